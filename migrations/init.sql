@@ -10,24 +10,88 @@ CREATE TABLE ingestor_executions (
     fetched_hour TIMESTAMP,
     number_of_files_fetched INTEGER,
     file_destination_path VARCHAR(255),
+    file_codec VARCHAR(32),
     traceback TEXT
 );
 
+CREATE INDEX ingestor_executions_workflow_id_idx ON ingestor_executions (workflow_id);
+
+-- latest successfully fetched hour (MAX(fetched_hour) WHERE traceback IS NULL)
+CREATE INDEX ingestor_executions_fetched_hour_success_idx ON ingestor_executions (fetched_hour) WHERE traceback IS NULL;
+
 CREATE TABLE handler_executions (
     workflow_id UUID,
     code_execution_id UUID,
     code_execution_date TIMESTAMP,
     file_fetch_path VARCHAR(255),
+    file_fingerprint VARCHAR(255),
     destination_table VARCHAR(255),
     records_inserted INTEGER,
+    records_updated INTEGER,
+    records_skipped INTEGER,
     traceback TEXT
 );
 
+CREATE INDEX handler_executions_workflow_id_idx ON handler_executions (workflow_id);
+
+-- clean loads of a file, looked up before it is loaded again
+CREATE INDEX handler_executions_file_fetch_path_idx ON handler_executions (file_fetch_path, file_fingerprint) WHERE traceback IS NULL;
+
+-- hours claimed by the executor workers (--worker): fetched, published to
+-- ingestor_executions in hour order, then handled (status ingest -> ingesting ->
+-- ingested -> handle -> handling -> done)
+CREATE TABLE work_queue (
+    fetched_hour TIMESTAMP PRIMARY KEY,
+    workflow_id UUID NOT NULL,
+    status VARCHAR(16) NOT NULL DEFAULT 'ingest',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_token UUID,
+    lease_owner VARCHAR(255),
+    lease_expires_at TIMESTAMPTZ,
+    code_execution_id UUID,
+    code_execution_date TIMESTAMP,
+    number_of_files_fetched INTEGER,
+    file_destination_path VARCHAR(255),
+    file_codec VARCHAR(32)
+);
+
+-- work still to claim, oldest hour first
+CREATE INDEX work_queue_status_idx ON work_queue (status, fetched_hour) WHERE status <> 'done';
+
+CREATE TABLE stage_metrics (
+    workflow_id UUID,
+    code_execution_id UUID,
+    code_step VARCHAR(32),
+    stage VARCHAR(255),
+    calls INTEGER,
+    wall_seconds DOUBLE PRECISION,
+    cpu_seconds DOUBLE PRECISION,
+    bytes_processed BIGINT,
+    rows_processed BIGINT,
+    peak_memory_bytes BIGINT
+);
+
+CREATE INDEX stage_metrics_code_execution_id_idx ON stage_metrics (code_execution_id);
+
+CREATE TABLE s3_object_index (
+    bucket_name VARCHAR(255),
+    object_key VARCHAR(1024) COLLATE "C",
+    last_modified TIMESTAMPTZ,
+    object_size BIGINT,
+    etag VARCHAR(255),
+    PRIMARY KEY (bucket_name, object_key)
+);
+
+CREATE INDEX s3_object_index_last_modified_idx ON s3_object_index (bucket_name, last_modified);
+
 
 \connect data_warehouse_db
 
+-- range partitioned on event_timestamp, the handler creates the daily or monthly
+-- partitions (see partitioning in schema_entities.yaml) ahead of every load
+
 CREATE TABLE vehicle_location (
-	event_generated_id UUID PRIMARY KEY,
+	event_generated_id UUID,
     vehicle_id UUID,
     event_timestamp TIMESTAMP NOT NULL,
     event_operation VARCHAR(255),
@@ -35,18 +99,20 @@ CREATE TABLE vehicle_location (
     vehicle_latitude FLOAT,
     vehicle_longitude FLOAT,
     vehicle_location_timestamp TIMESTAMP,
-    original_s3_file_path VARCHAR(255)
-);
+    original_s3_file_path VARCHAR(255),
+    PRIMARY KEY (event_generated_id, event_timestamp)
+) PARTITION BY RANGE (event_timestamp);
 
 
 CREATE TABLE operating_periods (
-	event_generated_id UUID PRIMARY KEY,
+	event_generated_id UUID,
     operating_period_id VARCHAR(255),
     event_timestamp TIMESTAMP NOT NULL,
     event_operation VARCHAR(255),
     organization_id VARCHAR(255),
     operation_start TIMESTAMP,
     operation_finish TIMESTAMP,
-    original_s3_file_path VARCHAR(255)
-);
+    original_s3_file_path VARCHAR(255),
+    PRIMARY KEY (event_generated_id, event_timestamp)
+) PARTITION BY RANGE (event_timestamp);
 
@@ -0,0 +1,88 @@
+import io
+import json
+import time
+import click
+from helper.codec import CODECS
+
+
+def benchmark_codec(codec, records):
+    """
+    Encode and decode records with a codec, measuring the encoded size and timings.
+
+    Args:
+        codec: Intermediate file codec (see helper.codec).
+        records (list): JSON records.
+
+    Returns:
+        dict: Bytes stored and encode/decode times in seconds.
+    """
+    buffer = io.BytesIO()
+    start_time = time.perf_counter()
+    codec.encode(iter(records), buffer)
+    encode_time = time.perf_counter() - start_time
+
+    encoded_size = buffer.tell()
+    buffer.seek(0)
+
+    start_time = time.perf_counter()
+    number_of_records = sum(1 for _ in codec.decode(buffer))
+    decode_time = time.perf_counter() - start_time
+
+    if number_of_records != len(records):
+        raise Exception(
+            f"Codec {codec.name} decoded {number_of_records} of {len(records)} records."
+        )
+
+    return {
+        "codec": codec.name,
+        "records": len(records),
+        "bytes": encoded_size,
+        "encode_seconds": round(encode_time, 4),
+        "decode_seconds": round(decode_time, 4),
+    }
+
+
+@click.command()
+@click.argument("events_file", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--repeat",
+    "-r",
+    default=1,
+    type=int,
+    help="Number of times the events of the file are repeated to scale the input.",
+)
+@click.option(
+    "--output",
+    "-o",
+    default=None,
+    type=click.Path(dir_okay=False),
+    help="Write the results to this file as JSON.",
+)
+def main(events_file, repeat, output) -> None:
+    """
+    Compare the bytes stored and the encode/decode time of every intermediate file codec
+    on a newline-delimited JSON file of events (e.g. the sample requests.jsonl).
+    """
+    with open(events_file, "r") as f:
+        records = [json.loads(line) for line in f if line.strip()] * repeat
+
+    results = [benchmark_codec(codec, records) for codec in CODECS.values()]
+
+    baseline_size = results[0]["bytes"]
+    click.echo(
+        f"{'codec':<12} {'records':>9} {'bytes':>12} {'ratio':>7} {'encode s':>9} {'decode s':>9}"
+    )
+    for result in results:
+        click.echo(
+            f"{result['codec']:<12} {result['records']:>9} {result['bytes']:>12} "
+            f"{result['bytes'] / baseline_size:>7.3f} {result['encode_seconds']:>9.3f} "
+            f"{result['decode_seconds']:>9.3f}"
+        )
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
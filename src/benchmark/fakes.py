@@ -0,0 +1,439 @@
+from botocore.response import StreamingBody
+from datetime import datetime, timezone
+from helper.s3 import S3
+from helper.postgres import PostgresSQL
+from helper.resources import Resources
+from urllib.parse import quote, unquote
+import threading
+import hashlib
+import pickle
+import time
+import io
+import os
+
+
+class FakeS3Client:
+    """
+    In-memory stand-in for the boto3 S3 client, implementing the calls made by helper.s3.S3.
+    An optional latency is added to every request to mimic network round trips.
+    """
+
+    def __init__(self, latency=0.0, page_size=1000):
+        """
+        Args:
+            latency (float, optional): Seconds slept on every request.
+            page_size (int, optional): Maximum number of keys per listing page.
+        """
+        self.latency = latency
+        self.page_size = page_size
+        self.buckets = {}
+        self.requests = {}
+        self._multipart_uploads = {}
+        self._lock = threading.Lock()
+
+    def create_bucket(self, Bucket, **kwargs):
+        self._request("create_bucket")
+        self.buckets.setdefault(Bucket, {})
+        return {}
+
+    def list_buckets(self):
+        self._request("list_buckets")
+        return {"Buckets": [{"Name": name} for name in self.buckets]}
+
+    def put_object(self, Bucket, Key, Body, LastModified=None, **kwargs):
+        self._request("put_object")
+        if isinstance(Body, str):
+            Body = Body.encode("utf-8")
+        with self._lock:
+            self.buckets[Bucket][Key] = {
+                "Body": bytes(Body),
+                "LastModified": LastModified or datetime.now(timezone.utc),
+                "ETag": f'"{hashlib.md5(Body).hexdigest()}"',
+            }
+        return {}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        self._request("get_object")
+        obj = self.buckets[Bucket][Key]
+        return {
+            "Body": StreamingBody(io.BytesIO(obj["Body"]), len(obj["Body"])),
+            "ContentLength": len(obj["Body"]),
+            "ETag": obj["ETag"],
+            "LastModified": obj["LastModified"],
+        }
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self._request("head_object")
+        obj = self.buckets[Bucket][Key]
+        return {
+            "ContentLength": len(obj["Body"]),
+            "ETag": obj["ETag"],
+            "LastModified": obj["LastModified"],
+        }
+
+    def list_objects_v2(self, Bucket, Prefix="", StartAfter="", **kwargs):
+        self._request("list_objects_v2")
+        keys = sorted(
+            key
+            for key in self.buckets[Bucket]
+            if key.startswith(Prefix) and key > (StartAfter or "")
+        )
+        contents = [
+            {
+                "Key": key,
+                "LastModified": self.buckets[Bucket][key]["LastModified"],
+                "Size": len(self.buckets[Bucket][key]["Body"]),
+                "ETag": self.buckets[Bucket][key]["ETag"],
+            }
+            for key in keys[: self.page_size]
+        ]
+        return {
+            "Contents": contents,
+            "KeyCount": len(contents),
+            "IsTruncated": len(keys) > self.page_size,
+        }
+
+    def get_paginator(self, operation_name):
+        return _FakeListObjectsPaginator(self)
+
+    def upload_file(self, Filename, Bucket, Key, **kwargs):
+        with open(Filename, "rb") as f:
+            self.put_object(Bucket=Bucket, Key=Key, Body=f.read())
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self._request("create_multipart_upload")
+        with self._lock:
+            upload_id = str(len(self._multipart_uploads) + 1)
+            self._multipart_uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        self._request("upload_part")
+        self._multipart_uploads[UploadId][PartNumber] = bytes(Body)
+        return {"ETag": f'"{hashlib.md5(Body).hexdigest()}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self._request("complete_multipart_upload")
+        parts = self._multipart_uploads.pop(UploadId)
+        body = b"".join(parts[part["PartNumber"]] for part in MultipartUpload["Parts"])
+        self.put_object(Bucket=Bucket, Key=Key, Body=body)
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self._request("abort_multipart_upload")
+        self._multipart_uploads.pop(UploadId, None)
+        return {}
+
+    def close(self):
+        pass
+
+    def _request(self, operation_name):
+        """
+        Count a request and wait for the simulated latency.
+
+        Args:
+            operation_name (str): Name of the S3 operation.
+        """
+        with self._lock:
+            self.requests[operation_name] = self.requests.get(operation_name, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class DirectoryS3Client(FakeS3Client):
+    """
+    FakeS3Client keeping its buckets in a local directory instead of memory, so several
+    processes (e.g. workers) can share them. Each bucket is a subdirectory and each
+    object a pickled file named after its quoted key, replaced atomically on writes.
+    """
+
+    def __init__(self, root_dir, latency=0.0, page_size=1000):
+        """
+        Args:
+            root_dir (str): Directory holding the buckets, created if missing.
+            latency (float, optional): Seconds slept on every request.
+            page_size (int, optional): Maximum number of keys per listing page.
+        """
+        super().__init__(latency=latency, page_size=page_size)
+        self.buckets = _DirectoryBuckets(root_dir)
+
+
+class _DirectoryBuckets:
+    """
+    Mapping of bucket names to _DirectoryBucket, one subdirectory per bucket.
+    """
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        os.makedirs(root_dir, exist_ok=True)
+
+    def __getitem__(self, bucket_name):
+        if bucket_name not in self:
+            raise KeyError(bucket_name)
+        return _DirectoryBucket(os.path.join(self.root_dir, bucket_name))
+
+    def __contains__(self, bucket_name):
+        return os.path.isdir(os.path.join(self.root_dir, bucket_name))
+
+    def __iter__(self):
+        return iter(sorted(os.listdir(self.root_dir)))
+
+    def setdefault(self, bucket_name, default=None):
+        os.makedirs(os.path.join(self.root_dir, bucket_name), exist_ok=True)
+        return self[bucket_name]
+
+
+class _DirectoryBucket:
+    """
+    Mapping of object keys to objects (dicts of Body, LastModified and ETag), one
+    pickled file per object.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __getitem__(self, key):
+        try:
+            with open(self._file_path(key), "rb") as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, obj):
+        # written aside first, readers in other processes never see a partial object
+        temporary_path = (
+            f"{self._file_path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        )
+        with open(temporary_path, "wb") as f:
+            pickle.dump(obj, f)
+        os.replace(temporary_path, self._file_path(key))
+
+    def __contains__(self, key):
+        return os.path.exists(self._file_path(key))
+
+    def __iter__(self):
+        return (
+            unquote(file_name)
+            for file_name in os.listdir(self.path)
+            if not file_name.endswith(".tmp")
+        )
+
+    def _file_path(self, key):
+        return os.path.join(self.path, quote(key, safe=""))
+
+
+class _FakeListObjectsPaginator:
+    """
+    Paginator for FakeS3Client.list_objects_v2, following StartAfter like boto3 does.
+    """
+
+    def __init__(self, s3_client):
+        self.s3_client = s3_client
+
+    def paginate(self, Bucket, Prefix="", StartAfter="", **kwargs):
+        while True:
+            page = self.s3_client.list_objects_v2(
+                Bucket=Bucket, Prefix=Prefix, StartAfter=StartAfter
+            )
+            yield page
+            if not page["IsTruncated"]:
+                return
+            StartAfter = page["Contents"][-1]["Key"]
+
+
+def fake_s3(s3_client, max_workers=8, max_retries=3):
+    """
+    Build a helper.s3.S3 instance talking to a fake client instead of a real endpoint.
+
+    Args:
+        s3_client (FakeS3Client): Client to use.
+        max_workers (int, optional): Number of objects downloaded concurrently.
+        max_retries (int, optional): Download attempts per object.
+
+    Returns:
+        S3: Instance using the fake client.
+    """
+    s3_instance = S3.__new__(S3)
+    s3_instance.max_workers = max_workers
+    s3_instance.max_retries = max_retries
+    s3_instance.s3_client = s3_client
+    s3_instance.cache = None
+    return s3_instance
+
+
+class RecordingCursor:
+    """
+    psycopg2 cursor stand-in that records the statements it receives instead of running
+    them. COPY input streams are read completely, so serialization costs are kept. The
+    target tables are considered empty: merges report every staged row as inserted.
+    """
+
+    def __init__(self):
+        self.statements = []
+        self.rows_received = 0
+        self.bytes_received = 0
+        self.rowcount = -1
+        self._rows_staged = 0
+        self._result = []
+
+    def execute(self, query, vars=None):
+        statement = " ".join(str(query).split())
+        self.statements.append(statement)
+        self.rowcount = 0
+        self._result = []
+        if "RETURNING (xmax = 0)" in statement:
+            # counts of the merge, in a single group (no 'count_by' column)
+            self._result = [(None, self._rows_staged, 0)]
+
+    def executemany(self, query, vars_list):
+        self.statements.append(" ".join(str(query).split()))
+        for row in vars_list:
+            self.rows_received += 1
+            self.bytes_received += sum(len(str(value)) for value in row)
+
+    def copy_expert(self, sql, file, size=8192):
+        self.statements.append(" ".join(str(sql).split()))
+        self._rows_staged = 0
+        while True:
+            data = file.read(size)
+            if not data:
+                break
+            self.rows_received += data.count("\n")
+            self._rows_staged += data.count("\n")
+            self.bytes_received += len(data)
+
+    def fetchone(self):
+        return self._result[0] if self._result else None
+
+    def fetchall(self):
+        return list(self._result)
+
+    def close(self):
+        pass
+
+
+class RecordingConnection:
+    """
+    psycopg2 connection stand-in handing out a RecordingCursor.
+    """
+
+    def __init__(self):
+        self.autocommit = True
+        self.commits = 0
+        self.rollbacks = 0
+        self._cursor = RecordingCursor()
+
+    def cursor(self):
+        return self._cursor
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        pass
+
+
+class RecordingPostgresSQL(PostgresSQL):
+    """
+    PostgresSQL backed by a RecordingConnection, standing in for both databases when the
+    real steps run offline (see FakeResources). Every table exists, the execution
+    metadata rows and stage metrics are kept in memory, and the ingestor output of a
+    workflow is the one recorded with record_ingestor_output.
+    """
+
+    def __init__(self, shared_state, load_mode=None):
+        """
+        Args:
+            shared_state (dict): State shared by the instances of a run:
+                'ingestor_outputs' (file path and codec keyed by workflow ID),
+                'metadata_rows' and 'stage_metrics' (lists).
+            load_mode (str, optional): Load mode used instead of the one requested by
+                the caller.
+        """
+        super().__init__(connection=RecordingConnection())
+        self.shared_state = shared_state
+        self.load_mode = load_mode
+
+    def record_ingestor_output(self, execution_metadata):
+        """
+        Record the output of an ingestor execution, returned by get_ingestor_output_file.
+
+        Args:
+            execution_metadata (dict): Execution metadata of the hour (see
+                ingestor.ingest_hour).
+        """
+        self.shared_state["ingestor_outputs"][execution_metadata["workflow_id"]] = (
+            execution_metadata["file_destination_path"],
+            execution_metadata["file_codec"],
+        )
+
+    def get_ingestor_output_file(self, workflow_id):
+        return self.shared_state["ingestor_outputs"].get(workflow_id, (None, None))
+
+    def table_exists(self, table_name):
+        return True
+
+    def flush_metadata(self):
+        for code_step, rows in self._metadata_buffer.items():
+            self.shared_state["metadata_rows"].extend((code_step, row) for row in rows)
+        self._metadata_buffer.clear()
+
+    def insert_stage_metrics(self, stage_metrics):
+        self.shared_state["stage_metrics"].append(stage_metrics)
+
+    def insert_dataframe(
+        self,
+        dataframe,
+        table_name,
+        load_mode="insert",
+        partitioning=None,
+        count_by=None,
+    ):
+        return super().insert_dataframe(
+            dataframe,
+            table_name,
+            load_mode=self.load_mode or load_mode,
+            partitioning=partitioning,
+            count_by=count_by,
+        )
+
+
+class FakeResources(Resources):
+    """
+    Resources running the real steps offline: both S3 clients use the same fake client
+    and every Postgres connection is a RecordingPostgresSQL.
+    """
+
+    def __init__(self, s3_client, max_workers=8, load_mode=None):
+        """
+        Args:
+            s3_client (FakeS3Client): Client of the fake buckets.
+            max_workers (int, optional): Number of objects downloaded concurrently.
+            load_mode (str, optional): Load mode of every entity, the one of
+                schema_entities.yaml when not provided.
+        """
+        super().__init__()
+        self.s3_instance = fake_s3(s3_client, max_workers=max_workers)
+        self.load_mode = load_mode
+        self.shared_state = {
+            "ingestor_outputs": {},
+            "metadata_rows": [],
+            "stage_metrics": [],
+        }
+
+    def source_s3(self):
+        return self.s3_instance
+
+    def data_s3(self):
+        return self.s3_instance
+
+    def postgres(self, dbname, name="default"):
+        with self._lock:
+            pg_instance = self._pg_instances.get((dbname, name))
+            if pg_instance is None:
+                pg_instance = RecordingPostgresSQL(self.shared_state, self.load_mode)
+                self._pg_instances[(dbname, name)] = pg_instance
+            return pg_instance
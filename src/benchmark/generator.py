@@ -0,0 +1,120 @@
+from datetime import timedelta, timezone
+import random
+import uuid
+import json
+
+VEHICLE_EVENTS = ("register", "update", "update", "update", "deregister")
+OPERATING_PERIOD_EVENTS = ("create", "delete")
+
+
+def generate_events(
+    number_of_events,
+    hour,
+    number_of_vehicles=1000,
+    operating_period_ratio=0.01,
+    organization_id="org-id",
+    seed=0,
+):
+    """
+    Generate synthetic door2door events for one hour, modeled on the source schema:
+    'vehicle' events carry the vehicle id and location, 'operating_period' events the
+    period id, start and finish.
+
+    Args:
+        number_of_events (int): Number of events to generate.
+        hour (datetime): Hour the events happen in (UTC).
+        number_of_vehicles (int, optional): Number of distinct vehicles.
+        operating_period_ratio (float, optional): Share of operating_period events.
+        organization_id (str, optional): Organization of the events.
+        seed (int, optional): Seed of the random generator, for reproducible data.
+
+    Yields:
+        dict: Events, in chronological order.
+    """
+    rng = random.Random(seed)
+    vehicle_ids = [
+        str(uuid.UUID(int=rng.getrandbits(128), version=4))
+        for _ in range(number_of_vehicles)
+    ]
+    step = 3600 / max(number_of_events, 1)
+
+    for event_number in range(number_of_events):
+        at = hour + timedelta(seconds=event_number * step)
+
+        if rng.random() < operating_period_ratio:
+            start = at.replace(minute=0, second=0, microsecond=0)
+            yield {
+                "event": rng.choice(OPERATING_PERIOD_EVENTS),
+                "on": "operating_period",
+                "at": _isoformat(at),
+                "data": {
+                    "id": f"op_{rng.getrandbits(48):012x}",
+                    "start": _isoformat(start),
+                    "finish": _isoformat(start + timedelta(hours=8)),
+                },
+                "organization_id": organization_id,
+            }
+        else:
+            yield {
+                "event": rng.choice(VEHICLE_EVENTS),
+                "on": "vehicle",
+                "at": _isoformat(at),
+                "data": {
+                    "id": rng.choice(vehicle_ids),
+                    "location": {
+                        "lat": round(52.45 + rng.random() * 0.1, 6),
+                        "lng": round(13.35 + rng.random() * 0.1, 6),
+                        "at": _isoformat(at),
+                    },
+                },
+                "organization_id": organization_id,
+            }
+
+
+def populate_source_bucket(
+    s3_client, bucket_name, number_of_events, events_per_file, hour, seed=0
+):
+    """
+    Write synthetic events for one hour to a bucket as newline-delimited JSON files
+    under 'data/', the way the source bucket stores them.
+
+    Args:
+        s3_client: S3 client (e.g. FakeS3Client) to write the files with.
+        bucket_name (str): Name of the S3 bucket.
+        number_of_events (int): Number of events to generate.
+        events_per_file (int): Number of events per file.
+        hour (datetime): Hour the events happen in (UTC).
+        seed (int, optional): Seed of the random generator.
+
+    Returns:
+        int: Number of files written.
+    """
+    events = generate_events(number_of_events, hour, seed=seed)
+    number_of_files = 0
+    while True:
+        lines = [json.dumps(event) for _, event in zip(range(events_per_file), events)]
+        if not lines:
+            return number_of_files
+
+        s3_client.put_object(
+            Bucket=bucket_name,
+            Key=f"data/{hour.strftime('%Y-%m-%d-%H')}-{number_of_files:06d}-events.json",
+            Body="\n".join(lines).encode("utf-8"),
+            LastModified=hour + timedelta(minutes=number_of_files % 60),
+        )
+        number_of_files += 1
+
+
+def _isoformat(timestamp):
+    """
+    Format a timestamp the way the source events do (e.g. '2019-06-01T18:17:10.101Z').
+
+    Args:
+        timestamp (datetime): Timestamp in UTC.
+
+    Returns:
+        str: ISO 8601 timestamp with milliseconds.
+    """
+    return (
+        timestamp.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+    )
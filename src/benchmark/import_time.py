@@ -0,0 +1,116 @@
+import subprocess
+import statistics
+import json
+import time
+import sys
+import os
+import click
+
+STEP_MODES = ("help", "ingestor", "handler", "all", "daemon")
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure_import_time(step_mode):
+    """
+    Import the executor and the modules of a step mode in a fresh interpreter with
+    'python -X importtime', the way a new container starts.
+
+    Args:
+        step_mode (str): 'help' (executor only) or a mode of executor.load_step_modules.
+
+    Returns:
+        tuple: (wall time of the interpreter in seconds, cumulative import time of
+            every top-level import in microseconds keyed by module)
+    """
+    code = "import executor"
+    if step_mode != "help":
+        code += f"; executor.load_step_modules('{step_mode}')"
+
+    start_time = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=SRC_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    wall_time = time.perf_counter() - start_time
+
+    # lines look like 'import time:   self [us] | cumulative | imported package', nested
+    # imports being indented below the package importing them
+    top_level_imports = {}
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _, cumulative, package = line[len("import time:") :].split("|")
+        if not package.startswith("  "):
+            top_level_imports[package.strip()] = int(cumulative)
+
+    return wall_time, top_level_imports
+
+
+@click.command()
+@click.option(
+    "--repeat",
+    "-r",
+    default=5,
+    type=int,
+    help="Number of cold starts measured per step mode (the median is reported).",
+)
+@click.option(
+    "--top",
+    default=5,
+    type=int,
+    help="Number of slowest top-level imports listed per step mode.",
+)
+@click.option(
+    "--output",
+    "-o",
+    default=None,
+    type=click.Path(dir_okay=False),
+    help="Write the results to this file as JSON.",
+)
+def main(repeat, top, output) -> None:
+    """
+    Measure the cold-start latency of executor.py for every step mode: interpreter wall
+    time and import time, with the slowest top-level imports.
+    """
+    results = []
+    for step_mode in STEP_MODES:
+        measurements = [measure_import_time(step_mode) for _ in range(repeat)]
+        wall_times = [wall_time for wall_time, _ in measurements]
+        import_times = [sum(imports.values()) for _, imports in measurements]
+        slowest_imports = sorted(
+            measurements[-1][1].items(), key=lambda item: item[1], reverse=True
+        )[:top]
+
+        results.append(
+            {
+                "step_mode": step_mode,
+                "wall_seconds": round(statistics.median(wall_times), 4),
+                "import_seconds": round(statistics.median(import_times) / 1e6, 4),
+                "slowest_imports": [
+                    {"module": module, "seconds": round(cumulative / 1e6, 4)}
+                    for module, cumulative in slowest_imports
+                ],
+            }
+        )
+
+    click.echo(f"{'step mode':<10} {'wall s':>8} {'import s':>9}  slowest imports")
+    for result in results:
+        slowest = ", ".join(
+            f"{entry['module']} {entry['seconds']:.3f}"
+            for entry in result["slowest_imports"]
+        )
+        click.echo(
+            f"{result['step_mode']:<10} {result['wall_seconds']:>8.3f} "
+            f"{result['import_seconds']:>9.3f}  {slowest}"
+        )
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
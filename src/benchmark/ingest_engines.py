@@ -0,0 +1,183 @@
+from benchmark.generator import populate_source_bucket
+from benchmark.fakes import FakeS3Client, fake_s3
+from ingestor.ingestor import FIRST_FETCH_DATE, ENGINES, upload_hour_records
+from helper.codec import CODECS
+from helper.logger import logger
+from logging import WARNING
+import tracemalloc
+import statistics
+import hashlib
+import json
+import time
+import io
+import click
+
+SOURCE_BUCKET = "benchmark-source"
+DATA_BUCKET = "benchmark-data"
+
+
+def benchmark_engine(engine, s3_instance, keys, codec, repeat):
+    """
+    Upload the records of the source files with an ingestor engine, as ingest_hour does,
+    measuring the median wall time and the peak memory allocated by a traced run.
+
+    Args:
+        engine (str): Ingestor engine (see ingestor.ENGINES).
+        s3_instance (S3): Client of the fake buckets.
+        keys (list): Source object keys.
+        codec (str): Intermediate file codec.
+        repeat (int): Number of timed runs.
+
+    Returns:
+        tuple: (results dict, digest of the records of the uploaded file)
+    """
+    wall_times = []
+    for run_number in range(repeat):
+        start_time = time.perf_counter()
+        number_of_records = upload_hour_records(
+            engine,
+            keys,
+            s3_instance,
+            SOURCE_BUCKET,
+            s3_instance,
+            DATA_BUCKET,
+            f"{engine}-{run_number}.{CODECS[codec].extension}",
+            codec,
+        )
+        wall_times.append(time.perf_counter() - start_time)
+
+    tracemalloc.start()
+    upload_hour_records(
+        engine,
+        keys,
+        s3_instance,
+        SOURCE_BUCKET,
+        s3_instance,
+        DATA_BUCKET,
+        f"{engine}-traced.{CODECS[codec].extension}",
+        codec,
+    )
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # the uploaded file must hold the same records in the same order for every engine
+    response = s3_instance.s3_client.get_object(
+        Bucket=DATA_BUCKET, Key=f"{engine}-0.{CODECS[codec].extension}"
+    )
+    digest = hashlib.sha256()
+    for record in CODECS[codec].decode(io.BytesIO(response["Body"].read())):
+        digest.update(json.dumps(record, sort_keys=True).encode("utf-8"))
+
+    wall_seconds = statistics.median(wall_times)
+    return {
+        "engine": engine,
+        "records": number_of_records,
+        "seconds": round(wall_seconds, 4),
+        "records_per_second": round(number_of_records / wall_seconds),
+        "peak_memory_bytes": peak_memory,
+    }, digest.hexdigest()
+
+
+@click.command()
+@click.option(
+    "--events", "-e", default=200000, type=int, help="Number of synthetic events."
+)
+@click.option(
+    "--events-per-file",
+    default=1000,
+    type=int,
+    help="Number of events per source file.",
+)
+@click.option(
+    "--codec",
+    default="ndjson.gz",
+    type=click.Choice(list(CODECS)),
+    help="Intermediate file codec.",
+)
+@click.option(
+    "--latency",
+    default=0.02,
+    type=float,
+    help="Simulated S3 latency per request, in seconds.",
+)
+@click.option(
+    "--workers", default=8, type=int, help="Number of objects downloaded concurrently."
+)
+@click.option(
+    "--repeat",
+    "-r",
+    default=3,
+    type=int,
+    help="Number of timed runs per engine (the median is reported).",
+)
+@click.option("--seed", default=0, type=int, help="Seed of the event generator.")
+@click.option(
+    "--output",
+    "-o",
+    default=None,
+    type=click.Path(dir_okay=False),
+    help="Write the results to this file as JSON.",
+)
+def main(
+    events, events_per_file, codec, latency, workers, repeat, seed, output
+) -> None:
+    """
+    Compare the ingestor engines (thread pool vs asyncio pipeline) on the same synthetic
+    hour: wall time, records/s and peak memory of downloading, parsing, encoding and
+    uploading its files, checking that both upload the same records.
+    """
+    logger.setLevel(WARNING)
+
+    s3_client = FakeS3Client(latency=latency)
+    s3_client.create_bucket(Bucket=SOURCE_BUCKET)
+    s3_client.create_bucket(Bucket=DATA_BUCKET)
+    populate_source_bucket(
+        s3_client,
+        SOURCE_BUCKET,
+        events,
+        events_per_file,
+        FIRST_FETCH_DATE,
+        seed=seed,
+    )
+    s3_instance = fake_s3(s3_client, max_workers=workers)
+    keys = [obj["Key"] for obj in s3_instance.list_objects(SOURCE_BUCKET, "data/")]
+
+    results = []
+    digests = set()
+    for engine in ENGINES:
+        result, digest = benchmark_engine(engine, s3_instance, keys, codec, repeat)
+        results.append(result)
+        digests.add(digest)
+
+    if len(digests) != 1:
+        raise Exception("The ingestor engines uploaded different records.")
+
+    click.echo(f"{'engine':<8} {'seconds':>9} {'records/s':>11} {'peak MiB':>9}")
+    for result in results:
+        click.echo(
+            f"{result['engine']:<8} {result['seconds']:>9.3f} "
+            f"{result['records_per_second']:>11} "
+            f"{result['peak_memory_bytes'] / 2**20:>9.1f}"
+        )
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(
+                {
+                    "parameters": {
+                        "events": events,
+                        "events_per_file": events_per_file,
+                        "codec": codec,
+                        "latency": latency,
+                        "workers": workers,
+                        "seed": seed,
+                    },
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+from datetime import datetime, timezone
+from logging import WARNING
+import tracemalloc
+import statistics
+import random
+import hashlib
+import json
+import time
+import uuid
+import io
+import click
+import numpy as np
+import pandas as pd
+from benchmark.generator import generate_events
+from helper.helper import read_yaml, df_columns_normalization, generate_unique_ids
+from helper.extractor import compile_schema_entities
+from helper.postgres import COPY_NULL
+from helper.logger import logger
+
+SCHEMA_ENTITIES_PATH = "./helper/schema_entities.yaml"
+
+
+def legacy_df_columns_normalization(dataframe, column_schema):
+    """
+    df_columns_normalization as it was before columns were kept typed: every column is
+    inserted one at a time into an empty DataFrame and its missing values are replaced
+    by None, turning it into an object column. Kept as the baseline of the benchmark.
+
+    Args:
+        dataframe (pd.DataFrame): Input DataFrame to normalize.
+        column_schema (dict): Schema definition for columns.
+
+    Returns:
+        pd.DataFrame: Normalized DataFrame with unique event_generated_id and no duplicates.
+    """
+    source_to_pandas_type_mapping = {
+        "uuid": pd.StringDtype(),
+        "bigint": "Int64",
+        "int": "Int64",
+        "smallint": "Int64",
+        "float": "float64",
+        "varchar": pd.StringDtype(),
+        "decimal": "float64",
+        "timestamp": "datetime64[ms]",
+        "date": "datetime64[s]",
+        "char": pd.StringDtype(),
+        "bit": "bool",
+        "string": pd.StringDtype(),
+    }
+
+    formated_df = pd.DataFrame()
+
+    for original_column_name, column_specs in column_schema.items():
+        column_type = column_specs["type"]
+        pandas_type = source_to_pandas_type_mapping.get(column_type.lower())
+
+        if (column_type == "timestamp") or (column_type == "date"):
+            formated_df[original_column_name] = pd.to_datetime(
+                dataframe[original_column_name], errors="coerce"
+            ).dt.tz_localize(None)
+            formated_df[original_column_name] = formated_df[
+                original_column_name
+            ].replace({pd.NaT: None})
+        else:
+            formated_df[original_column_name] = dataframe[original_column_name].astype(
+                pandas_type
+            )
+            formated_df[original_column_name] = formated_df[
+                original_column_name
+            ].replace({np.nan: None})
+
+        if isinstance(pandas_type, pd.StringDtype):
+            formated_df[original_column_name] = formated_df[
+                original_column_name
+            ].str.strip()
+
+    formated_df.rename(
+        columns={
+            original_column_name: column_specs["column_name"]
+            for original_column_name, column_specs in column_schema.items()
+        },
+        inplace=True,
+    )
+    formated_df["event_generated_id"] = generate_unique_ids(
+        formated_df,
+        [
+            column_specs["column_name"]
+            for column_specs in column_schema.values()
+            if column_specs.get("unique_identifier")
+        ],
+    )
+
+    return formated_df.drop_duplicates(subset=["event_generated_id"])
+
+
+IMPLEMENTATIONS = {
+    "legacy": legacy_df_columns_normalization,
+    "typed": df_columns_normalization,
+}
+
+
+def normalize_and_serialize(normalization, dataframe, column_schema):
+    """
+    Normalize an extracted DataFrame and serialize it to CSV the way the copy and merge
+    load modes stream it to Postgres.
+
+    Args:
+        normalization (function): Normalization implementation.
+        dataframe (pd.DataFrame): Extracted DataFrame.
+        column_schema (dict): Schema definition for columns.
+
+    Returns:
+        tuple: (normalized DataFrame, CSV text, normalization seconds, serialization
+            seconds)
+    """
+    start_time = time.perf_counter()
+    df_normalized = normalization(dataframe, column_schema)
+    normalize_time = time.perf_counter() - start_time
+
+    buffer = io.StringIO()
+    start_time = time.perf_counter()
+    df_normalized.to_csv(buffer, index=False, header=False, na_rep=COPY_NULL)
+    serialize_time = time.perf_counter() - start_time
+
+    return df_normalized, buffer.getvalue(), normalize_time, serialize_time
+
+
+def benchmark_normalization(name, extracted, schema_entities, repeat):
+    """
+    Measure an implementation on the extracted DataFrames of every entity: median
+    normalization and serialization times, and peak memory allocated by a separate,
+    traced run.
+
+    Args:
+        name (str): Implementation name (see IMPLEMENTATIONS).
+        extracted (dict): Extracted DataFrame keyed by entity.
+        schema_entities (dict): Entity definitions from schema_entities.yaml.
+        repeat (int): Number of timed runs.
+
+    Returns:
+        tuple: (results dict, digest of the event_generated_id of every row)
+    """
+    normalization = IMPLEMENTATIONS[name]
+    normalize_times, serialize_times = [], []
+    for _ in range(repeat):
+        normalize_time, serialize_time = 0.0, 0.0
+        for entity, dataframe in extracted.items():
+            _, _, entity_normalize, entity_serialize = normalize_and_serialize(
+                normalization, dataframe, schema_entities[entity]["schema"]
+            )
+            normalize_time += entity_normalize
+            serialize_time += entity_serialize
+        normalize_times.append(normalize_time)
+        serialize_times.append(serialize_time)
+
+    digest = hashlib.sha256()
+    rows = 0
+    tracemalloc.start()
+    for entity, dataframe in extracted.items():
+        df_normalized, csv_text, _, _ = normalize_and_serialize(
+            normalization, dataframe, schema_entities[entity]["schema"]
+        )
+        rows += len(df_normalized)
+        digest.update(",".join(df_normalized["event_generated_id"]).encode("utf-8"))
+        del df_normalized, csv_text
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    normalize_seconds = statistics.median(normalize_times)
+    return {
+        "implementation": name,
+        "rows": rows,
+        "normalize_seconds": round(normalize_seconds, 4),
+        "serialize_seconds": round(statistics.median(serialize_times), 4),
+        "rows_per_second": (
+            round(rows / normalize_seconds) if normalize_seconds else None
+        ),
+        "peak_memory_bytes": peak_memory,
+    }, digest.hexdigest()
+
+
+@click.command()
+@click.option(
+    "--events", "-e", default=200000, type=int, help="Number of synthetic events."
+)
+@click.option(
+    "--repeat",
+    "-r",
+    default=3,
+    type=int,
+    help="Number of timed runs per implementation (the median is reported).",
+)
+@click.option(
+    "--null-ratio",
+    default=0.05,
+    type=float,
+    help="Share of events missing their optional fields (organization, location, finish).",
+)
+@click.option("--seed", default=0, type=int, help="Seed of the event generator.")
+@click.option(
+    "--output",
+    "-o",
+    default=None,
+    type=click.Path(dir_okay=False),
+    help="Write the results to this file as JSON.",
+)
+def main(events, repeat, null_ratio, seed, output) -> None:
+    """
+    Compare the time and memory of df_columns_normalization (typed columns, nulls
+    handled at serialization) with the legacy object-column implementation on the same
+    extracted synthetic events, including the CSV serialization used by COPY.
+    """
+    logger.setLevel(WARNING)
+
+    schema_entities = read_yaml(SCHEMA_ENTITIES_PATH)
+    extractors = compile_schema_entities(SCHEMA_ENTITIES_PATH)
+
+    hour = datetime(2022, 11, 24, 10, tzinfo=timezone.utc)
+    rng = random.Random(seed)
+    entities_data = {entity: [] for entity in schema_entities}
+    for event in generate_events(events, hour, seed=seed):
+        if rng.random() < null_ratio:
+            # optional fields only, the unique identifier columns are always present
+            event.pop("organization_id")
+            event["data"].pop("location", None)
+            event["data"].pop("finish", None)
+        event["original_s3_file_path"] = f"s3://benchmark/data/{uuid.uuid4().hex}.json"
+        entities_data[event["on"]].append(event)
+    extracted = {
+        entity: extractors[entity].extract(records)
+        for entity, records in entities_data.items()
+        if records
+    }
+    del entities_data
+
+    results = []
+    digests = set()
+    for name in IMPLEMENTATIONS:
+        result, digest = benchmark_normalization(
+            name, extracted, schema_entities, repeat
+        )
+        results.append(result)
+        digests.add(digest)
+
+    if len(digests) != 1:
+        raise Exception("The implementations generated different event_generated_ids.")
+
+    click.echo(
+        f"{'implementation':<15} {'normalize s':>12} {'serialize s':>12} "
+        f"{'rows/s':>10} {'peak MiB':>9}"
+    )
+    for result in results:
+        click.echo(
+            f"{result['implementation']:<15} {result['normalize_seconds']:>12.3f} "
+            f"{result['serialize_seconds']:>12.3f} {result['rows_per_second']:>10} "
+            f"{result['peak_memory_bytes'] / 2**20:>9.1f}"
+        )
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(
+                {
+                    "parameters": {
+                        "events": events,
+                        "null_ratio": null_ratio,
+                        "seed": seed,
+                    },
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,310 @@
+from benchmark.generator import populate_source_bucket
+from benchmark.fakes import FakeS3Client, FakeResources
+from ingestor.ingestor import FIRST_FETCH_DATE, ingest_hour
+from handler import handler
+from helper.codec import CODECS, get_codec
+from helper.metrics import StageMetrics
+from helper.postgres import LOAD_MODES
+from helper.logger import logger
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from logging import WARNING
+import subprocess
+import platform
+import uuid
+import json
+import time
+import os
+import click
+
+SOURCE_BUCKET = "benchmark-source"
+DATA_BUCKET = "benchmark-data"
+LOAD_NOTE = (
+    "postgres.* stages run against a recording cursor: they time the client side of "
+    "each load mode (building the statements, serializing the CSV), not the database, "
+    "and are not comparable between load modes."
+)
+
+
+@contextmanager
+def _environment(**variables):
+    """
+    Set environment variables for the enclosed block and restore them afterwards.
+
+    Args:
+        **variables: Values of the variables, as strings.
+    """
+    previous_values = {name: os.environ.get(name) for name in variables}
+    os.environ.update(variables)
+    try:
+        yield
+    finally:
+        for name, value in previous_values.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def _stage_results(stage_metrics_list):
+    """
+    Merge the stages of several StageMetrics recorders by step and stage.
+
+    Args:
+        stage_metrics_list (list): StageMetrics recorders of the run.
+
+    Returns:
+        list: Calls, wall and CPU seconds, rows, bytes and rows per second of every
+            (step, stage), in the order the stages were first recorded.
+    """
+    results = {}
+    for stage_metrics in stage_metrics_list:
+        for row in stage_metrics.rows():
+            result = results.setdefault(
+                (row["code_step"], row["stage"]),
+                {
+                    "code_step": row["code_step"],
+                    "stage": row["stage"],
+                    "calls": 0,
+                    "wall_seconds": 0.0,
+                    "cpu_seconds": 0.0,
+                    "rows": 0,
+                    "bytes": 0,
+                },
+            )
+            for key in ("calls", "wall_seconds", "cpu_seconds", "rows", "bytes"):
+                result[key] += row[key] or 0
+
+    for result in results.values():
+        result["wall_seconds"] = round(result["wall_seconds"], 4)
+        result["cpu_seconds"] = round(result["cpu_seconds"], 4)
+        result["rows_per_second"] = (
+            round(result["rows"] / result["wall_seconds"])
+            if result["rows"] and result["wall_seconds"] > 0
+            else None
+        )
+    return list(results.values())
+
+
+def run_benchmark(
+    number_of_events,
+    events_per_file,
+    codec,
+    load_mode=None,
+    latency=0.0,
+    workers=8,
+    chunk_size=50000,
+    seed=0,
+):
+    """
+    Run the real ingestor and handler steps (ingestor.ingest_hour and handler.main) on
+    one hour of synthetic events, with S3 and Postgres replaced by the in-process
+    stand-ins of benchmark.fakes, and collect the stage metrics they record. The hour
+    is listed with S3.list_objects, as the object index refresh does.
+
+    The handler loads every entity with load_mode: 'insert' (executemany upsert),
+    'copy' (COPY into a staging table, then upsert) or 'merge' (like 'copy', but only
+    new and changed rows are written). The statements are recorded instead of run, so
+    the postgres.* stages only time the client side of a load mode (see LOAD_NOTE).
+
+    Args:
+        number_of_events (int): Number of events of the fetched hour.
+        events_per_file (int): Number of events per source file.
+        codec (str): Intermediate file codec.
+        load_mode (str, optional): Load mode of every entity ('insert', 'copy' or
+            'merge'), the one of schema_entities.yaml when not provided.
+        latency (float, optional): Simulated S3 latency per request in seconds.
+        workers (int, optional): Number of objects downloaded concurrently.
+        chunk_size (int, optional): Number of records per handler chunk.
+        seed (int, optional): Seed of the event generator.
+
+    Returns:
+        tuple: (per-stage results (see _stage_results), wall seconds of every step)
+    """
+    hour = FIRST_FETCH_DATE
+    s3_client = FakeS3Client(latency=latency)
+    s3_client.create_bucket(Bucket=SOURCE_BUCKET)
+    s3_client.create_bucket(Bucket=DATA_BUCKET)
+    populate_source_bucket(
+        s3_client, SOURCE_BUCKET, number_of_events, events_per_file, hour, seed=seed
+    )
+
+    resources = FakeResources(s3_client, max_workers=workers, load_mode=load_mode)
+    s3_instance = resources.source_s3()
+    metadata_instance = resources.postgres("monitor_db")
+    workflow_id = str(uuid.uuid4())
+    step_seconds = {}
+
+    # ingestor
+    start_time = time.perf_counter()
+    list_metrics = StageMetrics(
+        code_step="ingestor", workflow_id=workflow_id, code_execution_id=None
+    )
+    with list_metrics.bind():
+        keys = [
+            obj["Key"]
+            for obj in s3_instance.list_objects(SOURCE_BUCKET, prefix="data/")
+            if hour <= obj["LastModified"] < hour + timedelta(hours=1)
+            and obj["Key"].endswith(".json")
+        ]
+    execution_metadata, error = ingest_hour(
+        workflow_id,
+        hour,
+        keys,
+        s3_instance,
+        SOURCE_BUCKET,
+        s3_instance,
+        DATA_BUCKET,
+        get_codec(codec),
+    )
+    step_seconds["ingestor"] = round(time.perf_counter() - start_time, 4)
+    if error is not None:
+        raise error
+    metadata_instance.record_ingestor_output(execution_metadata)
+
+    # handler, configured through the environment like in the container
+    start_time = time.perf_counter()
+    with _environment(S3_DATA_BUCKET=DATA_BUCKET, HANDLER_CHUNK_SIZE=str(chunk_size)):
+        loaded_workflows = handler.main(workflow_id, resources=resources, force=True)
+    step_seconds["handler"] = round(time.perf_counter() - start_time, 4)
+    if workflow_id not in loaded_workflows:
+        raise Exception(f"The handler did not load workflow {workflow_id}.")
+
+    stage_metrics_list = [list_metrics, execution_metadata["stage_metrics"]]
+    stage_metrics_list += resources.shared_state["stage_metrics"]
+    return _stage_results(stage_metrics_list), step_seconds
+
+
+def _git_commit():
+    """
+    Returns:
+        str: Commit hash of the working tree, or None outside of a git checkout.
+    """
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.command()
+@click.option(
+    "--events", "-e", default=100000, type=int, help="Number of synthetic events."
+)
+@click.option(
+    "--events-per-file",
+    default=1000,
+    type=int,
+    help="Number of events per source file.",
+)
+@click.option(
+    "--codec",
+    default="ndjson.gz",
+    type=click.Choice(list(CODECS)),
+    help="Intermediate file codec.",
+)
+@click.option(
+    "--load-mode",
+    default=None,
+    type=click.Choice(list(LOAD_MODES)),
+    help="Load mode of every entity: 'insert' (executemany upsert), 'copy' (COPY into "
+    "a staging table, then upsert) or 'merge' (like 'copy', only writing new and "
+    "changed rows). Defaults to the one of schema_entities.yaml. No database is "
+    "involved, the load timings are not comparable between modes.",
+)
+@click.option(
+    "--latency",
+    default=0.0,
+    type=float,
+    help="Simulated S3 latency per request, in seconds.",
+)
+@click.option(
+    "--workers", default=8, type=int, help="Number of objects downloaded concurrently."
+)
+@click.option(
+    "--chunk-size", default=50000, type=int, help="Number of records per handler chunk."
+)
+@click.option("--seed", default=0, type=int, help="Seed of the event generator.")
+@click.option(
+    "--output",
+    "-o",
+    default=None,
+    type=click.Path(dir_okay=False),
+    help="Write the results to this file as JSON.",
+)
+@click.option("--verbose", is_flag=True, help="Keep the pipeline INFO logs.")
+def main(
+    events,
+    events_per_file,
+    codec,
+    load_mode,
+    latency,
+    workers,
+    chunk_size,
+    seed,
+    output,
+    verbose,
+) -> None:
+    """
+    Benchmark the real ingestor and handler steps on synthetic events, without MinIO or
+    Postgres, and report the stage metrics they record (listing, download, parsing,
+    upload, fetch, extraction, normalization, ID hashing and load).
+    """
+    if not verbose:
+        logger.setLevel(WARNING)
+
+    parameters = {
+        "events": events,
+        "events_per_file": events_per_file,
+        "codec": codec,
+        "load_mode": load_mode,
+        "latency": latency,
+        "workers": workers,
+        "chunk_size": chunk_size,
+        "seed": seed,
+    }
+    stages, step_seconds = run_benchmark(
+        number_of_events=events,
+        events_per_file=events_per_file,
+        codec=codec,
+        load_mode=load_mode,
+        latency=latency,
+        workers=workers,
+        chunk_size=chunk_size,
+        seed=seed,
+    )
+
+    click.echo(
+        f"{'step':<9} {'stage':<36} {'calls':>6} {'seconds':>9} {'rows':>10} {'rows/s':>10}"
+    )
+    for result in stages:
+        rows_per_second = result["rows_per_second"] or 0
+        click.echo(
+            f"{result['code_step']:<9} {result['stage']:<36} {result['calls']:>6} "
+            f"{result['wall_seconds']:>9.3f} {result['rows']:>10} {rows_per_second:>10}"
+        )
+    # stages of concurrent tasks overlap, their seconds can add up to more than the step
+    for code_step, seconds in step_seconds.items():
+        click.echo(f"{code_step} step: {seconds:.3f}s")
+    click.echo(LOAD_NOTE)
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(
+                {
+                    "commit": _git_commit(),
+                    "created_at": datetime.now(timezone.utc).isoformat(),
+                    "python": platform.python_version(),
+                    "parameters": parameters,
+                    "steps": step_seconds,
+                    "stages": stages,
+                    "note": LOAD_NOTE,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
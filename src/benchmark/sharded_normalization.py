@@ -0,0 +1,178 @@
+from benchmark.generator import generate_events
+from ingestor.ingestor import FIRST_FETCH_DATE
+from handler.handler import SCHEMA_ENTITIES_PATH
+from helper.helper import read_yaml, df_columns_normalization
+from helper.extractor import compile_schema_entities
+from helper.sharding import normalize_sharded, pack_dataframe
+from helper.logger import logger
+from concurrent.futures import ProcessPoolExecutor
+from logging import WARNING
+import multiprocessing
+import statistics
+import pickle
+import json
+import time
+import click
+
+
+def benchmark_workers(workers, extracted, schema_entities, shard_size, repeat):
+    """
+    Normalize the extracted DataFrame of every entity with a number of worker processes
+    (in this process for a single worker), the way the handler does.
+
+    Args:
+        workers (int): Number of worker processes.
+        extracted (dict): Extracted DataFrame keyed by entity.
+        schema_entities (dict): Entity definitions from schema_entities.yaml.
+        shard_size (int): Maximum number of rows per shard.
+        repeat (int): Number of timed runs (the median is reported).
+
+    Returns:
+        tuple: (median seconds, event_generated_id lists keyed by entity)
+    """
+    executor = None
+    if workers > 1:
+        executor = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        # start the workers and import the modules before timing
+        list(executor.map(abs, range(workers)))
+
+    try:
+        wall_times = []
+        for _ in range(repeat):
+            event_ids = {}
+            start_time = time.perf_counter()
+            for entity, dataframe in extracted.items():
+                column_schema = schema_entities[entity]["schema"]
+                if executor is None:
+                    df_normalized = df_columns_normalization(dataframe, column_schema)
+                else:
+                    df_normalized = normalize_sharded(
+                        dataframe, column_schema, executor, shard_size
+                    )
+                event_ids[entity] = df_normalized["event_generated_id"].tolist()
+            wall_times.append(time.perf_counter() - start_time)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return statistics.median(wall_times), event_ids
+
+
+@click.command()
+@click.option(
+    "--events", "-e", default=400000, type=int, help="Number of synthetic events."
+)
+@click.option(
+    "--workers",
+    "-w",
+    "workers_list",
+    default="1,2,4,8",
+    help="Comma separated numbers of worker processes to measure.",
+)
+@click.option(
+    "--shard-size", default=10000, type=int, help="Number of records per shard."
+)
+@click.option(
+    "--repeat",
+    "-r",
+    default=3,
+    type=int,
+    help="Number of timed runs per worker count (the median is reported).",
+)
+@click.option("--seed", default=0, type=int, help="Seed of the event generator.")
+@click.option(
+    "--output",
+    "-o",
+    default=None,
+    type=click.Path(dir_okay=False),
+    help="Write the results to this file as JSON.",
+)
+def main(events, workers_list, shard_size, repeat, seed, output) -> None:
+    """
+    Measure how sharded normalization (helper.sharding) scales with the number of
+    worker processes on the same extracted synthetic events, and how compact the shard
+    payloads are compared to pickled record dicts.
+    """
+    logger.setLevel(WARNING)
+
+    schema_entities = read_yaml(SCHEMA_ENTITIES_PATH)
+    extractors = compile_schema_entities(SCHEMA_ENTITIES_PATH)
+
+    entities_data = {entity: [] for entity in schema_entities}
+    for event in generate_events(events, FIRST_FETCH_DATE, seed=seed):
+        event["original_s3_file_path"] = "benchmark-source/data/0000.json"
+        entities_data[event["on"]].append(event)
+
+    records_bytes, payload_bytes = 0, 0
+    extracted = {}
+    for entity, records in entities_data.items():
+        if not records:
+            continue
+        extracted[entity] = extractors[entity].extract(records)
+        for shard_start in range(0, len(records), shard_size):
+            records_bytes += len(
+                pickle.dumps(
+                    records[shard_start : shard_start + shard_size],
+                    protocol=pickle.HIGHEST_PROTOCOL,
+                )
+            )
+            payload_bytes += len(
+                pack_dataframe(
+                    extracted[entity].iloc[shard_start : shard_start + shard_size]
+                )
+            )
+    del entities_data
+
+    results = []
+    baseline_seconds, baseline_ids = None, None
+    for workers in [int(workers) for workers in workers_list.split(",")]:
+        seconds, event_ids = benchmark_workers(
+            workers, extracted, schema_entities, shard_size, repeat
+        )
+        if baseline_ids is None:
+            baseline_seconds, baseline_ids = seconds, event_ids
+        elif event_ids != baseline_ids:
+            raise Exception(f"{workers} workers normalized different rows.")
+
+        results.append(
+            {
+                "workers": workers,
+                "seconds": round(seconds, 4),
+                "records_per_second": round(events / seconds),
+                "speedup": round(baseline_seconds / seconds, 2),
+            }
+        )
+
+    click.echo(
+        f"shard payloads: {payload_bytes} bytes ({records_bytes} bytes as pickled records)"
+    )
+    click.echo(f"{'workers':>7} {'seconds':>9} {'records/s':>11} {'speedup':>8}")
+    for result in results:
+        click.echo(
+            f"{result['workers']:>7} {result['seconds']:>9.3f} "
+            f"{result['records_per_second']:>11} {result['speedup']:>8.2f}"
+        )
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(
+                {
+                    "parameters": {
+                        "events": events,
+                        "shard_size": shard_size,
+                        "cpu_count": multiprocessing.cpu_count(),
+                        "seed": seed,
+                    },
+                    "payload_bytes": payload_bytes,
+                    "records_bytes": records_bytes,
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,381 @@
+from benchmark.generator import populate_source_bucket
+from benchmark.fakes import DirectoryS3Client, fake_s3
+from handler.handler import SCHEMA_ENTITIES_PATH
+from helper.helper import read_yaml
+from helper.resources import Resources
+from helper.logger import logger
+from datetime import datetime, timedelta, timezone
+from logging import WARNING
+from os import getenv
+import subprocess
+import tempfile
+import shutil
+import signal
+import uuid
+import time
+import sys
+import os
+import click
+
+SOURCE_BUCKET = "workers-source"
+DATA_BUCKET = "workers-data"
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class DirectoryResources(Resources):
+    """
+    Resources whose S3 clients read and write a local directory shared by every worker
+    process (see benchmark.fakes.DirectoryS3Client). Postgres is the real one.
+    """
+
+    def __init__(self, s3_dir):
+        """
+        Args:
+            s3_dir (str): Directory holding the buckets.
+        """
+        super().__init__()
+        self.s3_client = DirectoryS3Client(s3_dir)
+
+    def source_s3(self):
+        return fake_s3(self.s3_client)
+
+    def data_s3(self):
+        return fake_s3(self.s3_client)
+
+
+def seed_work(resources, number_of_hours, number_of_events, events_per_file):
+    """
+    Write synthetic events for the last complete hours to the source bucket and record
+    the hour before them as fetched, so the workers queue exactly those hours.
+
+    Args:
+        resources (DirectoryResources): Shared clients and connections.
+        number_of_hours (int): Number of hours to generate.
+        number_of_events (int): Number of events per hour.
+        events_per_file (int): Number of events per source file.
+
+    Returns:
+        list: Hours generated (UTC), oldest first.
+    """
+    resources.s3_client.create_bucket(Bucket=SOURCE_BUCKET)
+    resources.s3_client.create_bucket(Bucket=DATA_BUCKET)
+    current_hour = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    hours = [
+        current_hour - timedelta(hours=hours_ago)
+        for hours_ago in range(number_of_hours, 0, -1)
+    ]
+    for seed, hour in enumerate(hours):
+        populate_source_bucket(
+            resources.s3_client,
+            SOURCE_BUCKET,
+            number_of_events,
+            events_per_file,
+            hour,
+            seed=seed,
+        )
+
+    resources.postgres(getenv("DATA_WAREHOUSE_MONITOR_DB")).insert_metadata(
+        "ingestor",
+        {
+            "workflow_id": str(uuid.uuid4()),
+            "code_execution_id": str(uuid.uuid4()),
+            "code_execution_date": datetime.now(timezone.utc),
+            "fetched_hour": (hours[0] - timedelta(hours=1)).replace(tzinfo=None),
+            "number_of_files_fetched": 0,
+        },
+    )
+    return hours
+
+
+def run_workers(
+    s3_dir, log_dir, number_of_processes, max_hours, lease_seconds, timeout
+):
+    """
+    Start worker processes, kill one of them (SIGKILL) as soon as it holds a lease, and
+    stop the others (SIGTERM) once every queued hour is done (or given up).
+
+    Args:
+        s3_dir (str): Directory holding the buckets.
+        log_dir (str): Directory receiving the log of every worker.
+        number_of_processes (int): Number of workers started.
+        max_hours (int): --max-hours of the workers.
+        lease_seconds (int): Lease of the claims, in seconds.
+        timeout (int): Seconds to wait for the queue to be done.
+
+    Returns:
+        tuple: (name of the killed worker, whether the queue was done in time)
+    """
+    env = dict(
+        os.environ,
+        S3_BUCKET=SOURCE_BUCKET,
+        S3_DATA_BUCKET=DATA_BUCKET,
+        WORK_LEASE_SECONDS=str(lease_seconds),
+        WORK_RETRY_SECONDS="1",
+        WORK_POLL_SECONDS="1",
+    )
+    processes = {}
+    for number in range(number_of_processes):
+        worker_name = f"worker-{number}"
+        with open(os.path.join(log_dir, f"{worker_name}.log"), "w") as log_file:
+            processes[worker_name] = subprocess.Popen(
+                [
+                    sys.executable,
+                    "-m",
+                    "benchmark.workers",
+                    "--run-worker",
+                    worker_name,
+                    "--s3-dir",
+                    s3_dir,
+                    "--max-hours",
+                    str(max_hours),
+                ],
+                cwd=SRC_DIR,
+                env=env,
+                stdout=log_file,
+                stderr=subprocess.STDOUT,
+            )
+
+    resources = Resources()
+    monitor_instance = resources.postgres(getenv("DATA_WAREHOUSE_MONITOR_DB"))
+    killed_worker = None
+    done = False
+    deadline = time.monotonic() + timeout
+    try:
+        while time.monotonic() < deadline:
+            monitor_instance.cursor.execute(
+                """
+                SELECT
+                    COUNT(*) FILTER (WHERE status IN ('done', 'failed')),
+                    COUNT(*),
+                    MIN(lease_owner) FILTER (WHERE status IN ('ingesting', 'handling'))
+                FROM work_queue;
+                """
+            )
+            done_hours, queued_hours, lease_owner = monitor_instance.cursor.fetchone()
+            if killed_worker is None and lease_owner in processes:
+                # dies in the middle of its work, the lease has to expire
+                killed_worker = lease_owner
+                processes[killed_worker].kill()
+                click.echo(f"Killed {killed_worker} while it held a lease.")
+            if killed_worker and queued_hours and done_hours == queued_hours:
+                done = True
+                break
+            time.sleep(0.5)
+    finally:
+        resources.close()
+        for process in processes.values():
+            if process.poll() is None:
+                process.send_signal(signal.SIGTERM)
+        for process in processes.values():
+            try:
+                process.wait(timeout=max(lease_seconds, 30))
+            except subprocess.TimeoutExpired:
+                process.kill()
+    return killed_worker, done
+
+
+def check_results(monitor_instance, table_names):
+    """
+    Check that every queued hour was published exactly once and in hour order, and that
+    every published workflow with files was loaded exactly once into every table.
+
+    Args:
+        monitor_instance (PostgresSQL): Connection to monitor_db.
+        table_names (list): Names of the tables loaded by the handler.
+
+    Returns:
+        list: Problems found, empty when the run is correct.
+    """
+    problems = []
+    monitor_instance.cursor.execute(
+        "SELECT fetched_hour FROM work_queue WHERE status = 'failed' ORDER BY 1;"
+    )
+    for (fetched_hour,) in monitor_instance.cursor.fetchall():
+        problems.append(f"Hour {fetched_hour} was given up (status 'failed').")
+
+    monitor_instance.cursor.execute(
+        """
+        SELECT work_queue.fetched_hour, COUNT(ingestor_execution.workflow_id)
+        FROM work_queue
+        LEFT JOIN ingestor_executions AS ingestor_execution
+        ON ingestor_execution.fetched_hour = work_queue.fetched_hour
+        AND ingestor_execution.traceback IS NULL
+        GROUP BY work_queue.fetched_hour
+        ORDER BY work_queue.fetched_hour;
+        """
+    )
+    for fetched_hour, clean_rows in monitor_instance.cursor.fetchall():
+        if clean_rows != 1:
+            problems.append(
+                f"Hour {fetched_hour} has {clean_rows} clean ingestor_executions rows."
+            )
+
+    # rows inserted by later transactions have a higher xmin
+    monitor_instance.cursor.execute(
+        """
+        SELECT fetched_hour
+        FROM ingestor_executions
+        WHERE traceback IS NULL
+        AND fetched_hour >= (SELECT MIN(fetched_hour) FROM work_queue)
+        ORDER BY xmin::text::bigint, fetched_hour;
+        """
+    )
+    published_hours = [row[0] for row in monitor_instance.cursor.fetchall()]
+    if published_hours != sorted(published_hours):
+        problems.append(
+            f"Hours were published out of order: {[str(hour) for hour in published_hours]}."
+        )
+
+    monitor_instance.cursor.execute(
+        """
+        SELECT ingestor_execution.fetched_hour, handled_table.table_name, COUNT(entity_execution.workflow_id)
+        FROM work_queue
+        JOIN ingestor_executions AS ingestor_execution
+        ON ingestor_execution.workflow_id = work_queue.workflow_id
+        AND ingestor_execution.traceback IS NULL
+        AND ingestor_execution.number_of_files_fetched > 0
+        CROSS JOIN unnest(%s::varchar[]) AS handled_table (table_name)
+        LEFT JOIN handler_executions AS entity_execution
+        ON entity_execution.workflow_id = ingestor_execution.workflow_id
+        AND entity_execution.destination_table = handled_table.table_name
+        AND entity_execution.traceback IS NULL
+        AND NOT EXISTS (
+            SELECT 1
+            FROM handler_executions AS failed_execution
+            WHERE failed_execution.code_execution_id = entity_execution.code_execution_id
+            AND failed_execution.destination_table IS NULL
+            AND failed_execution.traceback IS NOT NULL
+        )
+        GROUP BY ingestor_execution.fetched_hour, handled_table.table_name
+        ORDER BY ingestor_execution.fetched_hour, handled_table.table_name;
+        """,
+        (list(table_names),),
+    )
+    handled_rows = monitor_instance.cursor.fetchall()
+    if not handled_rows:
+        problems.append("No hour with files was handled.")
+    for fetched_hour, table_name, clean_rows in handled_rows:
+        if clean_rows != 1:
+            problems.append(
+                f"Hour {fetched_hour} has {clean_rows} clean handler_executions rows "
+                f"for {table_name}."
+            )
+    return problems
+
+
+@click.command()
+@click.option(
+    "--processes", "-p", default=3, type=int, help="Number of workers started."
+)
+@click.option("--hours", default=8, type=int, help="Number of hours to process.")
+@click.option(
+    "--events",
+    "-e",
+    default=2000,
+    type=int,
+    help="Number of synthetic events per hour.",
+)
+@click.option(
+    "--events-per-file",
+    default=200,
+    type=int,
+    help="Number of events per source file.",
+)
+@click.option(
+    "--max-hours",
+    default=2,
+    type=int,
+    help="Maximum number of hours queued and handled together by a worker.",
+)
+@click.option(
+    "--lease-seconds",
+    default=10,
+    type=int,
+    help="Lease of the claims, the killed worker's work is claimed again after it.",
+)
+@click.option(
+    "--timeout",
+    default=300,
+    type=int,
+    help="Seconds to wait for every hour to be handled.",
+)
+@click.option("--run-worker", default=None, hidden=True)
+@click.option("--s3-dir", default=None, hidden=True)
+def main(
+    processes,
+    hours,
+    events,
+    events_per_file,
+    max_hours,
+    lease_seconds,
+    timeout,
+    run_worker,
+    s3_dir,
+) -> None:
+    """
+    Run several executor.py --worker processes against synthetic hours, kill one of them
+    while it holds a lease, and check that every hour ends up with exactly one clean
+    ingestor_executions row, published in hour order, and one clean handler_executions
+    row per table. S3 is replaced by a local directory, Postgres is the one configured
+    by the DATA_WAREHOUSE_* variables; its monitor_db must not have run the pipeline.
+    """
+    if run_worker:
+        from scheduler import worker
+
+        worker.main(
+            max_hours=max_hours,
+            delay=0,
+            worker_name=run_worker,
+            resources=DirectoryResources(s3_dir),
+        )
+        return
+
+    logger.setLevel(WARNING)
+    work_dir = tempfile.mkdtemp(prefix="workers-")
+    resources = DirectoryResources(os.path.join(work_dir, "s3"))
+    monitor_instance = resources.postgres(getenv("DATA_WAREHOUSE_MONITOR_DB"))
+    monitor_instance.cursor.execute(
+        "SELECT (SELECT COUNT(*) FROM work_queue) + (SELECT COUNT(*) FROM ingestor_executions);"
+    )
+    if monitor_instance.cursor.fetchone()[0]:
+        resources.close()
+        shutil.rmtree(work_dir)
+        raise click.ClickException(
+            "work_queue and ingestor_executions must be empty, run against a fresh monitor_db."
+        )
+
+    try:
+        seed_work(resources, hours, events, events_per_file)
+        click.echo(
+            f"Seeded {hours} hour(s) of {events} events, starting {processes} workers."
+        )
+        killed_worker, done = run_workers(
+            resources.s3_client.buckets.root_dir,
+            work_dir,
+            processes,
+            max_hours,
+            lease_seconds,
+            timeout,
+        )
+        problems = [] if done else [f"The queue was not done after {timeout}s."]
+        if killed_worker is None:
+            problems.append("No worker held a lease, none was killed.")
+        schema_entities = read_yaml(SCHEMA_ENTITIES_PATH)
+        problems += check_results(
+            monitor_instance,
+            [entity_specs["table_name"] for entity_specs in schema_entities.values()],
+        )
+    finally:
+        resources.close()
+
+    if problems:
+        for problem in problems:
+            click.echo(problem, err=True)
+        raise click.ClickException(f"Worker logs kept in {work_dir}.")
+
+    shutil.rmtree(work_dir)
+    click.echo("Every hour was fetched and handled exactly once, in order.")
+
+
+if __name__ == "__main__":
+    main()
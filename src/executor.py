@@ -1,14 +1,42 @@
 import uuid
-import traceback
 from helper.helper import check_inputs_consistency
-from art import text2art
 import click
-from datetime import datetime, timezone
-from ingestor import ingestor
-from handler import handler
+from datetime import timezone
 from helper.logger import logger
 
 
+def load_step_modules(step):
+    """
+    Import the modules of the steps run in a step mode. They are imported on demand so
+    a step mode only pays for the libraries it uses (e.g. the ingestor never loads
+    pandas).
+
+    Args:
+        step (str): Step mode ('all', 'ingestor', 'handler', 'daemon' or 'worker').
+
+    Returns:
+        dict: Step modules keyed by name.
+    """
+    modules = {}
+    if step in ("ingestor", "all"):
+        from ingestor import ingestor
+
+        modules["ingestor"] = ingestor
+    if step in ("handler", "all"):
+        from handler import handler
+
+        modules["handler"] = handler
+    if step == "daemon":
+        from scheduler import scheduler
+
+        modules["scheduler"] = scheduler
+    if step == "worker":
+        from scheduler import worker
+
+        modules["worker"] = worker
+    return modules
+
+
 @click.command()
 @click.option(
     "-s",
@@ -25,27 +53,127 @@ from helper.logger import logger
     "--workflow",
     "-w",
     required=False,
+    multiple=True,
+    help="the worflow_id to be executed. Should be used ONLY when variable 'step' is 'handler'. Repeat it to load several workflows in one coalesced run.",
+)
+@click.option(
+    "--pending",
+    is_flag=True,
+    default=False,
+    help="Handler: load the oldest workflows not loaded cleanly yet (up to HANDLER_PENDING_LIMIT), in one coalesced run.",
+)
+@click.option(
+    "--max-hours",
+    "-n",
+    required=False,
     default=None,
-    help="the worflow_id to be executed. Should be used ONLY when variable 'step' is 'handler'.",
+    type=click.IntRange(min=1),
+    help="Catch-up mode: maximum number of hours fetched by the ingestor in this run (unbounded with --until, 1 otherwise). Daemon and worker modes: maximum number of hours per run (1 by default).",
 )
-def executor(step, workflow) -> None:
+@click.option(
+    "--until",
+    "-u",
+    required=False,
+    default=None,
+    type=click.DateTime(),
+    help="Catch-up mode: only fetch hours starting before this UTC timestamp.",
+)
+@click.option(
+    "--workers",
+    required=False,
+    default=1,
+    type=click.IntRange(min=1),
+    help="Catch-up mode: number of hours fetched in parallel.",
+)
+@click.option(
+    "--daemon",
+    is_flag=True,
+    default=False,
+    help="Run forever, fetching and handling every hour as soon as it is complete.",
+)
+@click.option(
+    "--delay",
+    required=False,
+    default=60,
+    type=click.IntRange(min=0),
+    help="Daemon mode: seconds waited after an hour ends before fetching it.",
+)
+@click.option(
+    "--worker",
+    is_flag=True,
+    default=False,
+    help="Run forever, claiming hours to fetch and handle from the work queue. Start several to spread the work.",
+)
+@click.option(
+    "--force",
+    is_flag=True,
+    default=False,
+    help="Handler: reload every entity, even those already loaded from the same file.",
+)
+def executor(
+    step, workflow, pending, max_hours, until, workers, daemon, delay, worker, force
+) -> None:
+
+    check_inputs_consistency(
+        step,
+        workflow,
+        pending=pending,
+        catch_up=(max_hours or 1) > 1 or until is not None or workers > 1,
+        daemon=daemon,
+        until=until,
+        force=force,
+        worker=worker,
+    )
 
-    check_inputs_consistency(step, workflow)
+    if daemon:
+        load_step_modules("daemon")["scheduler"].main(
+            max_hours=max_hours or 1, workers=workers, delay=delay
+        )
+        return
+
+    if worker:
+        load_step_modules("worker")["worker"].main(
+            max_hours=max_hours or 1, delay=delay
+        )
+        return
 
     if not workflow:
-        workflow_id = str(uuid.uuid4())
+        workflow_ids = [str(uuid.uuid4())]
     else:
-        workflow_id = workflow
+        workflow_ids = list(workflow)
 
-    logger.info(
-        f"Starting workflow {workflow_id} -- step(s): {'ingestor and handler'if step == 'all' else step}"
-    )
+    if pending:
+        logger.info("Starting pending workflows -- step(s): handler")
+    else:
+        logger.info(
+            f"Starting workflow {', '.join(workflow_ids)} -- step(s): {'ingestor and handler'if step == 'all' else step}"
+        )
 
-    if step in ("ingestor", "all"):
-        ingestor.main(workflow_id)
+    step_modules = load_step_modules(step)
+    from helper.resources import Resources
 
-    if step in ("handler", "all"):
-        handler.main(workflow_id)
+    # the steps share one set of clients and pooled connections, closed once at the end
+    resources = Resources()
+    try:
+        if step in ("ingestor", "all"):
+            workflow_ids = step_modules["ingestor"].main(
+                workflow_ids[0],
+                max_hours=max_hours,
+                end_timestamp=until.replace(tzinfo=timezone.utc) if until else None,
+                workers=workers,
+                resources=resources,
+            )
+        elif pending:
+            workflow_ids = step_modules["handler"].get_pending_workflows(resources)
+            if not workflow_ids:
+                logger.info("No pending workflow to handle.")
+
+        # the hours fetched in this run (or the requested workflows) are loaded in one
+        # coalesced handler run
+        if step in ("handler", "all") and workflow_ids:
+            step_modules["handler"].main(workflow_ids, resources=resources, force=force)
+    finally:
+        resources.close()
 
 
 if __name__ == "__main__":
@@ -1,113 +1,687 @@
 from os import getenv
 from datetime import datetime, timezone
 import uuid
-from helper.s3 import S3
-from helper.postgres import PostgresSQL
+from helper.resources import Resources
 from helper.logger import logger
 from helper.helper import read_yaml, df_columns_normalization
-from pandas import json_normalize
+from helper.extractor import compile_schema_entities
+from helper.sharding import normalize_sharded
+from helper.metrics import StageMetrics
+from helper import metrics
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from itertools import islice
+from functools import partial
+import multiprocessing
 import traceback
-import sys
+import time
 
+SCHEMA_ENTITIES_PATH = "./helper/schema_entities.yaml"
+# column of the source file of every record, the rows of a coalesced run are counted
+# for the workflow whose file held them
+SOURCE_FILE_COLUMN = "original_s3_file_path"
 
-def main(workflow_id):
+
+def main(workflow_ids, resources=None, force=False, lease_token=None):
+    """
+    Load the files fetched by the ingestor for one or more workflows into the warehouse
+    tables. The files of several workflows are coalesced into one run: their records
+    are read one file after the other and cut into chunks of HANDLER_CHUNK_SIZE records,
+    so every entity is loaded in large batches (duplicates are dropped within a chunk).
+    handler_executions still gets one row per workflow and entity, with the rows counted
+    for the workflow whose file held them. When an entity fails on a chunk holding
+    several workflows, the chunk is loaded again one workflow at a time, so only the
+    workflows whose records fail are marked as failed, and their records of that entity
+    are left out of the following chunks. A workflow whose file cannot be read (missing
+    or undecodable) fails every entity it loads, and the other workflows are still loaded.
+
+    Entities already loaded cleanly from the same file content (same fingerprint in
+    handler_executions) are skipped, so a re-run only retries the failed entities.
+
+    Args:
+        workflow_ids (str or list): Workflow ID(s) whose files are loaded.
+        resources (Resources, optional): Shared clients and connections. When not
+            provided, they are created for this run and closed at its end.
+        force (bool, optional): Load every entity, even those already loaded.
+        lease_token (str, optional): Work queue claim of the workflows (see
+            scheduler.worker). Their handler_executions rows are then only written while
+            the claim is held, in the transaction recording the workflows loaded cleanly
+            as handled, and an exception is raised when the claim was lost.
+
+    Returns:
+        list: Workflow IDs whose entities are all loaded cleanly.
+    """
     logger.info("Starting handler step.")
-    try:
-        uuid.UUID(str(workflow_id))
-    except ValueError:
-        logger.error(
-            f"workflow_id are always UUIDs and the workflow_id '{workflow_id}' is not."
-        )
-        sys.exit(1)
-
-    metadata_instance = PostgresSQL(
-        dbname=getenv("DATA_WAREHOUSE_MONITOR_DB"),
-        user=getenv("DATA_WAREHOUSE_USER"),
-        password=getenv("DATA_WAREHOUSE_PASSWORD"),
-        host=getenv("DATA_WAREHOUSE_HOST"),
-        port=getenv("DATA_WAREHOUSE_PORT"),
-    )
+    if isinstance(workflow_ids, str):
+        workflow_ids = [workflow_ids]
+    workflow_ids = list(dict.fromkeys(workflow_ids))
+    for workflow_id in workflow_ids:
+        try:
+            uuid.UUID(str(workflow_id))
+        except ValueError:
+            raise ValueError(
+                f"workflow_id are always UUIDs and the workflow_id '{workflow_id}' is not."
+            )
 
-    s3_instance = S3(
-        access_key=getenv("S3_DATA_ROOT_USER"),
-        secret_access_key=getenv("S3_DATA_ROOT_PASSWORD"),
-        host=getenv("S3_DATA_HOST"),
-    )
+    owns_resources = resources is None
+    if owns_resources:
+        resources = Resources()
+
+    metadata_instance = resources.postgres(getenv("DATA_WAREHOUSE_MONITOR_DB"))
+
+    s3_instance = resources.data_s3()
     s3_bucket = getenv("S3_DATA_BUCKET")
     s3_instance.bucket_exists(s3_bucket)
 
-    pg_instance = PostgresSQL(
-        dbname=getenv("DATA_WAREHOUSE_DATA_DB"),
-        user=getenv("DATA_WAREHOUSE_USER"),
-        password=getenv("DATA_WAREHOUSE_PASSWORD"),
-        host=getenv("DATA_WAREHOUSE_HOST"),
-        port=getenv("DATA_WAREHOUSE_PORT"),
-    )
+    pg_instances = {}
 
-    execution_metadata = {}
-    execution_metadata["workflow_id"] = workflow_id
-    execution_metadata["code_execution_id"] = str(uuid.uuid4())
-    execution_metadata["code_execution_date"] = datetime.now(timezone.utc)
-    execution_metadata["file_fetch_path"] = None
+    # one code execution for all the workflows of the run, with its own metadata rows
+    code_execution_id = str(uuid.uuid4())
+    code_execution_date = datetime.now(timezone.utc)
+    executions_metadata = {}
+    for workflow_id in workflow_ids:
+        executions_metadata[workflow_id] = {
+            "workflow_id": workflow_id,
+            "code_execution_id": code_execution_id,
+            "code_execution_date": code_execution_date,
+            "file_fetch_path": None,
+            "file_fingerprint": None,
+        }
+    if len(workflow_ids) > 1:
+        logger.info(f"Coalescing {len(workflow_ids)} workflows in one handler run.")
+    # stage metrics of a coalesced run are recorded under its first workflow
+    stage_metrics = StageMetrics(
+        code_step="handler",
+        workflow_id=workflow_ids[0],
+        code_execution_id=code_execution_id,
+    )
     try:
-        schema_entities = read_yaml("./helper/schema_entities.yaml")
+        schema_entities = read_yaml(SCHEMA_ENTITIES_PATH)
+        extractors = compile_schema_entities(SCHEMA_ENTITIES_PATH)
         entities = list(schema_entities.keys())
         for entity in entities:
-            if not pg_instance.table_exists(schema_entities[entity]["table_name"]):
+            # every entity is loaded through its own connection
+            pg_instances[entity] = resources.postgres(
+                getenv("DATA_WAREHOUSE_DATA_DB"), name=entity
+            )
+            if not pg_instances[entity].table_exists(
+                schema_entities[entity]["table_name"]
+            ):
                 raise Exception(
                     f"Required table '{schema_entities[entity]['table_name']}' does not exist. Please create it first."
                 )
 
-        s3_file_path = metadata_instance.get_ingestor_output_file_path(
-            workflow_id=workflow_id
-        )
-        execution_metadata["file_fetch_path"] = s3_file_path
+        # (workflow ID, entity) loads that failed, left out of the following chunks
+        failed_loads = set()
+        # (workflow ID, file path, codec, entities to load) of every workflow to load
+        workflow_files = []
+        for workflow_id, execution_metadata in executions_metadata.items():
+            s3_file_path, file_codec = metadata_instance.get_ingestor_output_file(
+                workflow_id=workflow_id
+            )
+            execution_metadata["file_fetch_path"] = s3_file_path
+            if s3_file_path is None:
+                logger.error(f"No valid .JSON file found for workflow {workflow_id}.")
+                continue
 
-        if s3_file_path is None:
-            logger.error(f"No valid .JSON file found for workflow {workflow_id}.")
-        else:
-            json_content = s3_instance.fetch_file_from_bucket(s3_file_path)
-            entities_data = {entity: [] for entity in entities}
-            for record in json_content:
-                entities_data[record["on"]].append(record)
-
-            for entity in entities:
-                try:
-                    table_name = schema_entities[entity]["table_name"]
-                    execution_metadata[entity] = {"destination_table": table_name}
-                    logger.info(f"Entity {entity} -- Table {table_name}")
-
-                    df = json_normalize(entities_data[entity])
-                    df_normalized = df_columns_normalization(
-                        dataframe=df, column_schema=schema_entities[entity]["schema"]
-                    )
+            try:
+                execution_metadata["file_fingerprint"] = (
+                    s3_instance.get_file_fingerprint(s3_file_path)
+                )
+            except Exception as e:
+                _record_workflow_failure(
+                    executions_metadata,
+                    failed_loads,
+                    schema_entities,
+                    workflow_id,
+                    entities,
+                    e,
+                )
+                continue
 
-                    pg_instance.insert_dataframe(
-                        dataframe=df_normalized, table_name=table_name
-                    )
+            workflow_entities = list(entities)
+            if not force:
+                loaded_tables = metadata_instance.get_loaded_tables(
+                    s3_file_path, execution_metadata["file_fingerprint"]
+                )
+                for entity in entities:
+                    if schema_entities[entity]["table_name"] in loaded_tables:
+                        logger.info(
+                            f"Entity {entity} -- already loaded from {s3_file_path}, skipped."
+                        )
+                workflow_entities = [
+                    entity
+                    for entity in entities
+                    if schema_entities[entity]["table_name"] not in loaded_tables
+                ]
+            if not workflow_entities:
+                logger.info(
+                    f"Every entity was already loaded from {s3_file_path}, use --force to reload it."
+                )
+                continue
 
-                    execution_metadata[entity]["records_inserted"] = len(df_normalized)
+            for entity in workflow_entities:
+                execution_metadata[entity] = {
+                    "destination_table": schema_entities[entity]["table_name"],
+                    "records_inserted": 0,
+                    "records_updated": None,
+                    "records_skipped": None,
+                }
+            workflow_files.append(
+                (workflow_id, s3_file_path, file_codec, workflow_entities)
+            )
 
-                except Exception as e:
-                    execution_metadata[entity]["traceback"] = traceback.format_exc()
-                    logger.error(
-                        f"Error processing/loading data to table {table_name}: {e}"
+        if workflow_files:
+            entities = [
+                entity
+                for entity in entities
+                if any(entity in workflow_file[3] for workflow_file in workflow_files)
+            ]
+            chunk_size = int(getenv("HANDLER_CHUNK_SIZE", 50000))
+            entity_concurrency = int(
+                getenv("HANDLER_ENTITY_CONCURRENCY", len(entities))
+            )
+            entity_durations = {entity: 0.0 for entity in entities}
+            # workflow of every (entity, source file) of a coalesced run, the rows of a
+            # file are counted for the first workflow holding it
+            source_workflows = {} if len(workflow_files) > 1 else None
+
+            executor = ThreadPoolExecutor(max_workers=max(entity_concurrency, 1))
+            normalize_workers = int(getenv("HANDLER_NORMALIZE_WORKERS", 1))
+            shard_size = int(getenv("HANDLER_SHARD_SIZE", 10000))
+            normalize_executor = None
+            if normalize_workers > 1:
+                # spawned, not forked: the handler already runs threads and connections
+                normalize_executor = ProcessPoolExecutor(
+                    max_workers=normalize_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+                logger.info(
+                    f"Normalizing shards of {shard_size} records on {normalize_workers} processes."
+                )
+            try:
+                with stage_metrics.bind():
+                    records = _iter_workflow_records(
+                        s3_instance,
+                        workflow_files,
+                        entities,
+                        chunk_size,
+                        source_workflows,
+                        # a file that cannot be read only fails its own workflow
+                        on_failure=partial(
+                            _record_workflow_failure,
+                            executions_metadata,
+                            failed_loads,
+                            schema_entities,
+                        ),
                     )
+                    chunk_number = 0
+                    while chunk := list(islice(records, chunk_size)):
+                        chunk_number += 1
+                        logger.info(f"Chunk {chunk_number} -- {len(chunk)} records")
+                        entities_data = {entity: [] for entity in schema_entities}
+                        # workflow of every record of entities_data
+                        entities_workflows = {entity: [] for entity in schema_entities}
+                        for workflow_id, record in chunk:
+                            if (workflow_id, record["on"]) in failed_loads:
+                                # a previous chunk of the entity failed for the workflow
+                                continue
+                            entities_data[record["on"]].append(record)
+                            entities_workflows[record["on"]].append(workflow_id)
+                        del chunk
+
+                        futures = {}
+                        for entity in entities:
+                            if not entities_data[entity]:
+                                continue
+
+                            logger.info(
+                                f"Entity {entity} -- Table {schema_entities[entity]['table_name']}"
+                            )
+                            futures[entity] = metrics.submit(
+                                executor,
+                                _timed_load_entity_records,
+                                records=entities_data[entity],
+                                entity_specs=schema_entities[entity],
+                                extractor=extractors[entity],
+                                pg_instance=pg_instances[entity],
+                                normalize_executor=normalize_executor,
+                                shard_size=shard_size,
+                                count_by=(
+                                    SOURCE_FILE_COLUMN
+                                    if source_workflows is not None
+                                    else None
+                                ),
+                            )
+
+                        for entity, future in futures.items():
+                            try:
+                                row_counts, elapsed_time = future.result()
+                                entity_durations[entity] += elapsed_time
+                                if source_workflows is None:
+                                    workflow_row_counts = {
+                                        workflow_files[0][0]: row_counts
+                                    }
+                                else:
+                                    workflow_row_counts = _workflow_row_counts(
+                                        entity, row_counts, source_workflows
+                                    )
+                                for workflow_id, counts in workflow_row_counts.items():
+                                    _add_row_counts(
+                                        executions_metadata[workflow_id][entity], counts
+                                    )
+
+                            except Exception as e:
+                                workflow_records = _group_by_workflow(
+                                    entities_data[entity], entities_workflows[entity]
+                                )
+                                if len(workflow_records) == 1:
+                                    _record_load_failure(
+                                        executions_metadata,
+                                        failed_loads,
+                                        next(iter(workflow_records)),
+                                        entity,
+                                        schema_entities[entity]["table_name"],
+                                        e,
+                                    )
+                                    continue
+
+                                # the chunk is shared: it is loaded again one workflow
+                                # at a time, so only the failing workflows are marked
+                                logger.warning(
+                                    f"Entity {entity} -- chunk failed, loading its {len(workflow_records)} workflows one at a time: {e}"
+                                )
+                                for (
+                                    workflow_id,
+                                    records_of_workflow,
+                                ) in workflow_records.items():
+                                    try:
+                                        row_counts, elapsed_time = (
+                                            _timed_load_entity_records(
+                                                records=records_of_workflow,
+                                                entity_specs=schema_entities[entity],
+                                                extractor=extractors[entity],
+                                                pg_instance=pg_instances[entity],
+                                                normalize_executor=normalize_executor,
+                                                shard_size=shard_size,
+                                            )
+                                        )
+                                        entity_durations[entity] += elapsed_time
+                                        _add_row_counts(
+                                            executions_metadata[workflow_id][entity],
+                                            row_counts,
+                                        )
+                                    except Exception as workflow_error:
+                                        _record_load_failure(
+                                            executions_metadata,
+                                            failed_loads,
+                                            workflow_id,
+                                            entity,
+                                            schema_entities[entity]["table_name"],
+                                            workflow_error,
+                                        )
+                        del entities_data, entities_workflows
 
-                finally:
-                    metadata_instance.insert_metadata(
-                        code_step="handler", metadata=execution_metadata, entity=entity
+                for entity in entities:
+                    records_inserted = sum(
+                        execution_metadata[entity]["records_inserted"]
+                        for execution_metadata in executions_metadata.values()
+                        if entity in execution_metadata
                     )
+                    logger.info(
+                        f"Entity {entity} -- {records_inserted} records loaded in {entity_durations[entity]:.2f}s"
+                    )
+
+            finally:
+                executor.shutdown(wait=True, cancel_futures=True)
+                if normalize_executor is not None:
+                    normalize_executor.shutdown(wait=True, cancel_futures=True)
+                metadata_instance.insert_stage_metrics(stage_metrics)
+                if getenv("STAGE_METRICS_LOG", "false").lower() == "true":
+                    stage_metrics.log()
+                _write_execution_metadata(
+                    metadata_instance,
+                    executions_metadata,
+                    schema_entities,
+                    lease_token,
+                )
+
+        else:
+            # nothing to load, the workflows whose file cannot be read are still recorded
+            _write_execution_metadata(
+                metadata_instance, executions_metadata, schema_entities, lease_token
+            )
+
+        return _loaded_workflows(executions_metadata, schema_entities)
 
     except Exception as e:
-        execution_metadata["traceback"] = traceback.format_exc()
-        metadata_instance.insert_metadata(
-            code_step="handler", metadata=execution_metadata
-        )
+        error_traceback = traceback.format_exc()
+        for execution_metadata in executions_metadata.values():
+            execution_metadata["traceback"] = error_traceback
+            metadata_instance.buffer_metadata(
+                code_step="handler", metadata=execution_metadata
+            )
+        metadata_instance.flush_metadata()
         raise e
 
     finally:
+        if s3_instance.cache is not None:
+            s3_instance.cache.log_stats()
         logger.info("handler step finished.")
-        s3_instance.close()
-        metadata_instance.close()
-        pg_instance.close()
+        if owns_resources:
+            resources.close()
+
+
+def get_pending_workflows(resources, limit=None):
+    """
+    Return the workflows whose ingestor output was not loaded cleanly into every table
+    of schema_entities.yaml yet, oldest fetched hour first.
+
+    Args:
+        resources (Resources): Shared clients and connections.
+        limit (int, optional): Maximum number of workflows returned. Defaults to
+            HANDLER_PENDING_LIMIT (24).
+
+    Returns:
+        list: Workflow IDs still to be handled.
+    """
+    if limit is None:
+        limit = int(getenv("HANDLER_PENDING_LIMIT", 24))
+    schema_entities = read_yaml(SCHEMA_ENTITIES_PATH)
+    return resources.postgres(
+        getenv("DATA_WAREHOUSE_MONITOR_DB")
+    ).get_pending_workflows(
+        [entity_specs["table_name"] for entity_specs in schema_entities.values()],
+        limit=limit,
+    )
+
+
+def _iter_workflow_records(
+    s3_instance,
+    workflow_files,
+    entities,
+    chunk_size,
+    source_workflows=None,
+    on_failure=None,
+):
+    """
+    Stream the records of the files of several workflows one file after the other,
+    dropping the records of the entities a workflow does not load.
+
+    Args:
+        s3_instance (S3): Client with access to the data bucket.
+        workflow_files (list): (workflow ID, file path, codec, entities to load) of
+            every workflow.
+        entities (list): Entities loaded by the run.
+        chunk_size (int): Number of records read from S3 at a time.
+        source_workflows (dict, optional): Filled with the workflow of every (entity,
+            source file) met, the first workflow holding it.
+        on_failure (function, optional): Called with the workflow ID, its entities and
+            the error when a file cannot be read or decoded, while handling the error.
+            The following files are streamed anyway. The error is raised when not
+            provided.
+
+    Yields:
+        tuple: (workflow ID, JSON record).
+    """
+    for workflow_id, s3_file_path, file_codec, workflow_entities in workflow_files:
+        try:
+            for chunk in s3_instance.iter_file_records(
+                s3_file_path, chunk_size, codec=file_codec
+            ):
+                if source_workflows is None and len(workflow_entities) == len(entities):
+                    for record in chunk:
+                        yield workflow_id, record
+                    continue
+                for record in chunk:
+                    if record["on"] not in workflow_entities:
+                        continue
+                    if source_workflows is not None:
+                        source_workflows.setdefault(
+                            (record["on"], record[SOURCE_FILE_COLUMN]), workflow_id
+                        )
+                    yield workflow_id, record
+        except Exception as e:
+            if on_failure is None:
+                raise
+            on_failure(workflow_id, workflow_entities, e)
+
+
+def load_entity_records(
+    records,
+    entity_specs,
+    extractor,
+    pg_instance,
+    normalize_executor=None,
+    shard_size=10000,
+    count_by=None,
+):
+    """
+    Normalize the records of an entity according to its schema and load them into its table.
+
+    Args:
+        records (list): JSON records of the entity.
+        entity_specs (dict): Entity definition from schema_entities.yaml.
+        extractor (EntityExtractor): Extractor compiled from the entity schema.
+        pg_instance (PostgresSQL): Connection to the data warehouse.
+        normalize_executor (ProcessPoolExecutor, optional): Pool normalizing the
+            extracted records in shards (see helper.sharding). Normalized in this
+            process when not provided.
+        shard_size (int, optional): Maximum number of records per shard.
+        count_by (str, optional): Column the row counts are also broken down by.
+
+    Returns:
+        dict: 'inserted', 'updated' and 'skipped' row counts (see
+            PostgresSQL.insert_dataframe).
+    """
+    df = extractor.extract(records)
+    if normalize_executor is not None:
+        df_normalized = normalize_sharded(
+            df, entity_specs["schema"], normalize_executor, shard_size
+        )
+    else:
+        df_normalized = df_columns_normalization(
+            dataframe=df, column_schema=entity_specs["schema"]
+        )
+
+    return pg_instance.insert_dataframe(
+        dataframe=df_normalized,
+        table_name=entity_specs["table_name"],
+        load_mode=entity_specs.get("load_mode", "insert"),
+        partitioning=entity_specs.get("partitioning"),
+        count_by=count_by,
+    )
+
+
+def _timed_load_entity_records(**kwargs):
+    """
+    Run load_entity_records and measure how long it took.
+
+    Returns:
+        tuple: (row counts, elapsed time in seconds)
+    """
+    start_time = time.perf_counter()
+    row_counts = load_entity_records(**kwargs)
+    return row_counts, time.perf_counter() - start_time
+
+
+def _workflow_row_counts(entity, row_counts, source_workflows):
+    """
+    Split the row counts of a coalesced chunk of an entity, broken down by source file,
+    into the row counts of every workflow.
+
+    Args:
+        entity (str): Entity of the chunk.
+        row_counts (dict): Row counts of the chunk with their 'by' breakdown.
+        source_workflows (dict): Workflow of every (entity, source file).
+
+    Returns:
+        dict: 'inserted', 'updated' and 'skipped' row counts keyed by workflow ID.
+    """
+    workflow_row_counts = {}
+    for source_file, source_counts in row_counts["by"].items():
+        workflow_id = source_workflows[(entity, source_file)]
+        if workflow_id not in workflow_row_counts:
+            workflow_row_counts[workflow_id] = {
+                "inserted": 0,
+                "updated": None,
+                "skipped": None,
+            }
+        counts = workflow_row_counts[workflow_id]
+        counts["inserted"] += source_counts["inserted"]
+        for count_name in ("updated", "skipped"):
+            if source_counts[count_name] is not None:
+                counts[count_name] = (counts[count_name] or 0) + source_counts[
+                    count_name
+                ]
+    return workflow_row_counts
+
+
+def _loaded_workflows(executions_metadata, schema_entities):
+    """
+    Return the workflows of a run whose entities were all loaded cleanly (now or before).
+
+    Args:
+        executions_metadata (dict): Execution metadata keyed by workflow ID.
+        schema_entities (dict): Entity definitions from schema_entities.yaml.
+
+    Returns:
+        list: Workflow IDs.
+    """
+    return [
+        workflow_id
+        for workflow_id, execution_metadata in executions_metadata.items()
+        if execution_metadata["file_fetch_path"] is not None
+        and not any(
+            "traceback" in execution_metadata.get(entity, {})
+            for entity in schema_entities
+        )
+    ]
+
+
+def _group_by_workflow(records, record_workflows):
+    """
+    Split the records of a chunk by the workflow whose file held them.
+
+    Args:
+        records (list): JSON records of the chunk.
+        record_workflows (list): Workflow ID of every record.
+
+    Returns:
+        dict: Records keyed by workflow ID, in the order the workflows were met.
+    """
+    workflow_records = {}
+    for workflow_id, record in zip(record_workflows, records):
+        workflow_records.setdefault(workflow_id, []).append(record)
+    return workflow_records
+
+
+def _record_load_failure(
+    executions_metadata, failed_loads, workflow_id, entity, table_name, error
+):
+    """
+    Record the failure of an entity for a workflow: its traceback is stored in the
+    execution metadata and the entity is no longer loaded for the workflow. Must be
+    called while handling the exception.
+
+    Args:
+        executions_metadata (dict): Execution metadata keyed by workflow ID.
+        failed_loads (set): (workflow ID, entity) loads that failed.
+        workflow_id (str): Workflow whose records failed.
+        entity (str): Entity that failed.
+        table_name (str): Table of the entity.
+        error (Exception): Error raised.
+    """
+    failed_loads.add((workflow_id, entity))
+    executions_metadata[workflow_id][entity]["traceback"] = traceback.format_exc()
+    logger.error(
+        f"Error processing/loading data to table {table_name} for workflow {workflow_id}: {error}"
+    )
+
+
+def _record_workflow_failure(
+    executions_metadata, failed_loads, schema_entities, workflow_id, entities, error
+):
+    """
+    Record the failure of every entity a workflow loads, when its file cannot be read.
+    The entities already failed are left as they are. Must be called while handling
+    the exception.
+
+    Args:
+        executions_metadata (dict): Execution metadata keyed by workflow ID.
+        failed_loads (set): (workflow ID, entity) loads that failed.
+        schema_entities (dict): Entity definitions from schema_entities.yaml.
+        workflow_id (str): Workflow whose file failed.
+        entities (list): Entities loaded for the workflow.
+        error (Exception): Error raised.
+    """
+    for entity in entities:
+        if (workflow_id, entity) in failed_loads:
+            continue
+        executions_metadata[workflow_id].setdefault(
+            entity,
+            {
+                "destination_table": schema_entities[entity]["table_name"],
+                "records_inserted": 0,
+                "records_updated": None,
+                "records_skipped": None,
+            },
+        )
+        _record_load_failure(
+            executions_metadata,
+            failed_loads,
+            workflow_id,
+            entity,
+            schema_entities[entity]["table_name"],
+            error,
+        )
+
+
+def _write_execution_metadata(
+    metadata_instance, executions_metadata, schema_entities, lease_token=None
+):
+    """
+    Write the handler_executions rows of a run, one per workflow and entity loaded (or
+    failed). With a work queue claim, they are only written while the claim is held,
+    with the workflows loaded cleanly recorded as handled (see
+    PostgresSQL.flush_leased_metadata).
+
+    Args:
+        metadata_instance (PostgresSQL): Connection to monitor_db.
+        executions_metadata (dict): Execution metadata keyed by workflow ID.
+        schema_entities (dict): Entity definitions from schema_entities.yaml.
+        lease_token (str, optional): Work queue claim of the workflows.
+    """
+    for execution_metadata in executions_metadata.values():
+        for entity in schema_entities:
+            if entity in execution_metadata:
+                metadata_instance.buffer_metadata(
+                    code_step="handler", metadata=execution_metadata, entity=entity
+                )
+    if lease_token is None:
+        metadata_instance.flush_metadata()
+    elif not metadata_instance.flush_leased_metadata(
+        lease_token,
+        list(executions_metadata),
+        _loaded_workflows(executions_metadata, schema_entities),
+    ):
+        raise Exception(
+            f"Lease {lease_token} was lost, the workflows were claimed again and the handler_executions rows of this run are discarded."
+        )
+
+
+def _add_row_counts(entity_metadata, row_counts):
+    """
+    Add the row counts of a loaded chunk to the execution metadata of an entity. Updated
+    and skipped rows stay None unless the load mode counts them.
+
+    Args:
+        entity_metadata (dict): Execution metadata of the entity.
+        row_counts (dict): 'inserted', 'updated' and 'skipped' row counts of the chunk.
+    """
+    entity_metadata["records_inserted"] += row_counts["inserted"]
+    for count_name in ("updated", "skipped"):
+        if row_counts[count_name] is not None:
+            metadata_key = f"records_{count_name}"
+            entity_metadata[metadata_key] = (
+                entity_metadata[metadata_key] or 0
+            ) + row_counts[count_name]
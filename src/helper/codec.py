@@ -0,0 +1,253 @@
+import json
+import gzip
+
+COLUMNAR_BLOCK_SIZE = 10000
+READ_SIZE = 1024 * 1024
+
+
+class JSONCodec:
+    """
+    Single JSON array holding every record (the original intermediate format).
+    """
+
+    name = "json"
+    extension = "json"
+
+    def encode(self, records, fileobj):
+        """
+        Write records to a binary file object as a JSON array, one record at a time.
+
+        Args:
+            records (iterable): JSON-serializable records.
+            fileobj: Binary file object to write to.
+
+        Returns:
+            int: Number of records written.
+        """
+        number_of_records = 0
+        fileobj.write(b"[")
+        for record in records:
+            if number_of_records:
+                fileobj.write(b", ")
+            fileobj.write(json.dumps(record).encode("utf-8"))
+            number_of_records += 1
+        fileobj.write(b"]")
+        return number_of_records
+
+    def decode(self, fileobj):
+        """
+        Read the records of a JSON array. The array is parsed at once.
+
+        Args:
+            fileobj: Binary file object to read from.
+
+        Yields:
+            dict: JSON records.
+        """
+        yield from json.loads(fileobj.read().decode("utf-8"))
+
+
+class NDJSONCodec:
+    """
+    Newline-delimited JSON, one record per line.
+    """
+
+    name = "ndjson"
+    extension = "ndjson"
+
+    def encode(self, records, fileobj):
+        """
+        Write records to a binary file object as newline-delimited JSON.
+
+        Args:
+            records (iterable): JSON-serializable records.
+            fileobj: Binary file object to write to.
+
+        Returns:
+            int: Number of records written.
+        """
+        number_of_records = 0
+        for record in records:
+            fileobj.write((json.dumps(record) + "\n").encode("utf-8"))
+            number_of_records += 1
+        return number_of_records
+
+    def decode(self, fileobj):
+        """
+        Stream the records of a newline-delimited JSON file.
+
+        Args:
+            fileobj: Binary file object to read from.
+
+        Yields:
+            dict: JSON records.
+        """
+        for line in _iter_lines(fileobj):
+            if line.strip():
+                yield json.loads(line)
+
+
+class GzipNDJSONCodec(NDJSONCodec):
+    """
+    Gzip-compressed newline-delimited JSON.
+    """
+
+    name = "ndjson.gz"
+    extension = "ndjson.gz"
+
+    def encode(self, records, fileobj):
+        with gzip.GzipFile(fileobj=fileobj, mode="wb") as compressed_fileobj:
+            return super().encode(records, compressed_fileobj)
+
+    def decode(self, fileobj):
+        with gzip.GzipFile(fileobj=fileobj, mode="rb") as compressed_fileobj:
+            yield from super().decode(compressed_fileobj)
+
+
+class ColumnarCodec:
+    """
+    Gzip-compressed column blocks split by entity. Every line holds up to
+    COLUMNAR_BLOCK_SIZE records of one entity ('on' field) as
+    {"on": entity, "columns": {field: [values]}}, so top-level field names are stored
+    once per block instead of once per record. Fields missing from a record are
+    decoded as null.
+    """
+
+    name = "columnar.gz"
+    extension = "columnar.gz"
+
+    def __init__(self, block_size=COLUMNAR_BLOCK_SIZE):
+        self.block_size = block_size
+
+    def encode(self, records, fileobj):
+        """
+        Write records to a binary file object as gzip-compressed column blocks.
+
+        Args:
+            records (iterable): JSON-serializable records with an 'on' field.
+            fileobj: Binary file object to write to.
+
+        Returns:
+            int: Number of records written.
+        """
+        number_of_records = 0
+        blocks = {}
+        with gzip.GzipFile(fileobj=fileobj, mode="wb") as compressed_fileobj:
+            for record in records:
+                entity = record.get("on")
+                block = blocks.setdefault(entity, [])
+                block.append(record)
+                number_of_records += 1
+                if len(block) >= self.block_size:
+                    self._write_block(entity, block, compressed_fileobj)
+                    blocks[entity] = []
+
+            for entity, block in blocks.items():
+                if block:
+                    self._write_block(entity, block, compressed_fileobj)
+
+        return number_of_records
+
+    def decode(self, fileobj):
+        """
+        Stream the records of a columnar file, block by block.
+
+        Args:
+            fileobj: Binary file object to read from.
+
+        Yields:
+            dict: JSON records.
+        """
+        with gzip.GzipFile(fileobj=fileobj, mode="rb") as compressed_fileobj:
+            for line in _iter_lines(compressed_fileobj):
+                if not line.strip():
+                    continue
+                block = json.loads(line)
+                fields = list(block["columns"])
+                for values in zip(*block["columns"].values()):
+                    record = dict(zip(fields, values))
+                    record["on"] = block["on"]
+                    yield record
+
+    @staticmethod
+    def _write_block(entity, records, fileobj):
+        """
+        Write one block of records of an entity as a line of columns.
+
+        Args:
+            entity (str): Entity of the records.
+            records (list): Records of the block.
+            fileobj: Binary file object to write to.
+        """
+        fields = {}
+        for record in records:
+            fields.update(dict.fromkeys(record))
+        fields.pop("on", None)
+
+        columns = {field: [record.get(field) for record in records] for field in fields}
+        line = json.dumps({"on": entity, "columns": columns}) + "\n"
+        fileobj.write(line.encode("utf-8"))
+
+
+CODECS = {
+    codec.name: codec
+    for codec in (JSONCodec(), NDJSONCodec(), GzipNDJSONCodec(), ColumnarCodec())
+}
+
+
+def get_codec(name):
+    """
+    Return the intermediate file codec registered under a name.
+
+    Args:
+        name (str): Codec name ('json', 'ndjson', 'ndjson.gz' or 'columnar.gz').
+
+    Returns:
+        Codec instance.
+    """
+    try:
+        return CODECS[name.lower()]
+    except KeyError:
+        raise ValueError(
+            f"Invalid codec '{name}'. Valid options are: {', '.join(CODECS)}."
+        )
+
+
+def infer_codec(path):
+    """
+    Return the codec of an intermediate file from its extension (files written before
+    the codec was recorded in ingestor_executions).
+
+    Args:
+        path (str): Path or key of the file.
+
+    Returns:
+        Codec instance.
+    """
+    for codec in CODECS.values():
+        if path.endswith(f".{codec.extension}"):
+            return codec
+    return CODECS["json"]
+
+
+def _iter_lines(fileobj, read_size=READ_SIZE):
+    """
+    Split a binary stream into lines, reading it in blocks.
+
+    Args:
+        fileobj: Binary file object to read from.
+        read_size (int, optional): Number of bytes read at a time.
+
+    Yields:
+        bytes: Lines without the trailing newline.
+    """
+    pending = b""
+    while True:
+        data = fileobj.read(read_size)
+        if not data:
+            break
+        lines = (pending + data).split(b"\n")
+        pending = lines.pop()
+        yield from lines
+    if pending:
+        yield pending
@@ -0,0 +1,135 @@
+from helper.helper import read_yaml
+from helper import metrics
+import pandas as pd
+import numpy as np
+import os
+
+_compiled_schema_entities = {}
+
+
+class EntityExtractor:
+    """
+    Record extractor compiled from the schema of an entity. It reads only the dotted paths
+    named by the schema straight from the raw (nested) records into typed column arrays,
+    instead of flattening every field of the payload.
+    """
+
+    def __init__(self, column_schema: dict) -> None:
+        """
+        Compile the column schema of an entity.
+
+        Args:
+            column_schema (dict): Schema definition for columns, keyed by dotted path.
+        """
+        self.columns = [
+            (
+                original_column_name,
+                _compile_path_getter(original_column_name),
+                column_specs["type"].lower(),
+            )
+            for original_column_name, column_specs in column_schema.items()
+        ]
+
+    @metrics.measured("extractor.extract")
+    def extract(self, records: list) -> pd.DataFrame:
+        """
+        Build a DataFrame with one typed column per schema path from raw JSON records.
+        Paths missing from a record are extracted as nulls.
+
+        Args:
+            records (list): JSON records of the entity.
+
+        Returns:
+            pd.DataFrame: DataFrame whose columns are named after the schema paths.
+        """
+        columns = {}
+        for original_column_name, getter, column_type in self.columns:
+            values = [getter(record) for record in records]
+            columns[original_column_name] = _to_typed_array(values, column_type)
+
+        return pd.DataFrame(columns, copy=False)
+
+
+def compile_schema_entities(file_path):
+    """
+    Compile an EntityExtractor for every entity of a schema YAML file. The compiled plan is
+    cached and only rebuilt when the file changes.
+
+    Args:
+        file_path (str): Path to the schema YAML file.
+
+    Returns:
+        dict: EntityExtractor keyed by entity name.
+    """
+    file_version = os.stat(file_path).st_mtime_ns
+    cached = _compiled_schema_entities.get(file_path)
+    if cached is not None and cached[0] == file_version:
+        return cached[1]
+
+    schema_entities = read_yaml(file_path)
+    extractors = {
+        entity: EntityExtractor(entity_specs["schema"])
+        for entity, entity_specs in schema_entities.items()
+    }
+    _compiled_schema_entities[file_path] = (file_version, extractors)
+    return extractors
+
+
+def _compile_path_getter(dotted_path):
+    """
+    Build a function reading a dotted path (e.g. 'data.location.lat') from a nested record.
+
+    Args:
+        dotted_path (str): Path of the value, keys separated by dots.
+
+    Returns:
+        function: Getter returning the value, or None if the path does not exist.
+    """
+    keys = dotted_path.split(".")
+
+    if len(keys) == 1:
+        (key,) = keys
+
+        def getter(record):
+            return record.get(key)
+
+    else:
+        parent_keys, last_key = keys[:-1], keys[-1]
+
+        def getter(record):
+            for key in parent_keys:
+                record = record.get(key)
+                if not isinstance(record, dict):
+                    return None
+            return record.get(last_key)
+
+    return getter
+
+
+def _to_typed_array(values, column_type):
+    """
+    Convert extracted values to the typed array of the schema type, using the same
+    conversions as df_columns_normalization.
+
+    Args:
+        values (list): Extracted values.
+        column_type (str): Schema type of the column.
+
+    Returns:
+        array-like: Typed array (numpy, pandas extension or datetime index).
+    """
+    if column_type in ("timestamp", "date"):
+        timestamps = pd.to_datetime(values, errors="coerce")
+        if timestamps.tz is not None:
+            timestamps = timestamps.tz_localize(None)
+        return timestamps
+    if column_type in ("float", "decimal"):
+        return np.array(values, dtype="float64")
+    if column_type in ("bigint", "int", "smallint"):
+        return pd.array(values, dtype="Int64")
+    if column_type == "bit":
+        return np.array(values, dtype="bool")
+    if column_type in ("uuid", "varchar", "char", "string"):
+        return pd.array(values, dtype=pd.StringDtype())
+
+    raise Exception(f'No dataframe type equivalent to "{column_type}".')
@@ -1,43 +1,11 @@
 from helper.logger import logger
-import json
-import yaml
+from helper import metrics
 import sys
-import pandas as pd
-import numpy as np
 import hashlib
 import uuid
 
-
-def merge_jsons(json_list):
-    """
-    Merge a list of JSON objects or lists into a single flat list.
-
-    Args:
-        json_list (list): List of JSON objects or lists.
-
-    Returns:
-        list: Flattened list of JSON objects.
-    """
-    merged = []
-    for item in json_list:
-        if isinstance(item, list):
-            merged.extend(item)
-        else:
-            merged.append(item)
-    return merged
-
-
-def save_json_locally(data, filename):
-    """
-    Save a JSON-serializable object to a local file.
-
-    Args:
-        data (object): JSON-serializable object to save.
-        filename (str): Path to the output file.
-    """
-
-    with open(filename, "w") as f:
-        json.dump(data, f)
+# yaml, pandas and numpy are imported by the functions using them, so the executor and
+# the ingestor start without loading them
 
 
 def read_yaml(file_path):
@@ -50,6 +18,8 @@ def read_yaml(file_path):
     Returns:
         dict: Parsed YAML content.
     """
+    import yaml
+
     try:
         with open(file_path, "r") as f:
             yaml_content = yaml.safe_load(f)
@@ -57,12 +27,16 @@ def read_yaml(file_path):
         return yaml_content
     except Exception as e:
         logger.error(f"Error reading YAML file ({file_path}): {e}")
-        sys.exit(1)
+        raise
 
 
+@metrics.measured("helper.df_columns_normalization")
 def df_columns_normalization(dataframe, column_schema):
     """
     Normalize a DataFrame's columns according to a schema, apply type conversions, generate unique IDs, and drop duplicates.
+    Columns keep their typed arrays (datetime64, float64, nullable Int64 and string
+    dtypes) with missing values as NaN/NaT/NA; they are turned into NULLs when the rows
+    are serialized for the warehouse (see PostgresSQL.insert_dataframe).
 
     Args:
         dataframe (pd.DataFrame): Input DataFrame to normalize.
@@ -71,6 +45,8 @@ def df_columns_normalization(dataframe, column_schema):
     Returns:
         pd.DataFrame: Normalized DataFrame with unique event_generated_id and no duplicates.
     """
+    import pandas as pd
+
     source_to_pandas_type_mapping = {
         "uuid": pd.StringDtype(),
         "bigint": "Int64",
@@ -86,63 +62,36 @@ def df_columns_normalization(dataframe, column_schema):
         "string": pd.StringDtype(),
     }
 
-    formated_df = pd.DataFrame()
+    columns = {}
+    for original_column_name, column_specs in column_schema.items():
+        column_type = column_specs["type"].lower()
+        pandas_type = source_to_pandas_type_mapping.get(column_type)
+        if not pandas_type:
+            raise Exception(
+                f'No dataframe type equivalent to "{column_type}" in "{original_column_name}".'
+            )
+
+        column = dataframe[original_column_name]
+        if column_type in ("timestamp", "date"):
+            column = pd.to_datetime(column, errors="coerce")
+            if column.dt.tz is not None:
+                column = column.dt.tz_localize(None)
+        else:
+            column = column.astype(pandas_type, copy=False)
+            if isinstance(pandas_type, pd.StringDtype):
+                column = column.str.strip()
+
+        columns[column_specs["column_name"]] = column
+
+    formated_df = pd.DataFrame(columns, copy=False)
 
-    column_names_map = {
-        original_col_name: column_specs["column_name"]
-        for original_col_name, column_specs in column_schema.items()
-    }
-    column_types_map = {
-        original_col_name: column_specs["type"]
-        for original_col_name, column_specs in column_schema.items()
-    }
     unique_identifier_columns = [
         column_specs["column_name"]
-        for original_col_name, column_specs in column_schema.items()
+        for column_specs in column_schema.values()
         if column_specs.get("unique_identifier")
     ]
-
-    for original_column_name, column_type in column_types_map.items():
-        try:
-            pandas_type = source_to_pandas_type_mapping.get(column_type.lower())
-
-            if pandas_type:
-                if (column_type == "timestamp") or (column_type == "date"):
-                    formated_df[original_column_name] = pd.to_datetime(
-                        dataframe[original_column_name], errors="coerce"
-                    ).dt.tz_localize(None)
-                    # Convert NaT values to None for PostgreSQL compatibility
-                    formated_df[original_column_name] = formated_df[
-                        original_column_name
-                    ].replace({pd.NaT: None})
-
-                else:
-                    formated_df[original_column_name] = dataframe[
-                        original_column_name
-                    ].astype(pandas_type)
-                    # Convert NaN values to None for PostgreSQL compatibility
-                    formated_df[original_column_name] = formated_df[
-                        original_column_name
-                    ].replace({np.nan: None})
-
-                if isinstance(pandas_type, pd.StringDtype):
-
-                    formated_df[original_column_name] = formated_df[
-                        original_column_name
-                    ].str.strip()
-
-            else:
-                raise Exception(
-                    f'No dataframe type equivalent to "{column_type}" in "{original_column_name}".'
-                )
-
-        except Exception as err:
-            raise err
-
-    formated_df.rename(columns=column_names_map, inplace=True)
-
-    formated_df["event_generated_id"] = formated_df.apply(
-        _generate_unique_id, args=(unique_identifier_columns,), axis=1
+    formated_df["event_generated_id"] = generate_unique_ids(
+        formated_df, unique_identifier_columns
     )
 
     formated_df = formated_df.drop_duplicates(subset=["event_generated_id"])
@@ -173,13 +122,79 @@ def _generate_unique_id(row, unique_id_columns):
     return str(uuid.UUID(hash_value[:32]))
 
 
-def check_inputs_consistency(step, workflow=None):
+@metrics.measured("helper.generate_unique_ids")
+def generate_unique_ids(dataframe, unique_id_columns):
+    """
+    Generate reproducible UUIDs for every row of a DataFrame working on whole columns.
+    Produces exactly the same values as applying _generate_unique_id row by row.
+
+    Args:
+        dataframe (pd.DataFrame): DataFrame holding the unique identifier columns.
+        unique_id_columns (list): List of column names to use for ID generation.
+
+    Returns:
+        pd.Series: Generated UUID strings, aligned with the DataFrame index.
+    """
+    import pandas as pd
+    import numpy as np
+
+    combined = np.full(len(dataframe), "", dtype=object)
+    for column in unique_id_columns:
+        combined = combined + _column_to_strings(dataframe[column])
+
+    sha256 = hashlib.sha256
+    hash_values = [sha256(value.encode("utf-8")).hexdigest() for value in combined]
+
+    unique_ids = [
+        f"{value[:8]}-{value[8:12]}-{value[12:16]}-{value[16:20]}-{value[20:32]}"
+        for value in hash_values
+    ]
+
+    return pd.Series(unique_ids, index=dataframe.index, dtype=object)
+
+
+def _column_to_strings(column):
+    """
+    Convert a column to the strings str() gives for each of its values, with missing
+    values rendered as 'None' like the normalized (None filled) rows used to be.
+
+    Args:
+        column (pd.Series): Column to convert.
+
+    Returns:
+        np.ndarray: Object array of strings.
+    """
+    import numpy as np
+
+    values = column.astype(object).to_numpy()
+    strings = np.array(list(map(str, values)), dtype=object)
+    strings[column.isna().to_numpy()] = "None"
+    return strings
+
+
+def check_inputs_consistency(
+    step,
+    workflow=None,
+    catch_up=False,
+    daemon=False,
+    until=None,
+    force=False,
+    pending=False,
+    worker=False,
+):
     """
     Validate the consistency of input arguments for workflow execution.
 
     Args:
         step (str): The workflow step ('ingestor' or 'handler').
-        workflow (str, optional): Workflow ID, required for handler step.
+        workflow (tuple, optional): Workflow ID(s), required for handler step unless
+            'pending' is declared.
+        catch_up (bool, optional): Whether catch-up options were declared.
+        daemon (bool, optional): Whether daemon mode was requested.
+        until (datetime, optional): Catch-up end timestamp, if declared.
+        force (bool, optional): Whether the handler was asked to reload loaded entities.
+        pending (bool, optional): Whether the handler was asked for the pending workflows.
+        worker (bool, optional): Whether worker mode was requested.
 
     Exits:
         If arguments are inconsistent or missing.
@@ -188,6 +203,38 @@ def check_inputs_consistency(step, workflow=None):
         logger.error("workflow can only be declared when step mode is 'handler'.")
         sys.exit(1)
 
-    if step == "handler" and not workflow:
-        logger.error("A workflow_id must be declared when step mode is 'handler'.")
+    if step == "handler" and not workflow and not pending:
+        logger.error(
+            "A workflow_id (or pending) must be declared when step mode is 'handler'."
+        )
+        sys.exit(1)
+
+    if pending and (step != "handler" or workflow):
+        logger.error(
+            "pending can only be declared when step mode is 'handler', instead of workflow."
+        )
+        sys.exit(1)
+
+    if catch_up and step == "handler":
+        logger.error(
+            "Catch-up options can only be declared when step mode runs the ingestor."
+        )
+        sys.exit(1)
+
+    if daemon and (step != "all" or until is not None):
+        logger.error(
+            "Daemon mode runs both steps: it cannot be combined with a step mode or 'until'."
+        )
+        sys.exit(1)
+
+    if worker and (step != "all" or until is not None or daemon):
+        logger.error(
+            "Worker mode runs both steps: it cannot be combined with a step mode, 'until' or daemon mode."
+        )
+        sys.exit(1)
+
+    if force and (step == "ingestor" or daemon or worker):
+        logger.error(
+            "force can only be declared when step mode runs the handler, outside daemon and worker modes."
+        )
         sys.exit(1)
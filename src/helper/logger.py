@@ -31,6 +31,7 @@ class CustomLogger(Logger):
         self.addHandler(self.stream_handler)
 
         getLogger("urllib3").setLevel(INFO)
+        getLogger("asyncio").setLevel(INFO)
         getLogger("google").setLevel(INFO)
         getLogger("botocore").setLevel(ERROR)
         getLogger("pyathena").setLevel(ERROR)
@@ -0,0 +1,269 @@
+from helper.logger import logger
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from os import getenv
+import functools
+import threading
+import tracemalloc
+import json
+import time
+
+_current_recorder = ContextVar("stage_metrics_recorder", default=None)
+
+# stages whose memory is being traced, their peaks are updated before the traced peak
+# is reset by another stage
+_traced_stages = set()
+_traced_stages_lock = threading.Lock()
+
+
+class StageMetrics:
+    """
+    Per-stage wall time, CPU time, bytes, rows and peak memory of one code execution.
+    Stages are measured with stage() while the recorder is bound (see bind()); calls of
+    the same stage are added up.
+
+    Peak memory is only measured with STAGE_METRICS_TRACE_MEMORY=true, which traces the
+    Python allocations (tracemalloc, including numpy and pandas buffers) and slows
+    allocation-heavy stages down. It is the highest traced memory reached while the
+    stage ran, above what was allocated when it started. Stages running at the same time
+    share the process heap, so each one also counts what the others allocated meanwhile.
+    """
+
+    def __init__(self, code_step, workflow_id, code_execution_id):
+        """
+        Args:
+            code_step (str): 'ingestor' or 'handler'.
+            workflow_id (str): Workflow ID of the execution.
+            code_execution_id (str): Code execution ID the metrics belong to.
+        """
+        self.code_step = code_step
+        self.workflow_id = workflow_id
+        self.code_execution_id = code_execution_id
+        self.stages = {}
+        self.trace_memory = getenv("STAGE_METRICS_TRACE_MEMORY", "false") == "true"
+        self._lock = threading.Lock()
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def bind(self):
+        """
+        Record the stages run in the current context (and in the tasks submitted with
+        submit()) into this recorder.
+        """
+        token = _current_recorder.set(self)
+        try:
+            yield self
+        finally:
+            _current_recorder.reset(token)
+
+    def add(self, stage_name, wall_seconds, cpu_seconds, bytes, rows, peak_memory):
+        """
+        Add one measured call to a stage.
+
+        Args:
+            stage_name (str): Name of the stage.
+            wall_seconds (float): Elapsed wall time.
+            cpu_seconds (float): CPU time of the thread running the stage.
+            bytes (int): Bytes processed.
+            rows (int): Rows (records) processed.
+            peak_memory (int): Peak traced memory allocated during the call, in bytes
+                (None when memory is not traced).
+        """
+        with self._lock:
+            stage_metrics = self.stages.setdefault(
+                stage_name,
+                {
+                    "calls": 0,
+                    "wall_seconds": 0.0,
+                    "cpu_seconds": 0.0,
+                    "bytes": 0,
+                    "rows": 0,
+                    "peak_memory_bytes": None,
+                },
+            )
+            stage_metrics["calls"] += 1
+            stage_metrics["wall_seconds"] += wall_seconds
+            stage_metrics["cpu_seconds"] += cpu_seconds
+            stage_metrics["bytes"] += bytes
+            stage_metrics["rows"] += rows
+            if peak_memory is not None:
+                stage_metrics["peak_memory_bytes"] = max(
+                    stage_metrics["peak_memory_bytes"] or 0, peak_memory
+                )
+
+    def rows(self):
+        """
+        Returns:
+            list: One dict per stage, in the order the stages were first recorded.
+        """
+        with self._lock:
+            return [
+                {
+                    "workflow_id": self.workflow_id,
+                    "code_execution_id": self.code_execution_id,
+                    "code_step": self.code_step,
+                    "stage": stage_name,
+                    **stage_metrics,
+                }
+                for stage_name, stage_metrics in self.stages.items()
+            ]
+
+    def log(self):
+        """
+        Emit every stage as a structured (JSON) log line.
+        """
+        for row in self.rows():
+            logger.info(json.dumps({"type": "stage_metrics", **row}, default=str))
+
+
+class _MeasuredStage:
+    """
+    Bytes and rows of a running stage, increased from inside the measured block.
+    """
+
+    __slots__ = ("bytes", "rows", "start_memory", "peak_memory")
+
+    def __init__(self, bytes=0, rows=0):
+        self.bytes = bytes
+        self.rows = rows
+        self.start_memory = None
+        self.peak_memory = None
+
+    def add(self, bytes=0, rows=0):
+        self.bytes += bytes
+        self.rows += rows
+
+
+class _UnmeasuredStage:
+    """
+    Stand-in yielded by stage() when no recorder is bound.
+    """
+
+    __slots__ = ()
+
+    def add(self, bytes=0, rows=0):
+        pass
+
+
+_UNMEASURED_STAGE = _UnmeasuredStage()
+
+
+@contextmanager
+def stage(stage_name, bytes=0, rows=0):
+    """
+    Measure the enclosed block as a stage of the bound recorder. Does nothing when no
+    recorder is bound.
+
+    Args:
+        stage_name (str): Name of the stage (e.g. 's3.download').
+        bytes (int, optional): Bytes processed, if known before the block runs.
+        rows (int, optional): Rows processed, if known before the block runs.
+
+    Yields:
+        Object whose add(bytes=..., rows=...) method counts what the block processed.
+    """
+    recorder = _current_recorder.get()
+    if recorder is None:
+        yield _UNMEASURED_STAGE
+        return
+
+    measured_stage = _MeasuredStage(bytes, rows)
+    trace_memory = recorder.trace_memory and tracemalloc.is_tracing()
+    if trace_memory:
+        _start_memory_trace(measured_stage)
+    start_time = time.perf_counter()
+    start_cpu_time = time.thread_time()
+    try:
+        yield measured_stage
+    finally:
+        peak_memory = _stop_memory_trace(measured_stage) if trace_memory else None
+        recorder.add(
+            stage_name,
+            wall_seconds=time.perf_counter() - start_time,
+            cpu_seconds=time.thread_time() - start_cpu_time,
+            bytes=measured_stage.bytes,
+            rows=measured_stage.rows,
+            peak_memory=peak_memory,
+        )
+
+
+def measured(stage_name):
+    """
+    Decorator measuring every call of a function as a stage, counting the rows of the
+    (sized) object it returns.
+
+    Args:
+        stage_name (str): Name of the stage.
+
+    Returns:
+        function: Decorator.
+    """
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(stage_name) as measured_stage:
+                result = fn(*args, **kwargs)
+                measured_stage.add(rows=len(result))
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def submit(executor, fn, *args, **kwargs):
+    """
+    Submit a task to an executor in a copy of the current context, so the stages it
+    runs are recorded into the recorder bound by the caller.
+
+    Args:
+        executor (concurrent.futures.Executor): Thread pool to submit to.
+        fn (callable): Task to run.
+
+    Returns:
+        concurrent.futures.Future: Future of the task.
+    """
+    return executor.submit(copy_context().run, fn, *args, **kwargs)
+
+
+def _update_traced_peaks():
+    """
+    Fold the traced peak into every traced stage, then reset it so the next peaks only
+    cover what follows. Called with _traced_stages_lock held.
+    """
+    _, peak_memory = tracemalloc.get_traced_memory()
+    for traced_stage in _traced_stages:
+        traced_stage.peak_memory = max(traced_stage.peak_memory, peak_memory)
+    tracemalloc.reset_peak()
+
+
+def _start_memory_trace(measured_stage):
+    """
+    Start tracing the memory of a stage from the memory currently allocated.
+
+    Args:
+        measured_stage (_MeasuredStage): Stage starting.
+    """
+    with _traced_stages_lock:
+        _update_traced_peaks()
+        measured_stage.start_memory, _ = tracemalloc.get_traced_memory()
+        measured_stage.peak_memory = measured_stage.start_memory
+        _traced_stages.add(measured_stage)
+
+
+def _stop_memory_trace(measured_stage):
+    """
+    Stop tracing the memory of a stage.
+
+    Args:
+        measured_stage (_MeasuredStage): Stage ending.
+
+    Returns:
+        int: Peak memory allocated while the stage ran above its start, in bytes.
+    """
+    with _traced_stages_lock:
+        _update_traced_peaks()
+        _traced_stages.discard(measured_stage)
+    return measured_stage.peak_memory - measured_stage.start_memory
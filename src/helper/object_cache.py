@@ -0,0 +1,258 @@
+from helper.logger import logger
+from helper import metrics
+from collections import OrderedDict
+import threading
+import hashlib
+import mmap
+import os
+import io
+import re
+
+ETAG_PATTERN = re.compile(r"^[0-9A-Za-z-]+$")
+COPY_SIZE = 1024 * 1024
+
+
+class ObjectCache:
+    """
+    Local on-disk cache of S3 objects, keyed by bucket, key and ETag. Every object is
+    stored in its own file named after a hash of bucket/key and its ETag, so a rewritten
+    object (new ETag) never serves stale content. The total size is capped and the least
+    recently used objects are evicted first; the order survives restarts through the
+    file modification times. Cached objects are read through read-only memory maps.
+    """
+
+    def __init__(self, directory: str, max_bytes: int) -> None:
+        """
+        Open the cache directory, creating it if needed, and index the objects it holds.
+
+        Args:
+            directory (str): Directory holding the cached objects.
+            max_bytes (int): Maximum total size of the cached objects.
+        """
+        self.directory = directory
+        self.max_bytes = int(max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self.hit_bytes = 0
+        self.miss_bytes = 0
+        self._lock = threading.Lock()
+        # file name -> size, least recently used first
+        self._files = OrderedDict()
+        # hash of bucket/key -> (ETag, file name) of the cached version
+        self._entries = {}
+        self._total_bytes = 0
+
+        os.makedirs(directory, exist_ok=True)
+        cached_files = []
+        for entry in os.scandir(directory):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith(".tmp"):
+                # left over by an interrupted download
+                os.remove(entry.path)
+                continue
+            file_stat = entry.stat()
+            cached_files.append((file_stat.st_mtime, entry.name, file_stat.st_size))
+        for _, file_name, file_size in sorted(cached_files):
+            key_hash, _, etag = file_name.partition(".")
+            self._entries[key_hash] = (etag, file_name)
+            self._files[file_name] = file_size
+            self._total_bytes += file_size
+        self._evict()
+
+    def cached_etag(self, bucket_name: str, key: str):
+        """
+        Return the ETag of the cached version of an object.
+
+        Args:
+            bucket_name (str): Name of the S3 bucket.
+            key (str): Object key.
+
+        Returns:
+            str or None: Quoted ETag (as S3 returns it), or None if not cached.
+        """
+        with self._lock:
+            entry = self._entries.get(_key_hash(bucket_name, key))
+        return f'"{entry[0]}"' if entry else None
+
+    def open(self, bucket_name: str, key: str):
+        """
+        Open the cached version of an object as a read-only memory map and mark it as
+        the most recently used. Counted as a hit.
+
+        Args:
+            bucket_name (str): Name of the S3 bucket.
+            key (str): Object key.
+
+        Returns:
+            mmap.mmap or io.BytesIO: Binary file object (BytesIO for empty objects), or
+                None if the object is not cached anymore.
+        """
+        key_hash = _key_hash(bucket_name, key)
+        with self._lock:
+            entry = self._entries.get(key_hash)
+            if entry is None:
+                return None
+            file_name = entry[1]
+            self._files.move_to_end(file_name)
+
+        file_path = os.path.join(self.directory, file_name)
+        with metrics.stage("s3.cache_read") as stage:
+            try:
+                os.utime(file_path)
+                fileobj = _map_file(file_path)
+            except FileNotFoundError:
+                # evicted by another process sharing the directory
+                self._forget(key_hash)
+                return None
+            size = len(fileobj) if isinstance(fileobj, mmap.mmap) else 0
+            stage.add(bytes=size)
+
+        with self._lock:
+            self.hits += 1
+            self.hit_bytes += size
+        return fileobj
+
+    def store(self, bucket_name: str, key: str, etag: str, body, size: int = None):
+        """
+        Copy a downloaded object to the cache and open it as a read-only memory map.
+        Counted as a miss. Objects larger than the cache, or whose ETag cannot be used
+        in a file name, are not cached and None is returned.
+
+        Args:
+            bucket_name (str): Name of the S3 bucket.
+            key (str): Object key.
+            etag (str): ETag of the object, as returned by S3.
+            body: Binary file object of the object content (e.g. a boto3 StreamingBody).
+            size (int, optional): Size of the object, when known ahead.
+
+        Returns:
+            mmap.mmap or io.BytesIO: Binary file object of the cached copy, or None.
+        """
+        with self._lock:
+            self.misses += 1
+        etag = (etag or "").strip('"')
+        if not ETAG_PATTERN.match(etag) or (size or 0) > self.max_bytes:
+            return None
+
+        key_hash = _key_hash(bucket_name, key)
+        file_name = f"{key_hash}.{etag}"
+        file_path = os.path.join(self.directory, file_name)
+        temporary_path = f"{file_path}.{threading.get_ident()}.tmp"
+        file_size = 0
+        try:
+            with open(temporary_path, "wb") as f:
+                while True:
+                    data = body.read(COPY_SIZE)
+                    if not data:
+                        break
+                    f.write(data)
+                    file_size += len(data)
+            os.replace(temporary_path, file_path)
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+
+        with self._lock:
+            self.miss_bytes += file_size
+            previous_entry = self._entries.get(key_hash)
+            if previous_entry is not None and previous_entry[1] != file_name:
+                self._remove_file(previous_entry[1])
+            if file_name in self._files:
+                self._total_bytes -= self._files.pop(file_name)
+            self._entries[key_hash] = (etag, file_name)
+            self._files[file_name] = file_size
+            self._total_bytes += file_size
+            self._evict(keep=file_name)
+
+        return _map_file(file_path)
+
+    def log_stats(self) -> None:
+        """
+        Log the hits and misses counted since the previous call, then reset them.
+        """
+        with self._lock:
+            hits, misses = self.hits, self.misses
+            hit_bytes, miss_bytes = self.hit_bytes, self.miss_bytes
+            self.hits = self.misses = self.hit_bytes = self.miss_bytes = 0
+            total_bytes = self._total_bytes
+
+        if hits or misses:
+            logger.info(
+                f"S3 object cache: {hits} hit(s) ({hit_bytes} bytes read locally), "
+                f"{misses} miss(es) ({miss_bytes} bytes downloaded), "
+                f"{total_bytes}/{self.max_bytes} bytes cached."
+            )
+
+    def _evict(self, keep=None) -> None:
+        """
+        Remove the least recently used objects until the cache fits its size cap. Must
+        be called holding the lock.
+
+        Args:
+            keep (str, optional): File name never evicted (the object being stored).
+        """
+        for file_name in list(self._files):
+            if self._total_bytes <= self.max_bytes:
+                return
+            if file_name == keep:
+                continue
+            key_hash = file_name.partition(".")[0]
+            if self._entries.get(key_hash, (None, None))[1] == file_name:
+                del self._entries[key_hash]
+            self._remove_file(file_name)
+
+    def _remove_file(self, file_name) -> None:
+        """
+        Delete a cached file and stop counting it. Must be called holding the lock.
+
+        Args:
+            file_name (str): Name of the cached file.
+        """
+        self._total_bytes -= self._files.pop(file_name, 0)
+        try:
+            os.remove(os.path.join(self.directory, file_name))
+        except FileNotFoundError:
+            pass
+
+    def _forget(self, key_hash) -> None:
+        """
+        Drop the entry of an object whose file disappeared.
+
+        Args:
+            key_hash (str): Hash of the bucket and key of the object.
+        """
+        with self._lock:
+            entry = self._entries.pop(key_hash, None)
+            if entry is not None:
+                self._total_bytes -= self._files.pop(entry[1], 0)
+
+
+def _key_hash(bucket_name, key):
+    """
+    Args:
+        bucket_name (str): Name of the S3 bucket.
+        key (str): Object key.
+
+    Returns:
+        str: Hex SHA-256 of 'bucket/key', used in the names of the cached files.
+    """
+    return hashlib.sha256(f"{bucket_name}/{key}".encode("utf-8")).hexdigest()
+
+
+def _map_file(file_path):
+    """
+    Open a file as a read-only memory map. Empty files cannot be mapped and are
+    returned as an empty BytesIO.
+
+    Args:
+        file_path (str): Path of the file.
+
+    Returns:
+        mmap.mmap or io.BytesIO: Binary file object.
+    """
+    with open(file_path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return io.BytesIO(b"")
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
@@ -0,0 +1,324 @@
+from helper.s3 import MULTIPART_PART_SIZE
+from helper.codec import get_codec
+from helper.logger import logger
+from helper import metrics
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import asyncio
+import mmap
+
+# number of parsed objects, and of encoded parts, waiting between two stages
+QUEUE_SIZE = 4
+UPLOAD_CONCURRENCY = 4
+
+
+def upload_records_pipelined(
+    s3_source_instance,
+    source_bucket,
+    keys,
+    s3_data_instance,
+    data_bucket,
+    key,
+    codec,
+    queue_size=QUEUE_SIZE,
+    upload_concurrency=UPLOAD_CONCURRENCY,
+):
+    """
+    Download, parse, encode and upload the records of source objects as one asyncio
+    pipeline. The stages are connected by bounded queues so downloads, parsing, encoding
+    and part uploads overlap while memory stays bounded. The uploaded file holds the
+    same records in the same order (grouped by object in the order of 'keys') as
+    S3.upload_records(S3.iter_json_records(...)).
+
+    The boto3 calls and the CPU work run in threads of the event loop:
+        download -- up to 'max_workers' objects of the source client at a time
+        parse    -- one object at a time, in key order
+        encode   -- the codec, in one thread, cutting parts of MULTIPART_PART_SIZE bytes
+        upload   -- up to 'upload_concurrency' multipart parts at a time
+
+    Args:
+        s3_source_instance (S3): Client with access to the source bucket.
+        source_bucket (str): Name of the source bucket.
+        keys (list): Source object keys.
+        s3_data_instance (S3): Client with access to the destination bucket.
+        data_bucket (str): Name of the destination bucket.
+        key (str): Destination object key.
+        codec (str): Name of the codec (see helper.codec).
+        queue_size (int, optional): Capacity of the queues between stages.
+        upload_concurrency (int, optional): Number of parts uploaded at a time.
+
+    Returns:
+        int: Number of records uploaded.
+    """
+    logger.info(
+        f"Streaming result to S3 bucket: {data_bucket} as {key} ({codec}, asyncio pipeline)"
+    )
+    number_of_records, bytes_written = asyncio.run(
+        _run_pipeline(
+            s3_source_instance,
+            source_bucket,
+            keys,
+            s3_data_instance,
+            data_bucket,
+            key,
+            get_codec(codec),
+            queue_size,
+            upload_concurrency,
+        )
+    )
+    if number_of_records:
+        logger.info(
+            f"Upload to S3 completed ({number_of_records} records, {bytes_written} bytes)."
+        )
+    return number_of_records
+
+
+async def _run_pipeline(
+    s3_source_instance,
+    source_bucket,
+    keys,
+    s3_data_instance,
+    data_bucket,
+    key,
+    codec,
+    queue_size,
+    upload_concurrency,
+):
+    """
+    Run the stages of upload_records_pipelined and complete (or abort) the multipart
+    upload.
+
+    Returns:
+        tuple: (number of records uploaded, bytes uploaded)
+    """
+    loop = asyncio.get_running_loop()
+    # downloads, parsing, encoding and part uploads run in threads of their own
+    loop.set_default_executor(
+        ThreadPoolExecutor(
+            max_workers=s3_source_instance.max_workers + upload_concurrency + 2
+        )
+    )
+    s3_client = s3_data_instance.s3_client
+    # download tasks in key order, then parsed records and encoded parts
+    downloads = asyncio.Queue(maxsize=s3_source_instance.max_workers)
+    parsed = asyncio.Queue(maxsize=queue_size)
+    parts = asyncio.Queue(maxsize=queue_size)
+
+    async def download_stage():
+        for source_key in keys:
+            task = asyncio.create_task(
+                asyncio.to_thread(
+                    s3_source_instance._download_object, source_bucket, source_key
+                )
+            )
+            await downloads.put((source_key, task))
+        await downloads.put(None)
+
+    async def parse_stage():
+        while (item := await downloads.get()) is not None:
+            source_key, task = item
+            content = await task
+            try:
+                records = await asyncio.to_thread(
+                    s3_source_instance._parse_json_lines,
+                    content,
+                    source_bucket,
+                    source_key,
+                )
+            finally:
+                # cached objects are parsed from their memory map
+                if isinstance(content, mmap.mmap):
+                    content.close()
+            del content
+            await parsed.put(records)
+        await parsed.put(None)
+
+    # set when the pipeline fails, so the encode thread stops waiting on the queues
+    aborted = threading.Event()
+    waiting = {}
+
+    def wait_for(coroutine):
+        # runs a queue operation on the event loop from the encode thread
+        future = asyncio.run_coroutine_threadsafe(coroutine, loop)
+        waiting["future"] = future
+        if aborted.is_set():
+            future.cancel()
+        return future.result()
+
+    def iter_parsed_records():
+        while True:
+            records = wait_for(parsed.get())
+            if records is None:
+                return
+            yield from records
+
+    def put_part(part_number, body):
+        # blocks the encode thread while the upload queue is full
+        wait_for(parts.put((part_number, body)))
+
+    def encode_stage():
+        writer = _PartQueueWriter(put_part)
+        try:
+            number_of_records = codec.encode(iter_parsed_records(), writer)
+            if number_of_records:
+                writer.close()
+            return number_of_records, writer.bytes_written
+        finally:
+            if not aborted.is_set():
+                wait_for(parts.put(None))
+
+    def upload_part(upload_id, part_number, body):
+        with metrics.stage("s3.upload_part", bytes=len(body)):
+            response = s3_client.upload_part(
+                Bucket=data_bucket,
+                Key=key,
+                UploadId=upload_id,
+                PartNumber=part_number,
+                Body=body,
+            )
+        return response["ETag"]
+
+    async def upload_stage(upload_id):
+        etags = {}
+        semaphore = asyncio.Semaphore(upload_concurrency)
+        uploads = []
+
+        async def upload(part_number, body):
+            try:
+                etags[part_number] = await asyncio.to_thread(
+                    upload_part, upload_id, part_number, body
+                )
+            finally:
+                semaphore.release()
+
+        try:
+            while (item := await parts.get()) is not None:
+                await semaphore.acquire()
+                uploads.append(asyncio.create_task(upload(*item)))
+            await asyncio.gather(*uploads)
+        except BaseException:
+            for task in uploads:
+                task.cancel()
+            raise
+        return etags
+
+    with metrics.stage("s3.upload_records") as stage:
+        upload_id = (
+            await asyncio.to_thread(
+                s3_client.create_multipart_upload, Bucket=data_bucket, Key=key
+            )
+        )["UploadId"]
+
+        tasks = [
+            asyncio.create_task(download_stage()),
+            asyncio.create_task(parse_stage()),
+            asyncio.create_task(asyncio.to_thread(encode_stage)),
+            asyncio.create_task(upload_stage(upload_id)),
+        ]
+        try:
+            _, _, (number_of_records, bytes_written), etags = await asyncio.gather(
+                *tasks
+            )
+            if number_of_records == 0:
+                raise _NoRecords()
+        except BaseException as e:
+            aborted.set()
+            if "future" in waiting:
+                waiting["future"].cancel()
+            for task in tasks:
+                task.cancel()
+            while not downloads.empty():
+                item = downloads.get_nowait()
+                if item is not None:
+                    item[1].cancel()
+            await asyncio.to_thread(
+                s3_client.abort_multipart_upload,
+                Bucket=data_bucket,
+                Key=key,
+                UploadId=upload_id,
+            )
+            if isinstance(e, _NoRecords):
+                return 0, 0
+            raise
+
+        await asyncio.to_thread(
+            s3_client.complete_multipart_upload,
+            Bucket=data_bucket,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={
+                "Parts": [
+                    {"ETag": etags[part_number], "PartNumber": part_number}
+                    for part_number in sorted(etags)
+                ]
+            },
+        )
+        stage.add(bytes=bytes_written, rows=number_of_records)
+
+    return number_of_records, bytes_written
+
+
+class _PartQueueWriter:
+    """
+    Write-only file-like object cutting everything written to it into multipart parts of
+    MULTIPART_PART_SIZE bytes, handed to the upload stage instead of being uploaded.
+    """
+
+    def __init__(self, put_part, part_size=MULTIPART_PART_SIZE):
+        """
+        Args:
+            put_part (function): Called with the number and content of every part.
+            part_size (int, optional): Size of the parts in bytes (at least 5 MiB for S3).
+        """
+        self.put_part = put_part
+        self.part_size = part_size
+        self.bytes_written = 0
+        self.closed = False
+        self._buffer = bytearray()
+        self._number_of_parts = 0
+
+    def write(self, data):
+        """
+        Buffer data and hand a part over whenever the buffer reaches the part size.
+
+        Args:
+            data (bytes): Data to write.
+
+        Returns:
+            int: Number of bytes written.
+        """
+        self._buffer.extend(data)
+        self.bytes_written += len(data)
+        if len(self._buffer) >= self.part_size:
+            self._put_buffer()
+        return len(data)
+
+    def flush(self):
+        """
+        Parts are handed over as they fill up, nothing to flush.
+        """
+
+    def close(self):
+        """
+        Hand the remaining buffered data over as the last part.
+        """
+        if self.closed:
+            return
+        if self._buffer or not self._number_of_parts:
+            self._put_buffer()
+        self.closed = True
+
+    def _put_buffer(self):
+        """
+        Hand the buffered data over as the next part.
+        """
+        self._number_of_parts += 1
+        self.put_part(self._number_of_parts, bytes(self._buffer))
+        self._buffer.clear()
+
+
+class _NoRecords(Exception):
+    """
+    Raised inside the pipeline when the source objects hold no record, so the multipart
+    upload is aborted like S3.upload_records does.
+    """
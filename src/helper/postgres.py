@@ -1,6 +1,47 @@
+from __future__ import annotations
 import psycopg2
+from psycopg2.extras import execute_values
 from helper.logger import logger
-import pandas as pd
+from helper import metrics
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING
+import time
+import uuid
+import io
+
+if TYPE_CHECKING:
+    # only used in annotations, the ingestor never loads pandas
+    import pandas as pd
+
+LOAD_MODES = ("insert", "copy", "merge")
+# pandas period frequency and partition name suffix of every partition interval
+PARTITION_INTERVALS = {"day": ("D", "%Y%m%d"), "month": ("M", "%Y%m")}
+COPY_NULL = "\\N"
+METADATA_COLUMNS = {
+    "ingestor": (
+        "workflow_id",
+        "code_execution_id",
+        "code_execution_date",
+        "fetched_hour",
+        "number_of_files_fetched",
+        "file_destination_path",
+        "file_codec",
+        "traceback",
+    ),
+    "handler": (
+        "workflow_id",
+        "code_execution_id",
+        "code_execution_date",
+        "file_fetch_path",
+        "file_fingerprint",
+        "destination_table",
+        "records_inserted",
+        "records_updated",
+        "records_skipped",
+        "traceback",
+    ),
+}
 
 
 class PostgresSQL:
@@ -9,10 +50,17 @@ class PostgresSQL:
     """
 
     def __init__(
-        self, dbname: str, user: str, password: str, host: str, port: str
+        self,
+        dbname: str = None,
+        user: str = None,
+        password: str = None,
+        host: str = None,
+        port: str = None,
+        connection=None,
     ) -> None:
         """
-        Initialize the PostgresSQL client and connect to the database.
+        Initialize the PostgresSQL client and connect to the database, or wrap an open
+        connection (e.g. taken from a pool, see helper.resources).
 
         Args:
             dbname (str): Database name.
@@ -20,69 +68,138 @@ class PostgresSQL:
             password (str): Password.
             host (str): Host address.
             port (str): Port number.
+            connection (optional): Open psycopg2 connection to use instead of connecting.
         """
-        self.conn = psycopg2.connect(
-            dbname=dbname,
-            user=user,
-            password=password,
-            host=host,
-            port=port,
-        )
+        if connection is not None:
+            self.conn = connection
+        else:
+            self.conn = psycopg2.connect(
+                dbname=dbname,
+                user=user,
+                password=password,
+                host=host,
+                port=port,
+            )
 
         self.conn.autocommit = True
         self.cursor = self.conn.cursor()
+        self._metadata_buffer = {}
+        self._prepared_statements = set()
+        self._partitions = set()
 
     def insert_metadata(self, code_step, metadata, entity=None) -> None:
         """
         Insert execution metadata into the appropriate monitoring table (ingestor_executions or handler_executions).
+        Rows buffered with buffer_metadata are written in the same statement.
 
         Args:
             code_step (str): 'ingestor' or 'handler'.
             metadata (dict): Metadata dictionary to insert.
             entity (str, optional): Entity name for handler step.
         """
+        self.buffer_metadata(code_step, metadata, entity)
+        self.flush_metadata()
 
-        if code_step == "ingestor":
+    def buffer_metadata(self, code_step, metadata, entity=None) -> None:
+        """
+        Queue an execution metadata row, written by the next flush_metadata call.
 
-            upsert_query = f"""
-            INSERT INTO {code_step}_executions (workflow_id, code_execution_id, code_execution_date, fetched_hour, number_of_files_fetched, file_destination_path, traceback)
-            VALUES (%s, %s, %s, %s, %s, %s, %s);
-            """
+        Args:
+            code_step (str): 'ingestor' or 'handler'.
+            metadata (dict): Metadata dictionary to insert.
+            entity (str, optional): Entity name for handler step.
+        """
+        if code_step == "ingestor":
+            row = (
+                metadata["workflow_id"],
+                metadata["code_execution_id"],
+                metadata["code_execution_date"],
+                metadata.get("fetched_hour"),
+                metadata.get("number_of_files_fetched"),
+                metadata.get("file_destination_path"),
+                metadata.get("file_codec"),
+                metadata.get("traceback"),
+            )
 
-            self.cursor.execute(
-                upsert_query,
+        elif code_step == "handler":
+            row = (
+                metadata["workflow_id"],
+                metadata["code_execution_id"],
+                metadata["code_execution_date"],
+                metadata.get("file_fetch_path"),
+                metadata.get("file_fingerprint"),
+                metadata.get(entity).get("destination_table") if entity else None,
+                metadata.get(entity).get("records_inserted") if entity else None,
+                metadata.get(entity).get("records_updated") if entity else None,
+                metadata.get(entity).get("records_skipped") if entity else None,
                 (
-                    metadata["workflow_id"],
-                    metadata["code_execution_id"],
-                    metadata["code_execution_date"],
-                    metadata.get("fetched_hour"),
-                    metadata.get("number_of_files_fetched"),
-                    metadata.get("file_destination_path"),
-                    metadata.get("traceback"),
+                    metadata.get(entity).get("traceback")
+                    if entity
+                    else metadata.get("traceback")
                 ),
             )
 
-        elif code_step == "handler":
-            upsert_query = f"""
-            INSERT INTO {code_step}_executions (workflow_id, code_execution_id, code_execution_date, file_fetch_path, destination_table, records_inserted, traceback)
-            VALUES (%s, %s, %s, %s, %s, %s, %s);
+        else:
+            raise ValueError(
+                f"Invalid code step '{code_step}'. Valid options are: {', '.join(METADATA_COLUMNS)}."
+            )
+
+        self._metadata_buffer.setdefault(code_step, []).append(row)
+
+    def flush_metadata(self) -> None:
+        """
+        Write the buffered execution metadata rows, with one INSERT statement per
+        monitoring table.
+        """
+        for code_step, rows in self._metadata_buffer.items():
+            if not rows:
+                continue
+            insert_query = f"""
+            INSERT INTO {code_step}_executions ({', '.join(METADATA_COLUMNS[code_step])})
+            VALUES %s;
             """
+            execute_values(self.cursor, insert_query, rows)
+        self._metadata_buffer.clear()
 
-            self.cursor.execute(
-                upsert_query,
-                (
-                    metadata["workflow_id"],
-                    metadata["code_execution_id"],
-                    metadata["code_execution_date"],
-                    metadata.get("file_fetch_path"),
-                    metadata.get(entity).get("destination_table") if entity else None,
-                    metadata.get(entity).get("records_inserted") if entity else None,
+    def insert_stage_metrics(self, stage_metrics) -> None:
+        """
+        Insert the per-stage metrics of a code execution into the stage_metrics table.
+        Failures are logged and not raised, so instrumentation never fails an execution.
+
+        Args:
+            stage_metrics (StageMetrics): Recorder of the execution (see helper.metrics).
+        """
+        rows = stage_metrics.rows()
+        if not rows:
+            return
+
+        insert_query = """
+            INSERT INTO stage_metrics (workflow_id, code_execution_id, code_step, stage, calls, wall_seconds, cpu_seconds, bytes_processed, rows_processed, peak_memory_bytes)
+            VALUES %s;
+        """
+        try:
+            execute_values(
+                self.cursor,
+                insert_query,
+                [
                     (
-                        metadata.get(entity).get("traceback")
-                        if entity
-                        else metadata.get("traceback")
-                    ),
-                ),
+                        row["workflow_id"],
+                        row["code_execution_id"],
+                        row["code_step"],
+                        row["stage"],
+                        row["calls"],
+                        row["wall_seconds"],
+                        row["cpu_seconds"],
+                        row["bytes"],
+                        row["rows"],
+                        row["peak_memory_bytes"],
+                    )
+                    for row in rows
+                ],
+            )
+        except Exception as e:
+            logger.error(
+                f"Error inserting stage metrics of execution {stage_metrics.code_execution_id}: {e}"
             )
 
     def get_last_successfull_fetch_date(self, code_step: str):
@@ -105,28 +222,541 @@ class PostgresSQL:
         result = self.cursor.fetchone()
         return result[0] if result else None
 
-    def get_ingestor_output_file_path(self, workflow_id: str):
+    def get_ingestor_output_file(self, workflow_id: str):
         """
-        Return the file path of the ingestor output for a given workflow ID if the execution was successful.
+        Return the file path and codec of the ingestor output for a given workflow ID if the execution was successful.
 
         Args:
             workflow_id (str): Workflow ID to look up.
 
         Returns:
-            str or None: File path if found, else None.
+            tuple: (file path, codec name) if found, else (None, None). The codec is None for
+                files written before it was recorded.
         """
-        query = f"""
-            SELECT file_destination_path
+        self._prepare(
+            "get_ingestor_output_file",
+            """
+            SELECT file_destination_path, file_codec
             FROM ingestor_executions
-            WHERE workflow_id = '{workflow_id}'
+            WHERE workflow_id = $1
             AND traceback IS NULL
-            AND number_of_files_fetched > 0;
+            AND number_of_files_fetched > 0
+            """,
+            parameter_types=("uuid",),
+        )
+        self.cursor.execute("EXECUTE get_ingestor_output_file (%s);", (workflow_id,))
+        result = self.cursor.fetchone()
+        if result is None:
+            return None, None
+        return result[0], result[1]
+
+    def get_loaded_tables(self, file_fetch_path: str, file_fingerprint: str) -> set:
         """
-        self.cursor.execute(query)
+        Return the tables into which a file with the same content was already loaded
+        cleanly: their handler_executions row has no traceback and the execution did not
+        fail as a whole (e.g. while the file was being streamed).
+
+        Args:
+            file_fetch_path (str): Full S3 path of the file.
+            file_fingerprint (str): Fingerprint of its content (see
+                S3.get_file_fingerprint).
+
+        Returns:
+            set: Names of the tables already loaded from the file.
+        """
+        self._prepare(
+            "get_loaded_tables",
+            """
+            SELECT DISTINCT entity_execution.destination_table
+            FROM handler_executions AS entity_execution
+            WHERE entity_execution.file_fetch_path = $1
+            AND entity_execution.file_fingerprint = $2
+            AND entity_execution.destination_table IS NOT NULL
+            AND entity_execution.traceback IS NULL
+            AND NOT EXISTS (
+                SELECT 1
+                FROM handler_executions AS failed_execution
+                WHERE failed_execution.code_execution_id = entity_execution.code_execution_id
+                AND failed_execution.destination_table IS NULL
+                AND failed_execution.traceback IS NOT NULL
+            )
+            """,
+            parameter_types=("varchar", "varchar"),
+        )
+        self.cursor.execute(
+            "EXECUTE get_loaded_tables (%s, %s);", (file_fetch_path, file_fingerprint)
+        )
+        return {row[0] for row in self.cursor.fetchall()}
+
+    def get_pending_workflows(self, table_names: list, limit: int = None) -> list:
+        """
+        Return the workflows whose ingestor output was not loaded cleanly into every
+        given table yet (see get_loaded_tables), oldest fetched hour first.
+
+        Args:
+            table_names (list): Names of the tables loaded by the handler.
+            limit (int, optional): Maximum number of workflows returned.
+
+        Returns:
+            list: Workflow IDs still to be handled.
+        """
+        self.cursor.execute(
+            """
+            SELECT ingestor_execution.workflow_id
+            FROM ingestor_executions AS ingestor_execution
+            WHERE ingestor_execution.traceback IS NULL
+            AND ingestor_execution.number_of_files_fetched > 0
+            AND EXISTS (
+                SELECT 1
+                FROM unnest(%s::varchar[]) AS handled_table (table_name)
+                WHERE NOT EXISTS (
+                    SELECT 1
+                    FROM handler_executions AS entity_execution
+                    WHERE entity_execution.workflow_id = ingestor_execution.workflow_id
+                    AND entity_execution.destination_table = handled_table.table_name
+                    AND entity_execution.traceback IS NULL
+                    AND NOT EXISTS (
+                        SELECT 1
+                        FROM handler_executions AS failed_execution
+                        WHERE failed_execution.code_execution_id = entity_execution.code_execution_id
+                        AND failed_execution.destination_table IS NULL
+                        AND failed_execution.traceback IS NOT NULL
+                    )
+                )
+            )
+            ORDER BY ingestor_execution.fetched_hour, ingestor_execution.code_execution_date
+            LIMIT %s;
+            """,
+            (list(table_names), limit),
+        )
+        return [str(row[0]) for row in self.cursor.fetchall()]
+
+    def enqueue_hours(self, first_hour: datetime, get_hours) -> list:
+        """
+        Add the hours following the last queued one to the work queue, each with the
+        workflow ID it will be fetched and handled under. The queue is locked meanwhile,
+        so workers enqueueing at the same time never add an hour twice. The first hours
+        queued follow the last successfully fetched hour of ingestor_executions.
+
+        Args:
+            first_hour (datetime): Hour fetched first when nothing was ever fetched.
+            get_hours (function): Called with the first hour to queue, returns the
+                hours to queue from it (see ingestor.get_hours_to_fetch).
+
+        Returns:
+            list: Hours queued.
+        """
+        with self.transaction():
+            self.cursor.execute("SELECT pg_advisory_xact_lock(hashtext('work_queue'));")
+            self.cursor.execute(
+                """
+                SELECT COALESCE(
+                    (SELECT MAX(fetched_hour) FROM work_queue),
+                    (SELECT MAX(fetched_hour) FROM ingestor_executions WHERE traceback IS NULL)
+                );
+                """
+            )
+            last_hour = self.cursor.fetchone()[0]
+            if last_hour is not None:
+                # fetched_hour is stored without time zone, always in UTC
+                first_hour = last_hour.replace(tzinfo=first_hour.tzinfo) + timedelta(
+                    hours=1
+                )
+
+            fetch_hours = get_hours(first_hour)
+            if fetch_hours:
+                execute_values(
+                    self.cursor,
+                    """
+                    INSERT INTO work_queue (fetched_hour, workflow_id)
+                    VALUES %s
+                    ON CONFLICT (fetched_hour) DO NOTHING;
+                    """,
+                    [
+                        (fetch_hour.replace(tzinfo=None), str(uuid.uuid4()))
+                        for fetch_hour in fetch_hours
+                    ],
+                )
+        return fetch_hours
+
+    def claim_hour(self, lease_owner: str, lease_seconds: int):
+        """
+        Claim the oldest queued hour still to be fetched, or one whose lease expired
+        (its worker died or stalled), skipping the hours locked by other workers.
+
+        Args:
+            lease_owner (str): Name of the claiming worker.
+            lease_seconds (int): Seconds the claim lasts unless renewed.
+
+        Returns:
+            tuple: (lease token, fetched hour, workflow ID), or None when no hour is left.
+        """
+        lease_token = str(uuid.uuid4())
+        self.cursor.execute(
+            """
+            UPDATE work_queue
+            SET status = 'ingesting',
+                attempts = attempts + 1,
+                lease_token = %s,
+                lease_owner = %s,
+                lease_expires_at = now() + make_interval(secs => %s)
+            WHERE fetched_hour = (
+                SELECT fetched_hour
+                FROM work_queue
+                WHERE status IN ('ingest', 'ingesting')
+                AND (lease_expires_at IS NULL OR lease_expires_at < now())
+                ORDER BY fetched_hour
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING fetched_hour, workflow_id;
+            """,
+            (lease_token, lease_owner, lease_seconds),
+        )
         result = self.cursor.fetchone()
         if result is None:
             return None
-        return result[0]
+        return lease_token, result[0], str(result[1])
+
+    def claim_workflows(self, lease_owner: str, lease_seconds: int, limit: int):
+        """
+        Claim up to 'limit' of the oldest fetched hours waiting to be handled, or whose
+        handling lease expired, skipping the hours locked by other workers.
+
+        Args:
+            lease_owner (str): Name of the claiming worker.
+            lease_seconds (int): Seconds the claim lasts unless renewed.
+            limit (int): Maximum number of workflows claimed.
+
+        Returns:
+            tuple: (lease token, workflow IDs in hour order), the list is empty when no
+                workflow is waiting.
+        """
+        lease_token = str(uuid.uuid4())
+        self.cursor.execute(
+            """
+            UPDATE work_queue
+            SET status = 'handling',
+                attempts = attempts + 1,
+                lease_token = %s,
+                lease_owner = %s,
+                lease_expires_at = now() + make_interval(secs => %s)
+            WHERE fetched_hour IN (
+                SELECT fetched_hour
+                FROM work_queue
+                WHERE status IN ('handle', 'handling')
+                AND (lease_expires_at IS NULL OR lease_expires_at < now())
+                ORDER BY fetched_hour
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING fetched_hour, workflow_id;
+            """,
+            (lease_token, lease_owner, lease_seconds, limit),
+        )
+        return lease_token, [str(row[1]) for row in sorted(self.cursor.fetchall())]
+
+    def renew_lease(self, lease_token: str, lease_seconds: int) -> bool:
+        """
+        Extend a claim of the work queue.
+
+        Args:
+            lease_token (str): Token returned by the claim.
+            lease_seconds (int): Seconds the claim lasts from now on.
+
+        Returns:
+            bool: False when the claim was lost (its lease expired and the work was
+                claimed again).
+        """
+        self.cursor.execute(
+            """
+            UPDATE work_queue
+            SET lease_expires_at = now() + make_interval(secs => %s)
+            WHERE lease_token = %s
+            AND status IN ('ingesting', 'handling');
+            """,
+            (lease_seconds, lease_token),
+        )
+        return self.cursor.rowcount > 0
+
+    def complete_hour(self, lease_token: str, metadata: dict) -> bool:
+        """
+        Record a claimed hour as fetched, then publish the fetched hours whose previous
+        hours are all published: their ingestor_executions rows are written in hour
+        order and they wait to be handled. fetched_hour therefore only advances
+        contiguously, whatever the order the workers finish in. Nothing is recorded when
+        the claim was lost, so an hour is only recorded as fetched once.
+
+        Args:
+            lease_token (str): Token returned by claim_hour.
+            metadata (dict): Execution metadata of the hour (see ingestor.ingest_hour).
+
+        Returns:
+            bool: False when the claim was lost.
+        """
+        with self.transaction():
+            # serializes the publications, see publish_hours
+            self.cursor.execute("SELECT pg_advisory_xact_lock(hashtext('work_queue'));")
+            self.cursor.execute(
+                """
+                UPDATE work_queue
+                SET status = 'ingested',
+                    lease_token = NULL,
+                    lease_owner = NULL,
+                    lease_expires_at = NULL,
+                    code_execution_id = %s,
+                    code_execution_date = %s,
+                    number_of_files_fetched = %s,
+                    file_destination_path = %s,
+                    file_codec = %s
+                WHERE lease_token = %s
+                AND status = 'ingesting';
+                """,
+                (
+                    metadata["code_execution_id"],
+                    metadata["code_execution_date"],
+                    metadata.get("number_of_files_fetched"),
+                    metadata.get("file_destination_path"),
+                    metadata.get("file_codec"),
+                    lease_token,
+                ),
+            )
+            if self.cursor.rowcount == 0:
+                return False
+            self.publish_hours()
+        return True
+
+    def publish_hours(self) -> int:
+        """
+        Publish the fetched hours of the work queue that precede every hour still to be
+        fetched: write their ingestor_executions rows and queue them for the handler
+        (hours without files are done). Must run under the work queue lock, otherwise
+        two workers finishing consecutive hours at the same time could both wait for
+        each other's hour.
+
+        Returns:
+            int: Number of hours published.
+        """
+        self.cursor.execute(
+            """
+            WITH published AS (
+                UPDATE work_queue
+                SET status = CASE WHEN number_of_files_fetched > 0 THEN 'handle' ELSE 'done' END,
+                    attempts = 0
+                WHERE status = 'ingested'
+                AND fetched_hour < COALESCE(
+                    (SELECT MIN(fetched_hour) FROM work_queue WHERE status IN ('ingest', 'ingesting')),
+                    'infinity'
+                )
+                RETURNING *
+            )
+            INSERT INTO ingestor_executions (workflow_id, code_execution_id, code_execution_date, fetched_hour, number_of_files_fetched, file_destination_path, file_codec)
+            SELECT workflow_id, code_execution_id, code_execution_date, fetched_hour, number_of_files_fetched, file_destination_path, file_codec
+            FROM published
+            ORDER BY fetched_hour;
+            """
+        )
+        return self.cursor.rowcount
+
+    def release_work(
+        self, lease_token: str, retry_seconds: int, workflow_ids: list = None
+    ) -> None:
+        """
+        Give claimed work back to the work queue after a failure. It can be claimed
+        again once 'retry_seconds' have passed.
+
+        Args:
+            lease_token (str): Token returned by the claim.
+            retry_seconds (int): Seconds before the work can be claimed again.
+            workflow_ids (list, optional): Only release these workflows of the claim.
+        """
+        self.cursor.execute(
+            """
+            UPDATE work_queue
+            SET status = CASE WHEN status = 'ingesting' THEN 'ingest' ELSE 'handle' END,
+                lease_token = NULL,
+                lease_owner = NULL,
+                lease_expires_at = now() + make_interval(secs => %s)
+            WHERE lease_token = %s
+            AND status IN ('ingesting', 'handling')
+            AND (%s::uuid[] IS NULL OR workflow_id = ANY(%s::uuid[]));
+            """,
+            (retry_seconds, lease_token, workflow_ids, workflow_ids),
+        )
+
+    def fail_exhausted_work(self, max_attempts: int) -> list:
+        """
+        Give up on the work claimed 'max_attempts' times without success and not claimed
+        any more (released after a failure, or whose lease expired): its status becomes
+        'failed' and it is no longer claimed. A failed hour no longer holds back the
+        publication of the following hours, which are published right away. It stays
+        missing from the clean ingestor_executions rows (or from the handled hours)
+        until its status is reset.
+
+        Args:
+            max_attempts (int): Number of claims after which work is given up.
+
+        Returns:
+            list: (fetched hour, workflow ID) of the work given up, in hour order.
+        """
+        with self.transaction():
+            # serializes the publications, see publish_hours
+            self.cursor.execute("SELECT pg_advisory_xact_lock(hashtext('work_queue'));")
+            self.cursor.execute(
+                """
+                UPDATE work_queue
+                SET status = 'failed',
+                    lease_token = NULL,
+                    lease_owner = NULL,
+                    lease_expires_at = NULL
+                WHERE status IN ('ingest', 'ingesting', 'handle', 'handling')
+                AND attempts >= %s
+                AND (lease_expires_at IS NULL OR lease_expires_at < now())
+                RETURNING fetched_hour, workflow_id;
+                """,
+                (max_attempts,),
+            )
+            failed_work = sorted(self.cursor.fetchall())
+            if failed_work:
+                self.publish_hours()
+        return [
+            (fetched_hour, str(workflow_id)) for fetched_hour, workflow_id in failed_work
+        ]
+
+    def complete_workflows(self, lease_token: str, workflow_ids: list) -> None:
+        """
+        Record claimed workflows as handled.
+
+        Args:
+            lease_token (str): Token returned by claim_workflows.
+            workflow_ids (list): Workflows loaded cleanly.
+        """
+        self.cursor.execute(
+            """
+            UPDATE work_queue
+            SET status = 'done',
+                lease_token = NULL,
+                lease_owner = NULL,
+                lease_expires_at = NULL
+            WHERE lease_token = %s
+            AND status = 'handling'
+            AND workflow_id = ANY(%s::uuid[]);
+            """,
+            (lease_token, list(workflow_ids)),
+        )
+
+    def flush_leased_metadata(
+        self, lease_token: str, workflow_ids: list, loaded_workflow_ids: list
+    ) -> bool:
+        """
+        Write the buffered execution metadata rows of claimed workflows only while their
+        claim is held, in the transaction that records the workflows loaded cleanly as
+        handled. The claimed work_queue rows are locked first, so the claim cannot be
+        taken over until the rows are written. When the claim was lost (its lease
+        expired and the workflows were claimed again), the buffered rows are discarded:
+        the worker holding the new claim records them.
+
+        Args:
+            lease_token (str): Token returned by claim_workflows.
+            workflow_ids (list): Workflows of the claim whose rows are buffered.
+            loaded_workflow_ids (list): Workflows loaded cleanly.
+
+        Returns:
+            bool: False when the claim was lost and nothing was written.
+        """
+        with self.transaction():
+            self.cursor.execute(
+                """
+                SELECT workflow_id
+                FROM work_queue
+                WHERE lease_token = %s
+                AND status = 'handling'
+                FOR UPDATE;
+                """,
+                (lease_token,),
+            )
+            held_workflow_ids = {str(row[0]) for row in self.cursor.fetchall()}
+            if not held_workflow_ids.issuperset(workflow_ids):
+                self._metadata_buffer.clear()
+                return False
+            self.flush_metadata()
+            self.complete_workflows(lease_token, loaded_workflow_ids)
+        return True
+
+    def get_last_indexed_key(self, bucket_name: str):
+        """
+        Return the greatest object key already recorded in the S3 object index for a bucket.
+
+        Args:
+            bucket_name (str): Name of the indexed S3 bucket.
+
+        Returns:
+            str or None: Last indexed key, or None if the bucket was never indexed.
+        """
+        query = """
+            SELECT MAX(object_key)
+            FROM s3_object_index
+            WHERE bucket_name = %s;
+        """
+        self.cursor.execute(query, (bucket_name,))
+        result = self.cursor.fetchone()
+        return result[0] if result else None
+
+    def index_objects(self, bucket_name: str, objects: list) -> None:
+        """
+        Record S3 object summaries (key, LastModified, size and ETag) in the S3 object index.
+
+        Args:
+            bucket_name (str): Name of the indexed S3 bucket.
+            objects (list): Object summaries as returned by list_objects_v2.
+        """
+        upsert_query = """
+            INSERT INTO s3_object_index (bucket_name, object_key, last_modified, object_size, etag)
+            VALUES %s
+            ON CONFLICT (bucket_name, object_key) DO UPDATE SET
+                last_modified = EXCLUDED.last_modified,
+                object_size = EXCLUDED.object_size,
+                etag = EXCLUDED.etag;
+        """
+        execute_values(
+            self.cursor,
+            upsert_query,
+            [
+                (
+                    bucket_name,
+                    obj["Key"],
+                    obj["LastModified"],
+                    obj.get("Size"),
+                    obj.get("ETag"),
+                )
+                for obj in objects
+            ],
+        )
+
+    def get_indexed_keys(self, bucket_name: str, start, end, suffix: str = "") -> list:
+        """
+        Return the indexed object keys of a bucket last modified within [start, end).
+
+        Args:
+            bucket_name (str): Name of the indexed S3 bucket.
+            start (datetime): Inclusive lower bound of LastModified.
+            end (datetime): Exclusive upper bound of LastModified.
+            suffix (str, optional): Only return keys ending with this suffix.
+
+        Returns:
+            list: Matching object keys in key order.
+        """
+        query = """
+            SELECT object_key
+            FROM s3_object_index
+            WHERE bucket_name = %s
+            AND last_modified >= %s
+            AND last_modified < %s
+            AND object_key LIKE %s
+            ORDER BY object_key;
+        """
+        self.cursor.execute(query, (bucket_name, start, end, f"%{suffix}"))
+        return [row[0] for row in self.cursor.fetchall()]
 
     def table_exists(self, table_name: str) -> bool:
         """
@@ -154,39 +784,433 @@ class PostgresSQL:
         else:
             return True
 
-    def insert_dataframe(self, dataframe: pd.DataFrame, table_name: str) -> None:
+    def insert_dataframe(
+        self,
+        dataframe: pd.DataFrame,
+        table_name: str,
+        load_mode: str = "insert",
+        partitioning: dict = None,
+        count_by: str = None,
+    ) -> dict:
         """
         Insert a DataFrame into a PostgreSQL table, performing an upsert on event_generated_id.
 
         Args:
             dataframe (pd.DataFrame): DataFrame to insert.
             table_name (str): Name of the table to insert data into.
+            load_mode (str, optional): 'insert' for a row-by-row executemany upsert,
+                'copy' to stream the rows through a staging table with COPY, or 'merge'
+                to stream them like 'copy' but only write new rows and rows whose
+                payload changed.
+            partitioning (dict, optional): 'column' and 'interval' ('day' or 'month')
+                of a table range partitioned by that column (see schema_entities.yaml).
+                Missing partitions are created and the rows of every partition are
+                loaded straight into it, upserting on event_generated_id and the
+                partition column.
+            count_by (str, optional): Column whose values the row counts are also
+                broken down by (e.g. the source file of the rows).
+
+        Returns:
+            dict: 'inserted', 'updated' and 'skipped' row counts. Only the 'merge' mode
+                tells them apart; the other modes count every row as inserted and
+                return None for the others. With 'count_by', 'by' holds the same counts
+                keyed by the values of that column.
         """
+        if load_mode not in LOAD_MODES:
+            raise ValueError(
+                f"Invalid load mode '{load_mode}'. Valid options are: {', '.join(LOAD_MODES)}."
+            )
+
         try:
+            start_time = time.perf_counter()
 
-            columns = list(dataframe.columns)
+            with metrics.stage(
+                f"postgres.insert_dataframe.{load_mode}", rows=len(dataframe)
+            ):
+                if partitioning:
+                    row_counts = self._load_partitions(
+                        dataframe, table_name, load_mode, partitioning, count_by
+                    )
+                else:
+                    row_counts = self._load(
+                        dataframe,
+                        table_name,
+                        load_mode,
+                        ["event_generated_id"],
+                        count_by,
+                    )
 
-            placeholders = ", ".join(["%s"] * len(columns))
-            update_set = ", ".join(
-                [f"{col} = EXCLUDED.{col}" for col in columns if col != "id"]
+            elapsed_time = time.perf_counter() - start_time
+            rows_per_second = len(dataframe) / elapsed_time if elapsed_time > 0 else 0
+
+            if load_mode == "merge":
+                logger.info(
+                    f"Successfully merged {len(dataframe)} rows into table {table_name}: "
+                    f"{row_counts['inserted']} inserted, {row_counts['updated']} updated, "
+                    f"{row_counts['skipped']} unchanged "
+                    f"({elapsed_time:.2f}s, {rows_per_second:.0f} rows/s)"
+                )
+            else:
+                logger.info(
+                    f"Successfully inserted {len(dataframe)} rows into table {table_name} "
+                    f"({load_mode} mode, {elapsed_time:.2f}s, {rows_per_second:.0f} rows/s)"
+                )
+
+            return row_counts
+
+        except Exception as e:
+            logger.error(f"Error inserting DataFrame into table {table_name}: {e}")
+            raise
+
+    def _load(
+        self,
+        dataframe: pd.DataFrame,
+        table_name: str,
+        load_mode: str,
+        key_columns,
+        count_by: str = None,
+    ) -> dict:
+        """
+        Upsert a DataFrame into a table with a load mode.
+
+        Args:
+            dataframe (pd.DataFrame): DataFrame to insert.
+            table_name (str): Name of the table to insert data into.
+            load_mode (str): 'insert', 'copy' or 'merge' (see insert_dataframe).
+            key_columns (list): Columns of the primary key of the table.
+            count_by (str, optional): Column the row counts are broken down by.
+
+        Returns:
+            dict: 'inserted', 'updated' and 'skipped' row counts (and 'by', see
+                insert_dataframe).
+        """
+        if load_mode == "merge":
+            return self._copy_merge(dataframe, table_name, key_columns, count_by)
+
+        if load_mode == "copy":
+            self._copy_upsert(dataframe, table_name, key_columns)
+        else:
+            self._executemany_upsert(dataframe, table_name, key_columns)
+        row_counts = {"inserted": len(dataframe), "updated": None, "skipped": None}
+        if count_by:
+            row_counts["by"] = {
+                value: {"inserted": int(count), "updated": None, "skipped": None}
+                for value, count in dataframe[count_by].value_counts(sort=False).items()
+            }
+        return row_counts
+
+    def _load_partitions(
+        self,
+        dataframe: pd.DataFrame,
+        table_name: str,
+        load_mode: str,
+        partitioning: dict,
+        count_by: str = None,
+    ) -> dict:
+        """
+        Upsert a DataFrame into a range partitioned table. The partitions covering the
+        rows are created first, then the rows of each partition are loaded straight into
+        it, so upserts and merges only touch the primary key index of that partition.
+        All partitions are loaded in one transaction.
+
+        Args:
+            dataframe (pd.DataFrame): DataFrame to insert.
+            table_name (str): Name of the partitioned table.
+            load_mode (str): 'insert', 'copy' or 'merge' (see insert_dataframe).
+            partitioning (dict): 'column' and 'interval' of the partitioning.
+            count_by (str, optional): Column the row counts are broken down by.
+
+        Returns:
+            dict: 'inserted', 'updated' and 'skipped' row counts of all partitions (and
+                'by', see insert_dataframe).
+        """
+        import pandas as pd
+
+        column = partitioning["column"]
+        interval = partitioning["interval"]
+        if interval not in PARTITION_INTERVALS:
+            raise ValueError(
+                f"Invalid partition interval '{interval}'. Valid options are: {', '.join(PARTITION_INTERVALS)}."
+            )
+
+        timestamps = pd.to_datetime(dataframe[column])
+        if timestamps.isna().any():
+            raise ValueError(
+                f"{timestamps.isna().sum()} rows without {column} cannot be routed to a partition of table {table_name}."
+            )
+        partition_starts = timestamps.dt.to_period(
+            PARTITION_INTERVALS[interval][0]
+        ).dt.start_time
+
+        partition_names = {
+            partition_start: self.create_partition(
+                table_name, partition_start.to_pydatetime(), interval
+            )
+            for partition_start in sorted(partition_starts.unique())
+        }
+
+        row_counts = {"inserted": 0, "updated": None, "skipped": None}
+        if count_by:
+            row_counts["by"] = {}
+        with self.transaction():
+            for partition_start, partition_df in dataframe.groupby(
+                partition_starts, sort=True
+            ):
+                partition_counts = self._load(
+                    partition_df,
+                    partition_names[partition_start],
+                    load_mode,
+                    ["event_generated_id", column],
+                    count_by,
+                )
+                _add_row_counts(row_counts, partition_counts)
+        return row_counts
+
+    def create_partition(
+        self, table_name: str, partition_start: datetime, interval: str
+    ) -> str:
+        """
+        Create the partition of a range partitioned table starting at a given day or
+        month, unless it already exists. Concurrent loads creating the same partition
+        wait for each other on an advisory lock keyed on its name.
+
+        Args:
+            table_name (str): Name of the partitioned table.
+            partition_start (datetime): Start of the day or month covered.
+            interval (str): 'day' or 'month'.
+
+        Returns:
+            str: Name of the partition, e.g. vehicle_location_p20221124.
+        """
+        partition_name = (
+            f"{table_name}_p{partition_start.strftime(PARTITION_INTERVALS[interval][1])}"
+        )
+        if partition_name in self._partitions:
+            return partition_name
+
+        if interval == "day":
+            partition_end = partition_start + timedelta(days=1)
+        else:
+            partition_end = (partition_start + timedelta(days=32)).replace(day=1)
+
+        # IF NOT EXISTS does not stop two connections from creating the same partition
+        # at once, so the creations of a partition are serialized
+        with self.transaction():
+            self.cursor.execute(
+                "SELECT pg_advisory_xact_lock(hashtext(%s));", (partition_name,)
+            )
+            self.cursor.execute(
+                f"""
+                CREATE TABLE IF NOT EXISTS {partition_name}
+                PARTITION OF {table_name}
+                FOR VALUES FROM (%s) TO (%s);
+                """,
+                (partition_start, partition_end),
             )
-            upsert_query = f"""
+        self._partitions.add(partition_name)
+        return partition_name
+
+    def _executemany_upsert(
+        self, dataframe: pd.DataFrame, table_name: str, key_columns
+    ) -> None:
+        """
+        Upsert a DataFrame with one INSERT ... ON CONFLICT statement per row.
+
+        Args:
+            dataframe (pd.DataFrame): DataFrame to insert.
+            table_name (str): Name of the table to insert data into.
+            key_columns (list): Columns of the primary key of the table.
+        """
+        columns = list(dataframe.columns)
+
+        placeholders = ", ".join(["%s"] * len(columns))
+        upsert_query = f"""
+            INSERT INTO {table_name} ({', '.join(columns)})
+            VALUES ({placeholders})
+            ON CONFLICT ({', '.join(key_columns)}) DO UPDATE SET {_update_set(columns)}
+        """
+
+        data_to_insert = _dataframe_rows(dataframe)
+
+        self.cursor.executemany(upsert_query, data_to_insert)
+
+    def _copy_upsert(
+        self, dataframe: pd.DataFrame, table_name: str, key_columns
+    ) -> None:
+        """
+        Upsert a DataFrame by streaming it into a temporary staging table with COPY and
+        merging the staging table into the target with a single INSERT ... SELECT,
+        everything inside one transaction.
+
+        Args:
+            dataframe (pd.DataFrame): DataFrame to insert.
+            table_name (str): Name of the table to insert data into.
+            key_columns (list): Columns of the primary key of the table.
+        """
+        columns = list(dataframe.columns)
+
+        with self.transaction():
+            staging_table = self._copy_to_staging_table(dataframe, table_name)
+            self.cursor.execute(
+                f"""
                 INSERT INTO {table_name} ({', '.join(columns)})
-                VALUES ({placeholders})
-                ON CONFLICT (event_generated_id) DO UPDATE SET {update_set}
-            """
+                SELECT {', '.join(columns)} FROM {staging_table}
+                ON CONFLICT ({', '.join(key_columns)}) DO UPDATE SET {_update_set(columns)}
+                """
+            )
 
-            data_to_insert = [tuple(row) for row in dataframe.values]
+    def _copy_merge(
+        self, dataframe: pd.DataFrame, table_name: str, key_columns, count_by=None
+    ) -> dict:
+        """
+        Merge a DataFrame without rewriting unchanged rows, inside one transaction. The
+        rows are streamed into a temporary staging table with COPY. Staged rows identical
+        to the stored ones are then removed with a single lookup join on the primary
+        key. The rest are upserted, and a conflicting row is only updated
+        when its payload differs, so re-runs and duplicate events leave no dead tuples.
+
+        Args:
+            dataframe (pd.DataFrame): DataFrame to insert.
+            table_name (str): Name of the table to insert data into.
+            key_columns (list): Columns of the primary key of the table.
+            count_by (str, optional): Column the row counts are broken down by.
 
-            self.cursor.executemany(upsert_query, data_to_insert)
+        Returns:
+            dict: 'inserted', 'updated' and 'skipped' row counts (and 'by', see
+                insert_dataframe).
+        """
+        columns = list(dataframe.columns)
+        payload_columns = [col for col in columns if col not in key_columns]
+        key_join = " AND ".join(f"target.{col} = staged.{col}" for col in key_columns)
+        target_payload = ", ".join(f"target.{col}" for col in payload_columns)
+        staged_payload = ", ".join(f"staged.{col}" for col in payload_columns)
+        excluded_payload = ", ".join(f"EXCLUDED.{col}" for col in payload_columns)
+        count_value = f"target.{count_by}" if count_by else "NULL"
 
-            logger.info(
-                f"Successfully inserted {len(dataframe)} rows into table {table_name}"
+        with self.transaction():
+            staging_table = self._copy_to_staging_table(dataframe, table_name)
+            self.cursor.execute(
+                f"""
+                DELETE FROM {staging_table} AS staged
+                USING {table_name} AS target
+                WHERE {key_join}
+                AND ({target_payload}) IS NOT DISTINCT FROM ({staged_payload});
+                """
+            )
+            self.cursor.execute(
+                f"""
+                WITH upserted AS (
+                    INSERT INTO {table_name} AS target ({', '.join(columns)})
+                    SELECT {', '.join(columns)} FROM {staging_table}
+                    ON CONFLICT ({', '.join(key_columns)}) DO UPDATE SET {_update_set(columns)}
+                    WHERE ({target_payload}) IS DISTINCT FROM ({excluded_payload})
+                    RETURNING (xmax = 0) AS inserted, {count_value} AS count_value
+                )
+                SELECT
+                    count_value,
+                    COUNT(*) FILTER (WHERE inserted),
+                    COUNT(*) FILTER (WHERE NOT inserted)
+                FROM upserted
+                GROUP BY count_value;
+                """
             )
+            upserted_counts = {
+                value: (inserted, updated)
+                for value, inserted, updated in self.cursor.fetchall()
+            }
 
-        except Exception as e:
-            logger.error(f"Error inserting DataFrame into table {table_name}: {e}")
+        inserted = sum(counts[0] for counts in upserted_counts.values())
+        updated = sum(counts[1] for counts in upserted_counts.values())
+        row_counts = {
+            "inserted": inserted,
+            "updated": updated,
+            "skipped": len(dataframe) - inserted - updated,
+        }
+        if count_by:
+            # staged rows that are neither inserted nor updated were skipped
+            row_counts["by"] = {}
+            for value, count in dataframe[count_by].value_counts(sort=False).items():
+                inserted, updated = upserted_counts.get(value, (0, 0))
+                row_counts["by"][value] = {
+                    "inserted": inserted,
+                    "updated": updated,
+                    "skipped": int(count) - inserted - updated,
+                }
+        return row_counts
+
+    def _copy_to_staging_table(self, dataframe: pd.DataFrame, table_name: str) -> str:
+        """
+        Create a temporary staging table shaped like the target, dropped at commit, and
+        stream a DataFrame into it with COPY. Must run inside transaction().
+
+        Args:
+            dataframe (pd.DataFrame): DataFrame to stage.
+            table_name (str): Name of the target table.
+
+        Returns:
+            str: Name of the staging table.
+        """
+        columns = list(dataframe.columns)
+        staging_table = f"{table_name}_staging"
+
+        buffer = io.StringIO()
+        with metrics.stage("postgres.serialize_csv", rows=len(dataframe)) as stage:
+            dataframe.to_csv(buffer, index=False, header=False, na_rep=COPY_NULL)
+            stage.add(bytes=buffer.tell())
+        buffer.seek(0)
+
+        self.cursor.execute(
+            f"""
+            CREATE TEMPORARY TABLE {staging_table}
+            (LIKE {table_name} INCLUDING DEFAULTS)
+            ON COMMIT DROP;
+            """
+        )
+        self.cursor.copy_expert(
+            f"""
+            COPY {staging_table} ({', '.join(columns)})
+            FROM STDIN WITH (FORMAT csv, NULL '{COPY_NULL}')
+            """,
+            buffer,
+        )
+        return staging_table
+
+    def _prepare(self, name: str, statement: str, parameter_types=()) -> None:
+        """
+        Prepare a statement once per connection, so later calls only EXECUTE it.
+
+        Args:
+            name (str): Name of the prepared statement.
+            statement (str): SQL statement with $1, $2, ... parameters.
+            parameter_types (tuple, optional): Postgres types of the parameters.
+        """
+        if name in self._prepared_statements:
+            return
+        self.cursor.execute(
+            f"PREPARE {name} ({', '.join(parameter_types)}) AS {statement};"
+        )
+        self._prepared_statements.add(name)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run the statements issued inside the block in a single transaction, committing on
+        success and rolling back on error. Autocommit is restored afterwards. A block
+        opened inside another one joins the outer transaction.
+        """
+        if not self.conn.autocommit:
+            yield self.cursor
+            return
+
+        self.conn.autocommit = False
+        try:
+            yield self.cursor
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
             raise
+        finally:
+            self.conn.autocommit = True
 
     def close(self) -> None:
         """
@@ -194,3 +1218,64 @@ class PostgresSQL:
         """
         self.cursor.close()
         self.conn.close()
+
+
+def _dataframe_rows(dataframe: pd.DataFrame) -> list:
+    """
+    Convert a DataFrame to row tuples of Python values for psycopg2, with the missing
+    values of every typed column (NaN, NaT, NA) replaced by None at this point only.
+
+    Args:
+        dataframe (pd.DataFrame): DataFrame to convert.
+
+    Returns:
+        list: One tuple per row.
+    """
+    columns = []
+    for column_name in dataframe.columns:
+        column = dataframe[column_name]
+        values = column.tolist()
+        missing = column.isna().to_numpy()
+        if missing.any():
+            values = [
+                None if is_missing else value
+                for value, is_missing in zip(values, missing)
+            ]
+        columns.append(values)
+    return list(zip(*columns))
+
+
+def _add_row_counts(row_counts, other_counts) -> None:
+    """
+    Add row counts to others in place, including their 'by' breakdown. Counts that are
+    None (not told apart by the load mode) are left untouched.
+
+    Args:
+        row_counts (dict): Row counts added to.
+        other_counts (dict): Row counts to add.
+    """
+    for count_name in ("inserted", "updated", "skipped"):
+        if other_counts[count_name] is not None:
+            row_counts[count_name] = (row_counts[count_name] or 0) + other_counts[
+                count_name
+            ]
+    for value, value_counts in other_counts.get("by", {}).items():
+        _add_row_counts(
+            row_counts["by"].setdefault(
+                value, {"inserted": 0, "updated": None, "skipped": None}
+            ),
+            value_counts,
+        )
+
+
+def _update_set(columns):
+    """
+    Build the SET clause of an ON CONFLICT DO UPDATE statement for the given columns.
+
+    Args:
+        columns (list): Column names being loaded.
+
+    Returns:
+        str: Comma separated 'column = EXCLUDED.column' assignments.
+    """
+    return ", ".join([f"{col} = EXCLUDED.{col}" for col in columns if col != "id"])
@@ -0,0 +1,178 @@
+from os import getenv
+from helper.s3 import S3
+from helper.postgres import PostgresSQL
+from helper.object_cache import ObjectCache
+from helper.logger import logger
+from botocore.client import Config
+from psycopg2.pool import ThreadedConnectionPool
+import boto3
+import threading
+
+
+class Resources:
+    """
+    S3 clients and Postgres connections shared by the steps run in a process. The S3
+    clients come from a single boto3 session and share tuned settings (connection pool
+    size, TCP keep-alive and retries). Postgres connections are taken from one
+    psycopg2 pool per database. Everything is created on first use and kept open until
+    close(), so the steps of a run (or every run of executor.py --daemon) pay for them
+    once. When S3_CACHE_DIR is set, both S3 clients share a local cache of the objects
+    they download (see helper.object_cache).
+    """
+
+    def __init__(self) -> None:
+        self._session = None
+        self._object_cache = None
+        self._s3_instances = {}
+        self._pg_pools = {}
+        self._pg_instances = {}
+        self._lock = threading.Lock()
+
+    def source_s3(self) -> S3:
+        """
+        Returns:
+            S3: Anonymous client of the public source bucket.
+        """
+        return self._get_s3(
+            "source",
+            lambda session, config, cache: S3(
+                anonymous=True,
+                max_workers=getenv("S3_DOWNLOAD_CONCURRENCY", 8),
+                max_retries=getenv("S3_DOWNLOAD_RETRIES", 3),
+                session=session,
+                config=config,
+                cache=cache,
+            ),
+        )
+
+    def data_s3(self) -> S3:
+        """
+        Returns:
+            S3: Authenticated client of the data bucket (MinIO).
+        """
+        return self._get_s3(
+            "data",
+            lambda session, config, cache: S3(
+                access_key=getenv("S3_DATA_ROOT_USER"),
+                secret_access_key=getenv("S3_DATA_ROOT_PASSWORD"),
+                host=getenv("S3_DATA_HOST"),
+                session=session,
+                config=config,
+                cache=cache,
+            ),
+        )
+
+    def postgres(self, dbname: str, name: str = "default") -> PostgresSQL:
+        """
+        Return an open connection to a data warehouse database, taken from the pool of
+        the database. Several connections to the same database are kept apart by name
+        (e.g. one per entity loaded in parallel). A connection found closed is replaced.
+
+        Args:
+            dbname (str): Database name.
+            name (str, optional): Name of the connection.
+
+        Returns:
+            PostgresSQL: Connection to the database.
+        """
+        with self._lock:
+            pg_instance = self._pg_instances.get((dbname, name))
+            if pg_instance is not None and not pg_instance.conn.closed:
+                return pg_instance
+
+            pg_pool = self._pg_pools.get(dbname)
+            if pg_pool is None:
+                pg_pool = ThreadedConnectionPool(
+                    minconn=0,
+                    maxconn=int(getenv("POSTGRES_POOL_MAX_CONNECTIONS", 8)),
+                    dbname=dbname,
+                    user=getenv("DATA_WAREHOUSE_USER"),
+                    password=getenv("DATA_WAREHOUSE_PASSWORD"),
+                    host=getenv("DATA_WAREHOUSE_HOST"),
+                    port=getenv("DATA_WAREHOUSE_PORT"),
+                    # detect connections dropped while the process is idle
+                    keepalives=1,
+                    keepalives_idle=60,
+                    keepalives_interval=10,
+                    keepalives_count=5,
+                )
+                self._pg_pools[dbname] = pg_pool
+            elif pg_instance is not None:
+                pg_pool.putconn(pg_instance.conn, key=name, close=True)
+
+            pg_instance = PostgresSQL(connection=pg_pool.getconn(key=name))
+            self._pg_instances[(dbname, name)] = pg_instance
+            return pg_instance
+
+    def close(self) -> None:
+        """
+        Close every client and connection. Resources requested afterwards are created
+        again, which is how a long-running process recovers from broken connections.
+        The local object cache has nothing to close and is kept.
+        """
+        with self._lock:
+            s3_instances = list(self._s3_instances.values())
+            pg_pools = list(self._pg_pools.values())
+            self._s3_instances.clear()
+            self._pg_instances.clear()
+            self._pg_pools.clear()
+            self._session = None
+
+        for instance in s3_instances + pg_pools:
+            try:
+                if isinstance(instance, ThreadedConnectionPool):
+                    instance.closeall()
+                else:
+                    instance.close()
+            except Exception as e:
+                logger.warning(f"Error closing {type(instance).__name__}: {e}")
+
+    def _get_s3(self, name, factory) -> S3:
+        """
+        Return the S3 client cached under a name, creating it on first use from the
+        shared session.
+
+        Args:
+            name (str): Name of the client.
+            factory (function): Builds the client from a session, a client config and
+                the local object cache (None when disabled).
+
+        Returns:
+            S3: Cached client.
+        """
+        with self._lock:
+            s3_instance = self._s3_instances.get(name)
+            if s3_instance is None:
+                if self._session is None:
+                    self._session = boto3.session.Session()
+                if self._object_cache is None and getenv("S3_CACHE_DIR"):
+                    self._object_cache = ObjectCache(
+                        getenv("S3_CACHE_DIR"),
+                        max_bytes=int(getenv("S3_CACHE_MAX_BYTES", 1024**3)),
+                    )
+                s3_instance = factory(
+                    self._session, _s3_client_config(), self._object_cache
+                )
+                self._s3_instances[name] = s3_instance
+            return s3_instance
+
+
+def _s3_client_config():
+    """
+    Build the botocore settings shared by the S3 clients: TCP keep-alive, standard
+    retries of throttled or failed requests and, when S3_MAX_POOL_CONNECTIONS is set,
+    the size of the connection pool (sized after the download concurrency otherwise).
+
+    Returns:
+        botocore.client.Config: Client settings.
+    """
+    config_args = {
+        "tcp_keepalive": True,
+        "retries": {
+            "max_attempts": int(getenv("S3_MAX_ATTEMPTS", 5)),
+            "mode": "standard",
+        },
+    }
+    if getenv("S3_MAX_POOL_CONNECTIONS"):
+        config_args["max_pool_connections"] = int(getenv("S3_MAX_POOL_CONNECTIONS"))
+    return Config(**config_args)
@@ -1,15 +1,32 @@
 import boto3
 from botocore import UNSIGNED
 from botocore.client import Config
+from botocore.exceptions import ClientError
 from helper.logger import logger
+from helper.codec import get_codec, infer_codec
+from helper import metrics
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from itertools import islice
 import json
-import sys
-import os
+import time
+import mmap
+
+MULTIPART_PART_SIZE = 8 * 1024 * 1024
 
 
 class S3:
     def __init__(
-        self, access_key=None, secret_access_key=None, host=None, anonymous=False
+        self,
+        access_key=None,
+        secret_access_key=None,
+        host=None,
+        anonymous=False,
+        max_workers=8,
+        max_retries=3,
+        session=None,
+        config=None,
+        cache=None,
     ):
         """
         Initialize the S3 client for either authenticated or anonymous access.
@@ -19,120 +36,453 @@ class S3:
             secret_access_key (str, optional): AWS secret access key.
             host (str, optional): S3 endpoint host.
             anonymous (bool, optional): If True, use unsigned (anonymous) access.
+            max_workers (int, optional): Number of objects downloaded concurrently.
+            max_retries (int, optional): Download attempts per object before giving up.
+            session (boto3.session.Session, optional): Session creating the client,
+                shared by the clients of a process (see helper.resources).
+            config (botocore.client.Config, optional): Client settings (pool size,
+                keep-alive, retries, ...) merged over the defaults.
+            cache (ObjectCache, optional): Local cache of downloaded objects (see
+                helper.object_cache).
         """
+        self.cache = cache
+        self.max_workers = max(int(max_workers), 1)
+        self.max_retries = max(int(max_retries), 1)
+        # keep one pooled connection per download thread
+        pool_connections = max(self.max_workers, 10)
+        create_client = session.client if session is not None else boto3.client
+
         if anonymous:
-            self.s3_client = boto3.client(
+            client_config = Config(
+                signature_version=UNSIGNED,
+                max_pool_connections=pool_connections,
+            )
+            self.s3_client = create_client(
                 "s3",
-                config=Config(signature_version=UNSIGNED),
+                config=client_config.merge(config) if config else client_config,
                 # region_name=getenv('AWS_REGION', 'us-east-1')
             )
         else:
-            self.s3_client = boto3.client(
+            client_config = Config(max_pool_connections=pool_connections)
+            self.s3_client = create_client(
                 "s3",
                 endpoint_url=f"http://{host}",
                 aws_access_key_id=access_key,
                 aws_secret_access_key=secret_access_key,
+                config=client_config.merge(config) if config else client_config,
+            )
+
+    def list_objects(self, bucket_name, prefix="", start_after=None):
+        """
+        List every object under a prefix, following the list_objects_v2 pagination.
+
+        Args:
+            bucket_name (str): Name of the S3 bucket.
+            prefix (str, optional): Key prefix to list.
+            start_after (str, optional): Only list keys sorting after this key.
+
+        Yields:
+            dict: Object summaries as returned by list_objects_v2, in key order.
+        """
+        paginate_args = {"Bucket": bucket_name, "Prefix": prefix}
+        if start_after:
+            paginate_args["StartAfter"] = start_after
+
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        pages = iter(paginator.paginate(**paginate_args))
+        while True:
+            with metrics.stage("s3.list_objects") as stage:
+                page = next(pages, None)
+                if page is not None:
+                    stage.add(rows=len(page.get("Contents", [])))
+            if page is None:
+                return
+            yield from page.get("Contents", [])
+
+    def iter_json_records(self, bucket_name, keys):
+        """
+        Stream the records of newline-delimited JSON objects, downloading and parsing up
+        to twice 'max_workers' objects ahead of the consumer. Records are yielded grouped
+        by object in the order of 'keys', so memory use is bounded by the read-ahead
+        window and not by the number of objects.
+
+        Args:
+            bucket_name (str): Name of the S3 bucket.
+            keys (iterable): Object keys to download.
+
+        Yields:
+            dict: JSON records tagged with their original_s3_file_path.
+        """
+        keys = iter(keys)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = deque(
+                metrics.submit(executor, self._download_json_lines, bucket_name, key)
+                for key in islice(keys, self.max_workers * 2)
             )
+            while pending:
+                records = pending.popleft().result()
+                next_key = next(keys, None)
+                if next_key is not None:
+                    pending.append(
+                        metrics.submit(
+                            executor, self._download_json_lines, bucket_name, next_key
+                        )
+                    )
+                yield from records
 
-    def get_hour_files_from_bucket(self, bucket_name, timestamp):
+    def _download_json_lines(self, bucket_name, key):
         """
-        List and download JSON files from the specified S3 bucket for a given hour (UTC).
+        Download one newline-delimited JSON object, retrying failed downloads, and parse
+        its lines.
 
         Args:
             bucket_name (str): Name of the S3 bucket.
-            timestamp (datetime): The hour to filter files by (UTC).
+            key (str): Object key.
 
         Returns:
-            tuple: (list of JSON records, number of files fetched)
-        """
-        logger.info(f"Connecting to S3 bucket: {bucket_name}")
-        response = self.s3_client.list_objects_v2(Bucket=bucket_name, Prefix="data/")
-        files_fetched = 0
-        grouped_json = []
-        for obj in response.get("Contents", []):
-            key = obj["Key"]
-            last_modified = obj["LastModified"]
-            if last_modified.hour == timestamp.hour and key.endswith(".json"):
-                # logger.info(f"Downloading file: {key}")
-                files_fetched += 1
-                file_obj = self.s3_client.get_object(Bucket=bucket_name, Key=key)
-                file_content = file_obj["Body"].read().decode("utf-8")
-                for line in file_content.splitlines():
-                    if line.strip():  # skip empty lines
+            list: JSON records of the object tagged with their original_s3_file_path.
+        """
+        file_content = self._download_object(bucket_name, key)
+        try:
+            return self._parse_json_lines(file_content, bucket_name, key)
+        finally:
+            if isinstance(file_content, mmap.mmap):
+                file_content.close()
+
+    def _download_object(self, bucket_name, key):
+        """
+        Download the content of an object, retrying failed downloads with exponential
+        backoff. Objects served by the local cache are not read into memory: their
+        memory map is returned as it is.
+
+        Args:
+            bucket_name (str): Name of the S3 bucket.
+            key (str): Object key.
+
+        Returns:
+            bytes or mmap.mmap: Content of the object.
+        """
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                with metrics.stage("s3.download") as stage:
+                    fileobj = self._open_object(bucket_name, key)
+                    if isinstance(fileobj, mmap.mmap):
+                        file_content = fileobj
+                    else:
                         try:
-                            record_dict = json.loads(line)
-                            record_dict["original_s3_file_path"] = (
-                                f"{bucket_name}/{key}"
-                            )
-                            grouped_json.append(record_dict)
-                        except Exception as e:
-                            logger.warning(
-                                f"Failed to load a line from {key} as JSON: {e}"
-                            )
-                logger.info(f"Loaded JSON records from {key}")
-        return grouped_json, files_fetched
-
-    def upload_file_to_bucket(self, local_file, bucket):
-        """
-        Upload a local file to the specified S3 bucket and delete the local file after successful upload.
+                            file_content = fileobj.read()
+                        finally:
+                            fileobj.close()
+                    stage.add(bytes=len(file_content))
+                return file_content
+            except Exception as e:
+                if attempt == self.max_retries:
+                    logger.error(
+                        f"Failed to download {key} after {attempt} attempts: {e}"
+                    )
+                    raise
+                logger.warning(
+                    f"Download of {key} failed (attempt {attempt}/{self.max_retries}): {e}"
+                )
+                time.sleep(2 ** (attempt - 1))
+
+    def _open_object(self, bucket_name, key):
+        """
+        Open an object for reading. With a local cache, a cached object is only served
+        after a conditional GET (If-None-Match on its ETag) confirms it is still current,
+        and downloaded objects are copied to the cache first.
 
         Args:
-            local_file (str): Path to the local file to upload.
-            bucket (str): Name of the S3 bucket.
+            bucket_name (str): Name of the S3 bucket.
+            key (str): Object key.
+
+        Returns:
+            Binary file object: memory map of the cached copy, or the streaming body of
+                the response for uncached objects.
         """
-        logger.info(f"Uploading result to S3 bucket: {bucket} as {local_file}")
+        if self.cache is None:
+            return self.s3_client.get_object(Bucket=bucket_name, Key=key)["Body"]
 
+        get_object_args = {"Bucket": bucket_name, "Key": key}
+        cached_etag = self.cache.cached_etag(bucket_name, key)
+        if cached_etag is not None:
+            get_object_args["IfNoneMatch"] = cached_etag
         try:
-            self.s3_client.upload_file(local_file, bucket, local_file)
-            logger.info(f"Upload to S3 completed.")
+            response = self.s3_client.get_object(**get_object_args)
+        except ClientError as e:
+            if e.response.get("ResponseMetadata", {}).get("HTTPStatusCode") != 304:
+                raise
+            fileobj = self.cache.open(bucket_name, key)
+            if fileobj is not None:
+                return fileobj
+            response = self.s3_client.get_object(Bucket=bucket_name, Key=key)
 
-            if os.path.exists(local_file):
-                os.remove(local_file)
+        fileobj = self.cache.store(
+            bucket_name,
+            key,
+            response.get("ETag"),
+            response["Body"],
+            size=response.get("ContentLength"),
+        )
+        return fileobj if fileobj is not None else response["Body"]
 
-        except Exception as e:
-            logger.error(
-                f"Failed to upload {local_file} to S3 bucket {bucket} as {local_file}: {e}"
-            )
+    @staticmethod
+    def _parse_json_lines(file_content, bucket_name, key):
+        """
+        Parse the lines of a newline-delimited JSON object, skipping invalid lines. The
+        lines are sliced out of the content one at a time, so a memory-mapped object is
+        never copied as a whole.
+
+        Args:
+            file_content (bytes or mmap.mmap): Content of the object.
+            bucket_name (str): Name of the S3 bucket.
+            key (str): Object key.
+
+        Returns:
+            list: JSON records of the object tagged with their original_s3_file_path.
+        """
+        records = []
+        with metrics.stage("s3.parse_json_lines", bytes=len(file_content)) as stage:
+            for line in _buffer_lines(file_content):
+                if line.strip():  # skip empty lines
+                    try:
+                        record_dict = json.loads(line)
+                        record_dict["original_s3_file_path"] = f"{bucket_name}/{key}"
+                        records.append(record_dict)
+                    except Exception as e:
+                        logger.warning(f"Failed to load a line from {key} as JSON: {e}")
+            stage.add(rows=len(records))
+        logger.info(f"Loaded JSON records from {key}")
+        return records
+
+    def upload_records(self, records, bucket, key, codec):
+        """
+        Stream records to S3 encoded with an intermediate file codec through a multipart
+        upload, holding at most one part in memory. The upload is aborted if there are no
+        records.
+
+        Args:
+            records (iterable): JSON-serializable records to upload.
+            bucket (str): Name of the S3 bucket.
+            key (str): Destination object key.
+            codec (str): Name of the codec (see helper.codec).
+
+        Returns:
+            int: Number of records uploaded.
+        """
+        logger.info(f"Streaming result to S3 bucket: {bucket} as {key} ({codec})")
+
+        with metrics.stage("s3.upload_records") as stage:
+            with MultipartUploadWriter(self.s3_client, bucket, key) as upload:
+                number_of_records = get_codec(codec).encode(records, upload)
+
+                if number_of_records == 0:
+                    upload.abort()
+                    return 0
+            stage.add(bytes=upload.bytes_written, rows=number_of_records)
+
+        logger.info(
+            f"Upload to S3 completed ({number_of_records} records, {upload.bytes_written} bytes)."
+        )
+        return number_of_records
 
     def bucket_exists(self, bucket_name):
         """
-        Check if a bucket exists in S3. Exits the program if the bucket does not exist.
+        Check if a bucket exists in S3.
 
         Args:
             bucket_name (str): Name of the S3 bucket.
+
+        Raises:
+            Exception: If the bucket does not exist or the buckets cannot be listed.
         """
         try:
             response = self.s3_client.list_buckets()
-            for bucket in response.get("Buckets", []):
-                if bucket["Name"] == bucket_name:
-                    return
-            logger.error(f"S3 bucket {bucket_name} does not exist.")
-            sys.exit(1)
         except Exception as e:
             logger.error(f"Error checking if bucket {bucket_name} exists: {e}")
-            sys.exit(1)
+            raise
+
+        for bucket in response.get("Buckets", []):
+            if bucket["Name"] == bucket_name:
+                return
+        raise Exception(f"S3 bucket {bucket_name} does not exist.")
 
-    def fetch_file_from_bucket(self, s3_path):
+    def get_file_fingerprint(self, s3_path):
         """
-        Fetch the content of a file from S3 given a full S3 path (e.g., 's3://bucket/key').
+        Return a fingerprint of the content of a file in S3 given a full S3 path (e.g.,
+        's3://bucket/key'), read from its metadata without downloading it: its ETag, its
+        size and, when S3 stores one, its SHA-256 checksum.
 
         Args:
             s3_path (str): Full S3 path to the file.
 
         Returns:
-            dict or list: Parsed JSON content of the file.
+            str: Fingerprint of the file ('<etag>:<size>[:<sha256>]').
         """
+        bucket, path = s3_path.replace("s3://", "").split("/", 1)
+        response = self.s3_client.head_object(
+            Bucket=bucket, Key=path, ChecksumMode="ENABLED"
+        )
+        fingerprint = [response["ETag"].strip('"'), str(response["ContentLength"])]
+        if response.get("ChecksumSHA256"):
+            fingerprint.append(response["ChecksumSHA256"])
+        return ":".join(fingerprint)
 
+    def iter_file_records(self, s3_path, chunk_size, codec=None):
+        """
+        Stream the records of a file from S3 given a full S3 path (e.g., 's3://bucket/key')
+        in chunks of at most 'chunk_size' records. Files are decoded while they are
+        downloaded, except for the 'json' codec which is parsed at once.
+
+        Args:
+            s3_path (str): Full S3 path to the file.
+            chunk_size (int): Maximum number of records per chunk.
+            codec (str, optional): Name of the codec the file was written with. Inferred
+                from the file extension when not provided.
+
+        Yields:
+            list: Chunk of JSON records.
+        """
         bucket, path = s3_path.replace("s3://", "").split("/", 1)
-        response = self.s3_client.get_object(Bucket=bucket, Key=path)
-        content = response["Body"].read().decode("utf-8")
-        logger.info(f"Fetched file from S3: {s3_path}")
+        file_codec = get_codec(codec) if codec else infer_codec(path)
+        fileobj = self._open_object(bucket, path)
+        logger.info(f"Streaming file from S3: {s3_path} ({file_codec.name})")
 
-        json_content = json.loads(content)
-        return json_content
+        try:
+            records = file_codec.decode(fileobj)
+            while True:
+                with metrics.stage("s3.fetch_chunk") as stage:
+                    chunk = list(islice(records, chunk_size))
+                    stage.add(rows=len(chunk))
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            fileobj.close()
 
     def close(self):
         """
         Close the S3 client connection.
         """
         self.s3_client.close()
+
+
+class MultipartUploadWriter:
+    """
+    Write-only file-like object uploading everything written to it as an S3 multipart
+    upload, one part every MULTIPART_PART_SIZE bytes.
+    """
+
+    def __init__(self, s3_client, bucket, key, part_size=MULTIPART_PART_SIZE):
+        """
+        Start the multipart upload.
+
+        Args:
+            s3_client: boto3 S3 client.
+            bucket (str): Name of the S3 bucket.
+            key (str): Destination object key.
+            part_size (int, optional): Size of the parts in bytes (at least 5 MiB for S3).
+        """
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.bytes_written = 0
+        self.closed = False
+        self._buffer = bytearray()
+        self._parts = []
+        self._upload_id = self.s3_client.create_multipart_upload(
+            Bucket=bucket, Key=key
+        )["UploadId"]
+
+    def write(self, data):
+        """
+        Buffer data and upload a part whenever the buffer reaches the part size.
+
+        Args:
+            data (bytes): Data to write.
+
+        Returns:
+            int: Number of bytes written.
+        """
+        self._buffer.extend(data)
+        self.bytes_written += len(data)
+        if len(self._buffer) >= self.part_size:
+            self._upload_part()
+        return len(data)
+
+    def flush(self):
+        """
+        Parts are uploaded as they fill up, nothing to flush.
+        """
+
+    def close(self):
+        """
+        Upload the remaining buffered data and complete the multipart upload.
+        """
+        if self.closed:
+            return
+        if self._buffer or not self._parts:
+            self._upload_part()
+        self.s3_client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self._upload_id,
+            MultipartUpload={"Parts": self._parts},
+        )
+        self.closed = True
+
+    def abort(self):
+        """
+        Abort the multipart upload, discarding the parts already uploaded.
+        """
+        if self.closed:
+            return
+        self.s3_client.abort_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self._upload_id
+        )
+        self.closed = True
+
+    def _upload_part(self):
+        """
+        Upload the buffered data as the next part.
+        """
+        part_number = len(self._parts) + 1
+        with metrics.stage("s3.upload_part", bytes=len(self._buffer)):
+            response = self.s3_client.upload_part(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self._upload_id,
+                PartNumber=part_number,
+                Body=bytes(self._buffer),
+            )
+        self._parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+        self._buffer.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def _buffer_lines(buffer):
+    """
+    Split a bytes-like buffer (bytes or a memory map) into lines.
+
+    Args:
+        buffer (bytes or mmap.mmap): Buffer to split.
+
+    Yields:
+        bytes: Lines without the trailing newline.
+    """
+    start = 0
+    while start < len(buffer):
+        end = buffer.find(b"\n", start)
+        if end == -1:
+            end = len(buffer)
+        yield buffer[start:end]
+        start = end + 1
@@ -0,0 +1,89 @@
+from helper.helper import df_columns_normalization
+from helper import metrics
+import pickle
+
+# the pool workers only import this module, pandas is loaded on first use
+
+
+def normalize_sharded(dataframe, column_schema, executor, shard_size):
+    """
+    Normalize an extracted DataFrame in shards of 'shard_size' rows on a process pool,
+    then merge the shards and drop the event_generated_id duplicates across all of
+    them. The result is the same as df_columns_normalization on the whole DataFrame.
+
+    Shards are sent to the workers as columnar pickles of the extracted (typed) columns
+    and come back the same way, never as lists of record dicts.
+
+    Args:
+        dataframe (pd.DataFrame): DataFrame extracted by an EntityExtractor.
+        column_schema (dict): Schema definition for columns.
+        executor (ProcessPoolExecutor): Pool normalizing the shards.
+        shard_size (int): Maximum number of rows per shard.
+
+    Returns:
+        pd.DataFrame: Normalized DataFrame with unique event_generated_id and no duplicates.
+    """
+    import pandas as pd
+
+    if len(dataframe) <= shard_size:
+        return df_columns_normalization(dataframe, column_schema)
+
+    with metrics.stage("helper.normalize_sharded", rows=len(dataframe)) as stage:
+        futures = []
+        for shard_start in range(0, len(dataframe), shard_size):
+            payload = pack_dataframe(
+                dataframe.iloc[shard_start : shard_start + shard_size]
+            )
+            stage.add(bytes=len(payload))
+            futures.append(executor.submit(_normalize_shard, payload, column_schema))
+
+        # shards are merged in order, so the first occurrence of a duplicate is kept
+        # like in a single-process run
+        normalized_df = pd.concat(
+            [unpack_dataframe(future.result()) for future in futures],
+            ignore_index=True,
+        )
+        return normalized_df.drop_duplicates(subset=["event_generated_id"])
+
+
+def pack_dataframe(dataframe):
+    """
+    Serialize a DataFrame with pickle, which stores its typed column blocks (numpy
+    buffers and nullable masks) instead of one object per cell.
+
+    Args:
+        dataframe (pd.DataFrame): DataFrame to serialize.
+
+    Returns:
+        bytes: Serialized DataFrame.
+    """
+    return pickle.dumps(
+        dataframe.reset_index(drop=True), protocol=pickle.HIGHEST_PROTOCOL
+    )
+
+
+def unpack_dataframe(payload):
+    """
+    Args:
+        payload (bytes): DataFrame serialized by pack_dataframe.
+
+    Returns:
+        pd.DataFrame: Deserialized DataFrame.
+    """
+    return pickle.loads(payload)
+
+
+def _normalize_shard(payload, column_schema):
+    """
+    Normalize one shard in a pool worker.
+
+    Args:
+        payload (bytes): Shard serialized by pack_dataframe.
+        column_schema (dict): Schema definition for columns.
+
+    Returns:
+        bytes: Normalized shard serialized by pack_dataframe.
+    """
+    return pack_dataframe(
+        df_columns_normalization(unpack_dataframe(payload), column_schema)
+    )
@@ -2,85 +2,453 @@ from os import getenv
 import uuid
 from datetime import datetime, timezone, timedelta
 from helper.logger import logger
-from helper.s3 import S3
-from helper.postgres import PostgresSQL
-from helper.helper import save_json_locally, merge_jsons
+from helper.resources import Resources
+from helper.codec import get_codec
+from helper.pipeline import upload_records_pipelined
+from helper.metrics import StageMetrics
+from concurrent.futures import ThreadPoolExecutor
 import traceback
 
+FIRST_FETCH_DATE = datetime(2022, 11, 24, 10, 0, 0, tzinfo=timezone.utc)
+ENGINES = ("threads", "asyncio")
+DEFAULT_OUTPUT_CODEC = "ndjson.gz"
 
-def main(workflow_id):
+
+def main(workflow_id, max_hours=1, end_timestamp=None, workers=1, resources=None):
+    """
+    Fetch the hours following the last successfully fetched one and upload each of them
+    to the data bucket. By default a single hour is fetched; in catch-up mode (max_hours
+    greater than 1 or end_timestamp set) up to max_hours complete hours before
+    end_timestamp are fetched, 'workers' hours at a time, with one workflow and one
+    ingestor_executions row per hour.
+
+    Args:
+        workflow_id (str): Workflow ID of the first fetched hour.
+        max_hours (int, optional): Maximum number of hours to fetch. None fetches every
+            complete hour before end_timestamp, or a single hour without it.
+        end_timestamp (datetime, optional): Only fetch hours starting before it (UTC).
+        workers (int, optional): Number of hours fetched in parallel.
+        resources (Resources, optional): Shared clients and connections. When not
+            provided, they are created for this run and closed at its end.
+
+    Returns:
+        list: Workflow IDs of the hours fetched successfully, in hour order.
+    """
     logger.info("Starting ingestor step.")
-    execution_metadata = {}
-    execution_id = str(uuid.uuid4())
-    current_datetime = datetime.now(timezone.utc)
+    output_codec = get_codec(getenv("INGESTOR_OUTPUT_CODEC", DEFAULT_OUTPUT_CODEC))
 
-    s3_anon_instance = S3(anonymous=True)
+    owns_resources = resources is None
+    if owns_resources:
+        resources = Resources()
+
+    s3_anon_instance = resources.source_s3()
     s3_bucket = getenv("S3_BUCKET")
 
-    s3_data_instance = S3(
-        access_key=getenv("S3_DATA_ROOT_USER"),
-        secret_access_key=getenv("S3_DATA_ROOT_PASSWORD"),
-        host=getenv("S3_DATA_HOST"),
-    )
+    s3_data_instance = resources.data_s3()
     s3_data_bucket = getenv("S3_DATA_BUCKET")
     s3_data_instance.bucket_exists(s3_data_bucket)
 
-    s3_instance = PostgresSQL(
-        dbname=getenv("DATA_WAREHOUSE_MONITOR_DB"),
-        user=getenv("DATA_WAREHOUSE_USER"),
-        password=getenv("DATA_WAREHOUSE_PASSWORD"),
-        host=getenv("DATA_WAREHOUSE_HOST"),
-        port=getenv("DATA_WAREHOUSE_PORT"),
-    )
+    s3_instance = resources.postgres(getenv("DATA_WAREHOUSE_MONITOR_DB"))
+
+    successful_workflow_ids = []
+    failed_hour = None
+    first_error = None
 
     try:
-        output_filename = (
-            f"{execution_id}_{current_datetime.strftime('%Y%m%dT%H%M%SZ')}.json"
+        try:
+            last_fetch_date = s3_instance.get_last_successfull_fetch_date(
+                code_step="ingestor"
+            )
+            if last_fetch_date is not None:
+                # fetched_hour is stored without time zone, always in UTC
+                code_fetch_date = last_fetch_date.replace(
+                    tzinfo=timezone.utc
+                ) + timedelta(hours=1)
+            else:
+                code_fetch_date = FIRST_FETCH_DATE
+
+            if max_hours is None and end_timestamp is None:
+                max_hours = 1
+            if max_hours == 1 and end_timestamp is None:
+                fetch_hours = [code_fetch_date]
+            else:
+                fetch_hours = get_hours_to_fetch(
+                    code_fetch_date, max_hours, end_timestamp
+                )
+                logger.info(
+                    f"Catch-up mode: fetching {len(fetch_hours)} hour(s) from {code_fetch_date} with {workers} worker(s)."
+                )
+
+            if not fetch_hours:
+                logger.info("No complete hour left to fetch.")
+                return []
+
+            refresh_object_index(s3_anon_instance, s3_instance, s3_bucket)
+            hour_keys = [
+                s3_instance.get_indexed_keys(
+                    s3_bucket,
+                    start=fetch_hour,
+                    end=fetch_hour + timedelta(hours=1),
+                    suffix=".json",
+                )
+                for fetch_hour in fetch_hours
+            ]
+
+        except Exception as e:
+            s3_instance.insert_metadata(
+                code_step="ingestor",
+                metadata={
+                    "workflow_id": workflow_id,
+                    "code_execution_id": str(uuid.uuid4()),
+                    "code_execution_date": datetime.now(timezone.utc),
+                    "traceback": traceback.format_exc(),
+                },
+            )
+            raise e
+
+        workflow_ids = [workflow_id] + [str(uuid.uuid4()) for _ in fetch_hours[1:]]
+
+        with ThreadPoolExecutor(max_workers=max(int(workers), 1)) as executor:
+            futures = [
+                executor.submit(
+                    ingest_hour,
+                    hour_workflow_id,
+                    fetch_hour,
+                    keys,
+                    s3_anon_instance,
+                    s3_bucket,
+                    s3_data_instance,
+                    s3_data_bucket,
+                    output_codec,
+                )
+                for hour_workflow_id, fetch_hour, keys in zip(
+                    workflow_ids, fetch_hours, hour_keys
+                )
+            ]
+
+            # metadata is written in hour order and, once an hour fails, the following
+            # ones are recorded as failed too, so fetched_hour only advances contiguously
+            for hour_index, (future, hour_workflow_id, fetch_hour) in enumerate(
+                zip(futures, workflow_ids, fetch_hours)
+            ):
+                if failed_hour is not None and future.cancel():
+                    execution_metadata = _skipped_hour_metadata(
+                        hour_workflow_id, fetch_hour, failed_hour
+                    )
+                else:
+                    execution_metadata, error = future.result()
+                    if failed_hour is None and error is not None:
+                        failed_hour = fetch_hour
+                        first_error = error
+                    elif failed_hour is not None and error is None:
+                        execution_metadata["traceback"] = (
+                            f"Hour fetched but discarded: previous hour {failed_hour} failed."
+                        )
+
+                s3_instance.buffer_metadata(
+                    code_step="ingestor", metadata=execution_metadata
+                )
+                stage_metrics = execution_metadata.get("stage_metrics")
+                if stage_metrics is not None:
+                    s3_instance.insert_stage_metrics(stage_metrics)
+                    if getenv("STAGE_METRICS_LOG", "false").lower() == "true":
+                        stage_metrics.log()
+                if execution_metadata.get("traceback") is None:
+                    successful_workflow_ids.append(hour_workflow_id)
+                    # the hours fetched so far are written whenever the next one is
+                    # still running, so a crash does not lose the hours already fetched
+                    if (
+                        hour_index + 1 == len(futures)
+                        or not futures[hour_index + 1].done()
+                    ):
+                        s3_instance.flush_metadata()
+
+    finally:
+        if s3_anon_instance.cache is not None:
+            s3_anon_instance.cache.log_stats()
+        logger.info("ingestor step finished.\n")
+        try:
+            # the rows left buffered (the failed hours) are written in a single statement
+            s3_instance.flush_metadata()
+        finally:
+            if owns_resources:
+                resources.close()
+
+    if first_error is not None:
+        if failed_hour == fetch_hours[0]:
+            raise first_error
+        logger.error(
+            f"Hour {failed_hour} failed, it and the following hours will be fetched again on the next run."
         )
-        logger.info(
-            f"Execution started. UUID: {execution_id}, Timestamp: {current_datetime.isoformat()}"
+
+    return successful_workflow_ids
+
+
+def ingest_queued_hour(workflow_id, fetch_hour, resources):
+    """
+    Fetch one hour claimed from the work queue (see scheduler.worker) and upload its
+    records to the data bucket. The ingestor_executions row of a failed hour is written
+    right away, the row of a fetched hour once it is published in hour order (see
+    PostgresSQL.complete_hour).
+
+    Args:
+        workflow_id (str): Workflow ID of the hour.
+        fetch_hour (datetime): Hour being fetched (UTC).
+        resources (Resources): Shared clients and connections.
+
+    Returns:
+        tuple: (execution metadata of the hour, exception raised or None)
+    """
+    output_codec = get_codec(getenv("INGESTOR_OUTPUT_CODEC", DEFAULT_OUTPUT_CODEC))
+    s3_anon_instance = resources.source_s3()
+    s3_bucket = getenv("S3_BUCKET")
+    s3_data_instance = resources.data_s3()
+    s3_data_bucket = getenv("S3_DATA_BUCKET")
+    metadata_instance = resources.postgres(getenv("DATA_WAREHOUSE_MONITOR_DB"))
+
+    try:
+        refresh_object_index(s3_anon_instance, metadata_instance, s3_bucket)
+        keys = metadata_instance.get_indexed_keys(
+            s3_bucket,
+            start=fetch_hour,
+            end=fetch_hour + timedelta(hours=1),
+            suffix=".json",
+        )
+    except Exception as e:
+        execution_metadata = {
+            "workflow_id": workflow_id,
+            "code_execution_id": str(uuid.uuid4()),
+            "code_execution_date": datetime.now(timezone.utc),
+            "fetched_hour": fetch_hour,
+            "traceback": traceback.format_exc(),
+        }
+        metadata_instance.insert_metadata(
+            code_step="ingestor", metadata=execution_metadata
         )
+        return execution_metadata, e
 
-        last_fetch_date = s3_instance.get_last_successfull_fetch_date(
-            code_step="ingestor"
+    execution_metadata, error = ingest_hour(
+        workflow_id,
+        fetch_hour,
+        keys,
+        s3_anon_instance,
+        s3_bucket,
+        s3_data_instance,
+        s3_data_bucket,
+        output_codec,
+    )
+    stage_metrics = execution_metadata.pop("stage_metrics")
+    metadata_instance.insert_stage_metrics(stage_metrics)
+    if getenv("STAGE_METRICS_LOG", "false").lower() == "true":
+        stage_metrics.log()
+    if error is not None:
+        metadata_instance.insert_metadata(
+            code_step="ingestor", metadata=execution_metadata
         )
-        if last_fetch_date is not None:
-            code_fetch_date = last_fetch_date + timedelta(hours=1)
-        else:
-            code_fetch_date = datetime(2022, 11, 24, 10, 0, 0, tzinfo=timezone.utc)
+    return execution_metadata, error
+
+
+def ingest_hour(
+    workflow_id,
+    fetch_hour,
+    keys,
+    s3_source_instance,
+    s3_source_bucket,
+    s3_data_instance,
+    s3_data_bucket,
+    output_codec,
+):
+    """
+    Fetch the files of one hour and upload their records to the data bucket.
 
-        logger.info(f"Fetching data from hour: {code_fetch_date}.")
+    Args:
+        workflow_id (str): Workflow ID of the hour.
+        fetch_hour (datetime): Hour being fetched (UTC).
+        keys (list): Source object keys of the hour.
+        s3_source_instance (S3): Client with access to the source bucket.
+        s3_source_bucket (str): Name of the source bucket.
+        s3_data_instance (S3): Client with access to the data bucket.
+        s3_data_bucket (str): Name of the data bucket.
+        output_codec: Codec of the uploaded file (see helper.codec).
 
-        jsons, number_of_files_fetched = s3_anon_instance.get_hour_files_from_bucket(
-            s3_bucket, code_fetch_date
+    Returns:
+        tuple: (execution metadata of the hour, with its StageMetrics under
+            'stage_metrics', exception raised or None)
+    """
+    execution_id = str(uuid.uuid4())
+    current_datetime = datetime.now(timezone.utc)
+    output_filename = f"{execution_id}_{current_datetime.strftime('%Y%m%dT%H%M%SZ')}.{output_codec.extension}"
+
+    execution_metadata = {
+        "workflow_id": workflow_id,
+        "code_execution_id": execution_id,
+        "code_execution_date": current_datetime,
+        "fetched_hour": fetch_hour,
+        "number_of_files_fetched": len(keys),
+        "file_destination_path": f"s3://{s3_data_bucket}/{output_filename}",
+        "file_codec": output_codec.name,
+    }
+    stage_metrics = StageMetrics(
+        code_step="ingestor", workflow_id=workflow_id, code_execution_id=execution_id
+    )
+    execution_metadata["stage_metrics"] = stage_metrics
+    error = None
+
+    try:
+        logger.info(
+            f"Execution started. UUID: {execution_id}, Timestamp: {current_datetime.isoformat()}"
         )
-        if not jsons:
-            logger.warning("No JSON files found for this hour.")
+        logger.info(f"Fetching data from hour: {fetch_hour}.")
+
+        with stage_metrics.bind():
+            number_of_records = upload_hour_records(
+                getenv("INGESTOR_ENGINE", "threads"),
+                keys,
+                s3_source_instance,
+                s3_source_bucket,
+                s3_data_instance,
+                s3_data_bucket,
+                output_filename,
+                output_codec.name,
+            )
+        if not number_of_records:
+            # no object was written, the handler has nothing to load for the hour
+            execution_metadata["number_of_files_fetched"] = 0
+            execution_metadata["file_destination_path"] = None
+            logger.warning(f"No JSON files found for hour {fetch_hour}.")
         else:
-            logger.info(f"Fetched {number_of_files_fetched} files from S3 bucket.")
-            merged_json = merge_jsons(jsons)
-            save_json_locally(merged_json, output_filename)
-            s3_data_instance.upload_file_to_bucket(output_filename, s3_data_bucket)
+            logger.info(f"Fetched {len(keys)} files from S3 bucket.")
 
     except Exception as e:
+        logger.error(f"Error fetching hour {fetch_hour}: {e}")
         execution_metadata["traceback"] = traceback.format_exc()
-        raise e
-    finally:
-        logger.info("ingestor step finished.\n")
-        s3_anon_instance.close()
-        s3_data_instance.close()
-
-        execution_metadata["workflow_id"] = workflow_id
-        execution_metadata["code_execution_id"] = execution_id
-        execution_metadata["code_execution_date"] = current_datetime
-        execution_metadata["fetched_hour"] = code_fetch_date
-        execution_metadata["number_of_files_fetched"] = number_of_files_fetched
-        execution_metadata["file_destination_path"] = (
-            f"s3://{s3_data_bucket}/{output_filename}"
+        error = e
+
+    return execution_metadata, error
+
+
+def upload_hour_records(
+    engine,
+    keys,
+    s3_source_instance,
+    s3_source_bucket,
+    s3_data_instance,
+    s3_data_bucket,
+    output_filename,
+    output_codec,
+):
+    """
+    Download the source files of an hour and upload their records to the data bucket
+    as one file, with either engine. Both produce the same file.
+
+    Args:
+        engine (str): 'threads' streams the records of S3.iter_json_records (downloaded
+            and parsed by a thread pool) into S3.upload_records; 'asyncio' runs
+            download, parse, encode and part uploads as overlapping pipeline stages (see
+            helper.pipeline).
+        keys (list): Source object keys of the hour.
+        s3_source_instance (S3): Client with access to the source bucket.
+        s3_source_bucket (str): Name of the source bucket.
+        s3_data_instance (S3): Client with access to the data bucket.
+        s3_data_bucket (str): Name of the data bucket.
+        output_filename (str): Key of the uploaded file.
+        output_codec (str): Name of the codec of the uploaded file.
+
+    Returns:
+        int: Number of records uploaded.
+    """
+    if engine == "asyncio":
+        return upload_records_pipelined(
+            s3_source_instance,
+            s3_source_bucket,
+            keys,
+            s3_data_instance,
+            s3_data_bucket,
+            output_filename,
+            output_codec,
+        )
+    if engine == "threads":
+        return s3_data_instance.upload_records(
+            s3_source_instance.iter_json_records(s3_source_bucket, keys),
+            s3_data_bucket,
+            output_filename,
+            codec=output_codec,
         )
+    raise ValueError(
+        f"Invalid ingestor engine '{engine}'. Valid options are: {', '.join(ENGINES)}."
+    )
+
+
+def get_hours_to_fetch(first_hour, max_hours, end_timestamp=None):
+    """
+    List the complete hours to fetch in catch-up mode.
+
+    Args:
+        first_hour (datetime): First hour to fetch (UTC).
+        max_hours (int): Maximum number of hours, None for no limit.
+        end_timestamp (datetime, optional): Only hours starting before it are listed.
+
+    Returns:
+        list: Hours to fetch, in order.
+    """
+    last_complete_hour = datetime.now(timezone.utc).replace(
+        minute=0, second=0, microsecond=0
+    ) - timedelta(hours=1)
+
+    fetch_hours = []
+    fetch_hour = first_hour
+    while (
+        max_hours is None or len(fetch_hours) < max_hours
+    ) and fetch_hour <= last_complete_hour:
+        if end_timestamp is not None and fetch_hour >= end_timestamp:
+            break
+        fetch_hours.append(fetch_hour)
+        fetch_hour += timedelta(hours=1)
+    return fetch_hours
 
-        s3_instance.insert_metadata(code_step="ingestor", metadata=execution_metadata)
-        s3_instance.close()
+
+def _skipped_hour_metadata(workflow_id, fetch_hour, failed_hour):
+    """
+    Build the execution metadata of an hour not fetched because a previous hour failed.
+
+    Args:
+        workflow_id (str): Workflow ID of the hour.
+        fetch_hour (datetime): Hour that was not fetched.
+        failed_hour (datetime): Previous hour that failed.
+
+    Returns:
+        dict: Execution metadata of the hour.
+    """
+    return {
+        "workflow_id": workflow_id,
+        "code_execution_id": str(uuid.uuid4()),
+        "code_execution_date": datetime.now(timezone.utc),
+        "fetched_hour": fetch_hour,
+        "number_of_files_fetched": 0,
+        "traceback": f"Hour not fetched: previous hour {failed_hour} failed.",
+    }
+
+
+def refresh_object_index(s3_instance, metadata_instance, bucket_name, prefix="data/"):
+    """
+    Add the objects created since the last run to the S3 object index, listing only
+    the keys that sort after the last indexed one.
+
+    Args:
+        s3_instance (S3): Client with access to the indexed bucket.
+        metadata_instance (PostgresSQL): Connection to the monitor database.
+        bucket_name (str): Name of the S3 bucket to index.
+        prefix (str, optional): Key prefix to index.
+    """
+    last_indexed_key = metadata_instance.get_last_indexed_key(bucket_name)
+    new_objects = list(
+        s3_instance.list_objects(
+            bucket_name, prefix=prefix, start_after=last_indexed_key
+        )
+    )
+    if new_objects:
+        metadata_instance.index_objects(bucket_name, new_objects)
+    logger.info(f"Indexed {len(new_objects)} new objects from S3 bucket {bucket_name}.")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,120 @@
+from datetime import datetime, timedelta, timezone
+from helper.resources import Resources
+from helper.logger import logger
+from ingestor import ingestor
+from handler import handler
+import threading
+import signal
+import uuid
+
+
+def main(max_hours=1, workers=1, delay=60, retry_interval=60):
+    """
+    Run the ingestor and handler steps forever, keeping clients and connections open
+    between runs. Whenever the hours following the last fetched one are complete, they
+    are fetched (up to max_hours per run) and handled back-to-back until the daemon
+    catches up. It then sleeps until the next hour is complete plus 'delay' seconds.
+    Workflows whose handler run failed are handled again on the following runs.
+    SIGTERM and SIGINT stop the daemon once the running hours are handled.
+
+    Args:
+        max_hours (int, optional): Maximum number of hours fetched per run.
+        workers (int, optional): Number of hours fetched in parallel.
+        delay (int, optional): Seconds waited after an hour ends before fetching it.
+        retry_interval (int, optional): Seconds waited after a failed run.
+    """
+    stop_event = threading.Event()
+
+    def request_stop(signum, frame):
+        logger.info(
+            f"Received {signal.Signals(signum).name}, stopping after the current run."
+        )
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    logger.info(
+        f"Starting daemon -- up to {max_hours} hour(s) per run, {workers} worker(s)."
+    )
+    resources = Resources()
+    try:
+        while not stop_event.is_set():
+            try:
+                workflow_ids = run_once(resources, max_hours, workers, delay)
+            except Exception as e:
+                logger.error(f"Daemon run failed, retrying in {retry_interval}s: {e}")
+                # connections may be broken, they are opened again on the next run
+                resources.close()
+                stop_event.wait(retry_interval)
+                continue
+
+            if workflow_ids:
+                # still behind: fetch the following hours right away
+                continue
+
+            wait_seconds = seconds_until_next_hour(delay)
+            logger.info(f"Caught up, next run in {wait_seconds:.0f}s.")
+            stop_event.wait(wait_seconds)
+    finally:
+        resources.close()
+        logger.info("Daemon stopped.")
+
+
+def run_once(resources, max_hours, workers, delay=0):
+    """
+    Fetch the complete hours following the last fetched one and handle them, together
+    with the workflows not loaded cleanly by previous runs (see
+    handler.get_pending_workflows), in one coalesced handler run.
+
+    Args:
+        resources (Resources): Shared clients and connections.
+        max_hours (int): Maximum number of hours fetched.
+        workers (int): Number of hours fetched in parallel.
+        delay (int, optional): Seconds waited after an hour ends before fetching it.
+
+    Returns:
+        list: Workflow IDs of the hours fetched (and handled, successfully or not).
+    """
+    workflow_id = str(uuid.uuid4())
+    logger.info(f"Starting workflow {workflow_id} -- step(s): ingestor and handler")
+
+    # only the hours that ended 'delay' seconds ago are fetched, late files included
+    workflow_ids = ingestor.main(
+        workflow_id,
+        max_hours=max_hours,
+        end_timestamp=datetime.now(timezone.utc) - timedelta(hours=1, seconds=delay),
+        workers=workers,
+        resources=resources,
+    )
+    # the pending workflows are the oldest ones, the hours just fetched usually among
+    # them
+    handler_workflow_ids = list(
+        dict.fromkeys(handler.get_pending_workflows(resources) + workflow_ids)
+    )
+    if handler_workflow_ids:
+        try:
+            handler.main(handler_workflow_ids, resources=resources)
+        except Exception as e:
+            # the failure is recorded in handler_executions, the workflows are handled
+            # again on the next run, on fresh connections
+            logger.error(
+                f"Handler failed for workflow(s) {', '.join(handler_workflow_ids)}: {e}"
+            )
+            resources.close()
+    return workflow_ids
+
+
+def seconds_until_next_hour(delay):
+    """
+    Return the number of seconds until the current hour is complete, plus a delay.
+
+    Args:
+        delay (int): Seconds added after the end of the hour.
+
+    Returns:
+        float: Seconds to wait.
+    """
+    now = datetime.now(timezone.utc)
+    next_hour = now.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+    return (next_hour - now).total_seconds() + delay
@@ -0,0 +1,222 @@
+from os import getenv
+from datetime import datetime, timedelta, timezone
+from helper.resources import Resources
+from helper.logger import logger
+from ingestor import ingestor
+from handler import handler
+from scheduler.scheduler import seconds_until_next_hour
+from contextlib import contextmanager
+import threading
+import signal
+import socket
+import os
+
+
+def main(max_hours=1, delay=60, worker_name=None, resources=None):
+    """
+    Run a worker forever, claiming its work from the work_queue table of monitor_db.
+    Any number of workers (processes or nodes) can run against the same database: the
+    complete hours are queued once, each hour is claimed by a single worker with
+    SELECT ... FOR UPDATE SKIP LOCKED and a lease, fetched, published to
+    ingestor_executions in hour order and finally handled. A worker that dies loses its
+    lease and its work is claimed again by another worker once the lease expires.
+    SIGTERM and SIGINT stop the worker once its current work is done.
+
+    Args:
+        max_hours (int, optional): Maximum number of hours queued per run, and of
+            fetched hours handled together in one coalesced handler run.
+        delay (int, optional): Seconds waited after an hour ends before fetching it.
+        worker_name (str, optional): Name recorded on the claims. Defaults to the host
+            name and process ID.
+        resources (Resources, optional): Shared clients and connections. Created (and
+            closed when the worker stops) when not given.
+    """
+    lease_seconds = int(getenv("WORK_LEASE_SECONDS", 600))
+    retry_seconds = int(getenv("WORK_RETRY_SECONDS", 60))
+    max_attempts = int(getenv("WORK_MAX_ATTEMPTS", 5))
+    poll_seconds = int(getenv("WORK_POLL_SECONDS", 30))
+    worker_name = worker_name or f"{socket.gethostname()}:{os.getpid()}"
+    stop_event = threading.Event()
+
+    def request_stop(signum, frame):
+        logger.info(
+            f"Received {signal.Signals(signum).name}, stopping after the current work."
+        )
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    logger.info(
+        f"Starting worker {worker_name} -- up to {max_hours} hour(s) per claim, {lease_seconds}s leases."
+    )
+    owns_resources = resources is None
+    if owns_resources:
+        resources = Resources()
+    try:
+        while not stop_event.is_set():
+            try:
+                claimed = run_once(
+                    resources,
+                    worker_name,
+                    max_hours,
+                    delay,
+                    lease_seconds,
+                    retry_seconds,
+                    max_attempts,
+                )
+            except Exception as e:
+                logger.error(f"Worker run failed, retrying in {retry_seconds}s: {e}")
+                # connections may be broken, they are opened again on the next run
+                resources.close()
+                stop_event.wait(retry_seconds)
+                continue
+
+            if not claimed:
+                # the other workers may publish hours to handle before the next one ends
+                stop_event.wait(min(poll_seconds, seconds_until_next_hour(delay)))
+    finally:
+        if owns_resources:
+            resources.close()
+        logger.info(f"Worker {worker_name} stopped.")
+
+
+def run_once(
+    resources,
+    worker_name,
+    max_hours,
+    delay,
+    lease_seconds,
+    retry_seconds,
+    max_attempts=5,
+):
+    """
+    Queue the complete hours following the last queued one, then claim and run one piece
+    of work: the oldest fetched hours waiting to be handled (up to max_hours, handled in
+    one coalesced run), or else the oldest hour waiting to be fetched. Work that failed
+    max_attempts times is given up first, so it does not block the queue.
+
+    Args:
+        resources (Resources): Shared clients and connections.
+        worker_name (str): Name recorded on the claims.
+        max_hours (int): Maximum number of hours queued, and of hours handled together.
+        delay (int): Seconds waited after an hour ends before fetching it.
+        lease_seconds (int): Seconds a claim lasts unless renewed.
+        retry_seconds (int): Seconds before failed work can be claimed again.
+        max_attempts (int, optional): Number of claims after which work is given up.
+
+    Returns:
+        bool: Whether work was claimed.
+    """
+    # the work queue gets its own connection, renewed from another thread while the
+    # steps use theirs
+    queue_instance = resources.postgres(
+        getenv("DATA_WAREHOUSE_MONITOR_DB"), name="work_queue"
+    )
+    end_timestamp = datetime.now(timezone.utc) - timedelta(hours=1, seconds=delay)
+    queued_hours = queue_instance.enqueue_hours(
+        ingestor.FIRST_FETCH_DATE,
+        lambda first_hour: ingestor.get_hours_to_fetch(
+            first_hour, max_hours, end_timestamp
+        ),
+    )
+    if queued_hours:
+        logger.info(
+            f"Queued {len(queued_hours)} hour(s) from {queued_hours[0]} to {queued_hours[-1]}."
+        )
+    for fetch_hour, workflow_id in queue_instance.fail_exhausted_work(max_attempts):
+        logger.error(
+            f"Hour {fetch_hour} (workflow {workflow_id}) failed {max_attempts} times and is given up, its status is now 'failed'."
+        )
+
+    lease_token, workflow_ids = queue_instance.claim_workflows(
+        worker_name, lease_seconds, max_hours
+    )
+    if workflow_ids:
+        logger.info(f"Claimed {len(workflow_ids)} workflow(s) to handle.")
+        try:
+            with _renewed_lease(queue_instance, lease_token, lease_seconds):
+                # the handler_executions rows are only written while the claim is held
+                loaded_workflow_ids = handler.main(
+                    workflow_ids, resources=resources, lease_token=lease_token
+                )
+        except BaseException:
+            # the failure is recorded in handler_executions; the claim is also given
+            # back when a step stops the worker (SystemExit, KeyboardInterrupt)
+            queue_instance.release_work(lease_token, retry_seconds)
+            raise
+
+        # workflows already loaded before this run have no rows to write
+        queue_instance.complete_workflows(lease_token, loaded_workflow_ids)
+        failed_workflow_ids = [
+            workflow_id
+            for workflow_id in workflow_ids
+            if workflow_id not in loaded_workflow_ids
+        ]
+        if failed_workflow_ids:
+            logger.error(
+                f"Workflow(s) {', '.join(failed_workflow_ids)} not loaded cleanly, retrying in {retry_seconds}s."
+            )
+            queue_instance.release_work(
+                lease_token, retry_seconds, workflow_ids=failed_workflow_ids
+            )
+        return True
+
+    claim = queue_instance.claim_hour(worker_name, lease_seconds)
+    if claim is None:
+        return False
+
+    lease_token, fetch_hour, workflow_id = claim
+    logger.info(f"Claimed hour {fetch_hour} -- workflow {workflow_id}.")
+    try:
+        with _renewed_lease(queue_instance, lease_token, lease_seconds):
+            execution_metadata, error = ingestor.ingest_queued_hour(
+                workflow_id,
+                # fetched_hour is stored without time zone, always in UTC
+                fetch_hour.replace(tzinfo=timezone.utc),
+                resources,
+            )
+    except BaseException:
+        queue_instance.release_work(lease_token, retry_seconds)
+        raise
+
+    if error is not None:
+        # the failure is recorded in ingestor_executions, the following hours are only
+        # published once this one is fetched
+        logger.error(f"Hour {fetch_hour} failed, retrying in {retry_seconds}s.")
+        queue_instance.release_work(lease_token, retry_seconds)
+    elif not queue_instance.complete_hour(lease_token, execution_metadata):
+        logger.warning(
+            f"Lease of hour {fetch_hour} expired and it was claimed again, its file is discarded."
+        )
+    return True
+
+
+@contextmanager
+def _renewed_lease(queue_instance, lease_token, lease_seconds):
+    """
+    Renew a claim of the work queue every third of its lease while the block runs.
+
+    Args:
+        queue_instance (PostgresSQL): Connection used by the work queue only.
+        lease_token (str): Token returned by the claim.
+        lease_seconds (int): Seconds a claim lasts unless renewed.
+    """
+    stop_event = threading.Event()
+
+    def renew():
+        while not stop_event.wait(lease_seconds / 3):
+            try:
+                if not queue_instance.renew_lease(lease_token, lease_seconds):
+                    logger.warning(f"Lease {lease_token} expired and was lost.")
+                    return
+            except Exception as e:
+                logger.error(f"Error renewing lease {lease_token}: {e}")
+
+    renew_thread = threading.Thread(target=renew, daemon=True)
+    renew_thread.start()
+    try:
+        yield
+    finally:
+        stop_event.set()
+        renew_thread.join()
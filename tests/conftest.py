@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules are imported the way the executor runs them, from src/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "src"))
@@ -0,0 +1,134 @@
+from helper.extractor import compile_schema_entities
+from helper.helper import df_columns_normalization, read_yaml
+import os
+import pandas as pd
+import pytest
+
+SCHEMA_ENTITIES_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(__file__)), "src", "helper", "schema_entities.yaml"
+)
+
+RECORDS = {
+    "vehicle": [
+        {
+            "event": "update",
+            "on": "vehicle",
+            "at": "2019-06-01T18:17:10.101Z",
+            "organization_id": " org-1 ",
+            "data": {
+                "id": "bac5188f-67c6-4965-81dc-4ef49622e280",
+                "location": {
+                    "lat": 52.5,
+                    "lng": 13,
+                    "at": "2019-06-01T18:17:10.101Z",
+                },
+            },
+            "original_s3_file_path": "s3://bucket/data/0000.json",
+        },
+        # same record twice, dropped by the normalization
+        {
+            "event": "update",
+            "on": "vehicle",
+            "at": "2019-06-01T18:17:10.101Z",
+            "organization_id": " org-1 ",
+            "data": {
+                "id": "bac5188f-67c6-4965-81dc-4ef49622e280",
+                "location": {
+                    "lat": 52.5,
+                    "lng": 13,
+                    "at": "2019-06-01T18:17:10.101Z",
+                },
+            },
+            "original_s3_file_path": "s3://bucket/data/0000.json",
+        },
+        {
+            "event": "register",
+            "on": "vehicle",
+            "at": "2019-06-01T18:17:11Z",
+            "organization_id": None,
+            "data": {"id": "2f8bde4e-1d2b-4b1d-9c4d-0f5d1e0b8a43"},
+            "original_s3_file_path": "s3://bucket/data/0000.json",
+        },
+        {
+            "event": "update",
+            "on": "vehicle",
+            "at": "malformed",
+            "data": {
+                "id": "2f8bde4e-1d2b-4b1d-9c4d-0f5d1e0b8a43",
+                "location": {"lat": None, "lng": -0.5, "at": None},
+            },
+            "original_s3_file_path": "s3://bucket/data/0001.json",
+        },
+        {
+            "event": "deregister",
+            "on": "vehicle",
+            "at": "2019-06-01T18:17:12.5Z",
+            "organization_id": "",
+            "data": {"id": None, "location": {"lat": 1e-7, "lng": 0.0}},
+            "original_s3_file_path": "s3://bucket/data/0001.json",
+        },
+    ],
+    "operating_period": [
+        {
+            "event": "create",
+            "on": "operating_period",
+            "at": "2019-06-01T18:17:10Z",
+            "organization_id": "org-1",
+            "data": {
+                "id": "op-1",
+                "start": "2019-06-01T00:00:00Z",
+                "finish": "2019-06-30T23:59:59Z",
+            },
+            "original_s3_file_path": "s3://bucket/data/0000.json",
+        },
+        {
+            "event": "delete",
+            "on": "operating_period",
+            "at": "2019-06-02T08:00:00Z",
+            "organization_id": "org-2",
+            "data": {"id": " op-2 ", "start": "2019-06-02T00:00:00Z", "finish": None},
+            "original_s3_file_path": "s3://bucket/data/0001.json",
+        },
+        {
+            "event": "create",
+            "on": "operating_period",
+            "at": "2019-06-02T08:00:01Z",
+            "data": {"id": "op-3"},
+            "original_s3_file_path": "s3://bucket/data/0001.json",
+        },
+    ],
+}
+
+
+@pytest.mark.parametrize("entity", list(RECORDS))
+def test_extractor_matches_json_normalize(entity):
+    column_schema = read_yaml(SCHEMA_ENTITIES_PATH)[entity]["schema"]
+    extractor = compile_schema_entities(SCHEMA_ENTITIES_PATH)[entity]
+
+    extracted_df = df_columns_normalization(
+        extractor.extract(RECORDS[entity]), column_schema
+    )
+    # the handler flattened the whole payload with json_normalize before the extractor
+    legacy_df = df_columns_normalization(
+        pd.json_normalize(RECORDS[entity]), column_schema
+    )
+
+    pd.testing.assert_frame_equal(extracted_df, legacy_df, check_exact=True)
+
+
+def test_paths_missing_from_every_record_are_null_columns():
+    column_schema = read_yaml(SCHEMA_ENTITIES_PATH)["operating_period"]["schema"]
+    extractor = compile_schema_entities(SCHEMA_ENTITIES_PATH)["operating_period"]
+    records = [
+        {key: value for key, value in record.items() if key != "data"}
+        for record in RECORDS["operating_period"]
+    ]
+
+    extracted_df = df_columns_normalization(extractor.extract(records), column_schema)
+
+    # json_normalize left these columns out and the normalization raised a KeyError
+    with pytest.raises(KeyError):
+        df_columns_normalization(pd.json_normalize(records), column_schema)
+    assert extracted_df["operating_period_id"].isna().all()
+    assert extracted_df["operation_start"].isna().all()
+    assert pd.api.types.is_datetime64_dtype(extracted_df["operation_start"])
@@ -0,0 +1,121 @@
+from helper.helper import (
+    _generate_unique_id,
+    df_columns_normalization,
+    generate_unique_ids,
+)
+import numpy as np
+import pandas as pd
+
+
+def _legacy_unique_ids(dataframe, unique_id_columns):
+    """
+    IDs as the row-wise apply generated them, on rows with missing values as None.
+    """
+    legacy_df = dataframe.astype(object).where(dataframe.notna(), None)
+    return legacy_df.apply(_generate_unique_id, args=(unique_id_columns,), axis=1)
+
+
+def _legacy_normalization(dataframe, column_schema):
+    """
+    Previous df_columns_normalization: typed columns with NaN/NaT replaced by None, then
+    _generate_unique_id applied row by row.
+    """
+    types_mapping = {
+        "uuid": pd.StringDtype(),
+        "float": "float64",
+        "bigint": "Int64",
+        "string": pd.StringDtype(),
+    }
+    legacy_df = pd.DataFrame()
+    for original_column_name, column_specs in column_schema.items():
+        column_type = column_specs["type"]
+        if column_type == "timestamp":
+            column = pd.to_datetime(
+                dataframe[original_column_name], errors="coerce"
+            ).dt.tz_localize(None)
+            column = column.replace({pd.NaT: None})
+        else:
+            column = dataframe[original_column_name].astype(types_mapping[column_type])
+            column = column.replace({np.nan: None})
+            if isinstance(types_mapping[column_type], pd.StringDtype):
+                column = column.str.strip()
+        legacy_df[column_specs["column_name"]] = column
+
+    unique_id_columns = [
+        column_specs["column_name"]
+        for column_specs in column_schema.values()
+        if column_specs.get("unique_identifier")
+    ]
+    legacy_df["event_generated_id"] = legacy_df.apply(
+        _generate_unique_id, args=(unique_id_columns,), axis=1
+    )
+    return legacy_df.drop_duplicates(subset=["event_generated_id"])
+
+
+def test_generate_unique_ids_matches_row_wise():
+    dataframe = pd.DataFrame(
+        {
+            "string": pd.Series(["a", None, " b ", "", "ç"], dtype=pd.StringDtype()),
+            "integer": pd.Series([1, None, -3, 0, 2**40], dtype="Int64"),
+            "float": [1.5, np.nan, -0.0, 1e-7, 3.0],
+            "timestamp": pd.to_datetime(
+                [
+                    "2019-06-01T18:17:10.101Z",
+                    None,
+                    "2019-06-01T18:17:10Z",
+                    "not a timestamp",
+                    "2019-06-01T18:17:10.101123Z",
+                ],
+                errors="coerce",
+                format="ISO8601",
+            ).tz_localize(None),
+            "mixed": ["x", 1, 2.5, None, True],
+        }
+    )
+    unique_id_columns = ["string", "integer", "float", "timestamp", "mixed"]
+
+    unique_ids = generate_unique_ids(dataframe, unique_id_columns)
+
+    assert (
+        unique_ids.tolist() == _legacy_unique_ids(dataframe, unique_id_columns).tolist()
+    )
+    assert unique_ids.index.equals(dataframe.index)
+
+
+def test_normalization_ids_match_legacy():
+    column_schema = {
+        "data.id": {"type": "uuid", "column_name": "id", "unique_identifier": True},
+        "at": {
+            "type": "timestamp",
+            "column_name": "event_timestamp",
+            "unique_identifier": True,
+        },
+        "count": {"type": "bigint", "column_name": "count", "unique_identifier": True},
+        "lat": {"type": "float", "column_name": "lat", "unique_identifier": True},
+        "event": {"type": "string", "column_name": "event"},
+    }
+    dataframe = pd.DataFrame(
+        {
+            "data.id": ["a1 ", None, 7, "a1", "b2", None],
+            "at": [
+                "2019-06-01T18:17:10.101Z",
+                "2019-06-01T18:17:11Z",
+                None,
+                "2019-06-01T18:17:10.101Z",
+                "malformed",
+                "2019-06-01T18:17:12+02:00",
+            ],
+            "count": [1, None, 3, 1, 5, 6],
+            "lat": [52.5, np.nan, 13.4, 52.5, None, 0.0],
+            "event": ["update", "register", None, "update", " update ", "update"],
+        },
+        index=[10, 11, 12, 13, 14, 15],
+    )
+
+    normalized_df = df_columns_normalization(dataframe, column_schema)
+    legacy_df = _legacy_normalization(dataframe, column_schema)
+
+    assert (
+        normalized_df["event_generated_id"].tolist()
+        == legacy_df["event_generated_id"].tolist()
+    )
@@ -0,0 +1,41 @@
+from helper import metrics
+import tracemalloc
+
+
+def _stage_peaks(recorder):
+    return {row["stage"]: row["peak_memory_bytes"] for row in recorder.rows()}
+
+
+def test_peak_memory_is_measured_per_stage(monkeypatch):
+    monkeypatch.setenv("STAGE_METRICS_TRACE_MEMORY", "true")
+    was_tracing = tracemalloc.is_tracing()
+    recorder = metrics.StageMetrics("handler", None, None)
+    try:
+        with recorder.bind():
+            with metrics.stage("outer"):
+                with metrics.stage("large"):
+                    large = bytearray(20 * 2**20)
+                    del large
+                with metrics.stage("small"):
+                    small = bytearray(2**20)
+                    del small
+    finally:
+        if not was_tracing:
+            tracemalloc.stop()
+
+    peaks = _stage_peaks(recorder)
+    # a stage after a larger one does not report the larger peak
+    assert 2**19 < peaks["small"] < 2 * 2**20
+    assert 19 * 2**20 < peaks["large"] < 21 * 2**20
+    # an enclosing stage keeps the peak of the stages it contains
+    assert peaks["outer"] >= peaks["large"]
+
+
+def test_peak_memory_is_not_measured_by_default(monkeypatch):
+    monkeypatch.delenv("STAGE_METRICS_TRACE_MEMORY", raising=False)
+    recorder = metrics.StageMetrics("handler", None, None)
+    with recorder.bind():
+        with metrics.stage("stage"):
+            pass
+
+    assert _stage_peaks(recorder) == {"stage": None}
@@ -0,0 +1,34 @@
+from helper.object_cache import ObjectCache
+from helper.s3 import S3
+import io
+import json
+import mmap
+
+
+def test_cached_objects_are_parsed_from_their_memory_map(tmp_path):
+    content = (
+        json.dumps({"event": "update", "at": "2019-06-01T18:17:10.101Z"})
+        + "\n\nnot json\n"
+        + json.dumps({"event": "register", "name": "café"})
+        + "\r\n"
+        + json.dumps({"event": "deregister"})
+    ).encode("utf-8")
+    cache = ObjectCache(str(tmp_path), max_bytes=2**20)
+    cached_content = cache.store(
+        "bucket", "data/0000.json", '"abc"', io.BytesIO(content)
+    )
+
+    assert isinstance(cached_content, mmap.mmap)
+    try:
+        records = S3._parse_json_lines(cached_content, "bucket", "data/0000.json")
+    finally:
+        cached_content.close()
+
+    assert records == S3._parse_json_lines(content, "bucket", "data/0000.json")
+    assert [record["event"] for record in records] == [
+        "update",
+        "register",
+        "deregister",
+    ]
+    assert records[1]["name"] == "café"
+    assert records[0]["original_s3_file_path"] == "bucket/data/0000.json"